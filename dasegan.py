@@ -7,26 +7,31 @@ from models import model_selector
 from models.gan import define_Gen, define_Dis
 from tools.metrics_mnms import compute_metrics_on_directories
 from utils.dasegan_arguments import *
-from utils.data_augmentation import data_augmentation_selector
-from utils.datasets import dataset_selector
-from utils.logging import get_name
+from utils.data_augmentation import data_augmentation_selector, batch_augmentation_selector
+from utils.datasets import dataset_selector, loader_throughput, set_sampler_epoch
+from utils.distributed import cleanup_distributed, gather_objects, get_device, get_rank, is_main_process, local_model
+from utils.checkpoints import load_checkpoint
+from utils.logging import get_name, wandb_save_checkpoint
 from utils.mnms import test_prediction
 from utils.neural import *
 from utils.gans import *
 
 os.environ["WANDB_SILENT"] = "true"
-set_seed(args.seed)
+set_seed(args.seed + get_rank())  # Distributed launches: different augmentations in each process
 
 # Define Dataloader
 #####################################################
 train_aug, train_aug_img, val_aug = data_augmentation_selector(
     args.data_augmentation, args.img_size, args.crop_size, args.mask_reshape_method
 )
+batch_transform = batch_augmentation_selector(args.data_augmentation, add_depth=args.add_depth)
 vol_loader, val_vols, num_classes, class_to_cat, include_background = dataset_selector(
     train_aug, train_aug_img, val_aug, args, sampler=args.data_sampling
 )
 
 print(f"Number of segmentator classes: {num_classes}")
+if args.throughput_batches > 0:
+    loader_throughput(vol_loader, "Train", args.throughput_batches)
 AVAILABLE_LABELS = list(np.arange(0, vol_loader.dataset.num_vendors))
 print(f"Number of vendors: {AVAILABLE_LABELS}")
 
@@ -34,21 +39,23 @@ print(f"Number of vendors: {AVAILABLE_LABELS}")
 #####################################################
 generator = define_Gen(
     input_nc=3 if args.add_depth else 1, output_nc=3 if args.add_depth else 1, ngf=args.ngf, netG=args.gen_net,
-    norm=args.gen_norm_layer, use_dropout=not args.no_dropout, gpu_ids=args.gpu, checkpoint=args.gen_checkpoint
+    norm=args.gen_norm_layer, use_dropout=not args.no_dropout, gpu_ids=args.gpu, checkpoint=args.gen_checkpoint,
+    compile_mode=args.compile_mode, compile_cache=args.compile_cache
 )
 discriminator = define_Dis(
     input_nc=3 if args.add_depth else 1, ndf=args.ndf, netD=args.dis_net, n_layers_D=3, norm=args.dis_norm_layer,
     gpu_ids=args.gpu, checkpoint=args.dis_checkpoint, real_fake=(args.realfake_coef > 0),
-    num_classes=len(AVAILABLE_LABELS)
+    num_classes=len(AVAILABLE_LABELS), compile_mode=args.compile_mode, compile_cache=args.compile_cache
 )
 segmentator = model_selector(
     "segmentation", args.seg_net, num_classes,
-    in_channels=3 if args.add_depth else 1, devices=args.gpu, checkpoint=args.seg_checkpoint
+    in_channels=3 if args.add_depth else 1, devices=args.gpu, checkpoint=args.seg_checkpoint,
+    compile_mode=args.compile_mode, compile_cache=args.compile_cache
 )
 
 if args.dasegan_checkpoint:
     print(f"\nLoading DaSeGAN checkpoint {args.dasegan_checkpoint}...\n")
-    dasegan_checkpoint = torch.load(args.dasegan_checkpoint)
+    dasegan_checkpoint = load_checkpoint(args.dasegan_checkpoint, map_location="cpu")
     generator.load_state_dict(dasegan_checkpoint["generator"])
     discriminator.load_state_dict(dasegan_checkpoint["discriminator"])
     segmentator.load_state_dict(dasegan_checkpoint["segmentator"])
@@ -68,6 +75,7 @@ g_optimizer = torch.optim.Adam([
     {"params": generator.parameters(), "lr": args.generator_lr},
 ], betas=(0.5, 0.999))
 d_optimizer = torch.optim.Adam(discriminator.parameters(), lr=args.discriminator_lr, betas=(0.5, 0.999))
+g_precision, d_precision = MixedPrecision(args.amp), MixedPrecision(args.amp)
 
 g_lr_scheduler = torch.optim.lr_scheduler.LambdaLR(
     g_optimizer, lr_lambda=LambdaLR(args.epochs, 0, args.decay_epoch).step
@@ -76,38 +84,62 @@ d_lr_scheduler = torch.optim.lr_scheduler.LambdaLR(
     d_optimizer, lr_lambda=LambdaLR(args.epochs, 0, args.decay_epoch).step
 )
 
+checkpoint_writer = CheckpointWriter(
+    max_pending=args.checkpoint_queue, content_addressed=args.checkpoint_store == "content",
+    half_precision=args.checkpoint_half, compress=args.checkpoint_compress
+)
+
 vendors_samples = None
 if args.plot_examples:
     print("Generating samples to plot...")
     vendors_samples = get_vendors_samples(args.normalization, add_depth=args.add_depth, num_test_samples=10)
 
-wandb.init(project="MnMs DASEGAN - Exp2", name=get_name(args.unique_id), config=args)  # name="experiment1",
+start_epoch, wandb_id = 0, None
+resume_path = os.path.join(args.output_dir, "checkpoint.pt")
+if args.resume and os.path.exists(resume_path):
+    print(f"\nResuming DaSeGAN training from {resume_path}...\n")
+    resume_state = load_checkpoint(resume_path, map_location="cpu", weights_only=False)
+    generator.load_state_dict(resume_state["generator"])
+    discriminator.load_state_dict(resume_state["discriminator"])
+    segmentator.load_state_dict(resume_state["segmentator"])
+    g_optimizer.load_state_dict(resume_state["g_optimizer"])
+    d_optimizer.load_state_dict(resume_state["d_optimizer"])
+    g_lr_scheduler.load_state_dict(resume_state["g_lr_scheduler"])
+    d_lr_scheduler.load_state_dict(resume_state["d_lr_scheduler"])
+    g_precision.load_state_dict(resume_state["g_precision"])
+    d_precision.load_state_dict(resume_state["d_precision"])
+    set_rng_state(resume_state["rng"][get_rank() % len(resume_state["rng"])])  # One state per process
+    start_epoch, wandb_id = resume_state["epoch"], resume_state["wandb_id"]
+
+wandb.init(  # name="experiment1",
+    project="MnMs DASEGAN - Exp2", name=get_name(args.unique_id), config=args, id=wandb_id, resume="allow",
+    mode=None if is_main_process() else "disabled"  # Distributed launches: main process logs
+)
 
+device = get_device()
 print("\n\n --- START TRAINING --\n")
 
 # wandb.watch(generator)
 # wandb.watch(discriminator)
 
-for epoch in range(args.epochs):
-
-    epoch_gen_loss, epoch_dis_loss = [], []
-
-    epoch_dis_realfake_loss, epoch_dis_xlabel_loss, epoch_dis_ulabel_loss = [], [], []
-    epoch_gen_cycle_loss, epoch_gen_ulabel_loss, epoch_gen_ufake_loss = [], [], []
-    epoch_seg_xtask_loss, epoch_seg_utask_loss = [], []
+for epoch in range(start_epoch, args.epochs):
 
-    vol_x_vendor_acc, vol_u_vendor_acc = [], []
-    vol_x_realfake_acc, vol_u_realfake_acc = [], []
-    vol_x_iou, vol_u_iou = [], []
+    # Losses and metrics accumulated on device, moved to host once at the end of the epoch
+    epoch_values = RunningLosses(debug=args.debug_losses)
+    set_sampler_epoch(vol_loader, epoch)
 
     for batch_indx, batch in enumerate(vol_loader):
 
-        vol_x = batch["image"].cuda()
-        # Como utilizamos datos que no tienen porque estar etiquetados, recibimos una lista de labels
-        # donde puede haber o no (None). Ejemplo: [None, tensor, None, None]
-        inestable_mask = batch["inestable_mask"]
-        vol_x_original_label = torch.from_numpy(np.array(batch["vendor_label"])).cuda()
-        img_id = batch["img_id"]
+        vol_x = batch["image"].to(device)
+        # Como utilizamos datos que no tienen porque estar etiquetados, no todas las muestras tienen mascara:
+        # 'label_present' marca las que la tienen, el resto tienen la mascara a ceros (o no hay 'label' si ninguna)
+        masked_indices = torch.nonzero(batch["label_present"]).flatten().tolist()
+        batch_masks = batch["label"].to(device) if batch["label"] is not None else torch.zeros_like(vol_x[:, :1])
+        vol_x_original_label = torch.from_numpy(np.array(batch["vendor_label"])).to(device)
+
+        if batch_transform is not None:
+            # Unlabeled samples empty masks are transformed along the batch and skipped by the task loss
+            vol_x, batch_masks = batch_transform(vol_x, batch_masks)
 
         generator.train()
         discriminator.train()
@@ -122,24 +154,24 @@ for epoch in range(args.epochs):
         g_optimizer.zero_grad()
 
         # -- Forward pass through generator --
-        vol_u = generator(vol_x)
+        with g_precision.autocast():
+            vol_u = generator(vol_x)
 
-        pred_x = segmentator(vol_x)
-        pred_u = segmentator(vol_u)
+            pred_x = segmentator(vol_x)
+            pred_u = segmentator(vol_u)
 
         # --- Task Loss ---
-        if not all(m is None for m in inestable_mask):
-            original_masks = torch.vstack([imask for imask in inestable_mask if imask is not None]).to(pred_x.device)
-            masked_indices = torch.tensor([index for index, imask in enumerate(inestable_mask) if imask is not None])
-            masked_indices = masked_indices.to(pred_x.device)
+        if len(masked_indices) > 0:
+            masked_select = torch.tensor(masked_indices, device=pred_x.device)
+            original_masks = torch.index_select(batch_masks, 0, masked_select).squeeze(1)
 
             task_loss_x = calculate_loss(
-                original_masks, torch.index_select(pred_x, 0, masked_indices),
+                original_masks, torch.index_select(pred_x, 0, masked_select),
                 task_criterion, task_weights_criterion, task_multiclass_criterion, num_classes
             )
 
             task_loss_u = calculate_loss(
-                original_masks, torch.index_select(pred_u, 0, masked_indices),
+                original_masks, torch.index_select(pred_u, 0, masked_select),
                 task_criterion, task_weights_criterion, task_multiclass_criterion, num_classes
             ) * linear_rampup(args.epochs, epoch + 1, args.task_loss_u_coef)
 
@@ -148,37 +180,39 @@ for epoch in range(args.epochs):
             task_loss = task_loss_x = task_loss_u = torch.tensor(0).to(pred_x.device)
 
         # --- Identity/Cycle losses ---
-        cycle_loss = identity_mask_criterion(pred_x, pred_u) * args.cycle_coef
+        cycle_loss = identity_mask_criterion(pred_x.float(), pred_u.float()) * args.cycle_coef
 
         # --- Adversarial losses: Vendor Label ---
-        vol_fake_label_u, vol_vendor_label_u = discriminator(vol_u)
+        # Criterions stay in fp32 under autocast (L1, MSE, BCEWithLogits and CE are autocasted to float32)
+        with g_precision.autocast():
+            vol_fake_label_u, vol_vendor_label_u = discriminator(vol_u)
 
-        random_labels = get_random_labels(vol_x_original_label, AVAILABLE_LABELS)
-        random_labels = labels2rfield(
-            method=args.rfield_method, shape=vol_vendor_label_u.shape,
-            label_range=(0, len(AVAILABLE_LABELS)), labels=random_labels
-        ).to(vol_vendor_label_u.device)
+            random_labels = get_random_labels(vol_x_original_label, AVAILABLE_LABELS)
+            random_labels = labels2rfield(
+                method=args.rfield_method, shape=vol_vendor_label_u.shape,
+                label_range=(0, len(AVAILABLE_LABELS)), labels=random_labels
+            ).to(vol_vendor_label_u.device)
 
-        vendor_label_loss_u = dis_labels_criterion(vol_vendor_label_u, random_labels) * args.vendor_label_coef
+            vendor_label_loss_u = dis_labels_criterion(vol_vendor_label_u, random_labels) * args.vendor_label_coef
 
-        # --- Adversarial losses: Real/Fake Label ---
-        fake_label_loss_u = 0
-        if args.realfake_coef > 0:
-            target_real = torch.ones_like(vol_fake_label_u).cuda()
-            fake_label_loss_u = dis_realfake_criterion(vol_fake_label_u, target_real) * args.realfake_coef
+            # --- Adversarial losses: Real/Fake Label ---
+            fake_label_loss_u = 0
+            if args.realfake_coef > 0:
+                target_real = torch.ones_like(vol_fake_label_u)
+                fake_label_loss_u = dis_realfake_criterion(vol_fake_label_u, target_real) * args.realfake_coef
 
         # --- Total generators losses ---
         gen_loss = cycle_loss + vendor_label_loss_u + fake_label_loss_u + task_loss
-        epoch_gen_loss.append(gen_loss.item())
-        epoch_gen_cycle_loss.append(cycle_loss.item())
-        epoch_gen_ulabel_loss.append(vendor_label_loss_u.item())
-        epoch_seg_xtask_loss.append(task_loss_x.item())
-        epoch_seg_utask_loss.append(task_loss_u.item())
-        epoch_gen_ufake_loss.append(0 if fake_label_loss_u == 0 else fake_label_loss_u.item())
+        epoch_values.add("Generator Loss", gen_loss)
+        epoch_values.add("Generator Cycle Loss", cycle_loss)
+        epoch_values.add("Generator U-VendorLabel Loss", vendor_label_loss_u)
+        epoch_values.add("Segmentator X-Task Loss", task_loss_x)
+        epoch_values.add("Segmentator U-Task Loss", task_loss_u)
+        epoch_values.add("Generator U-Fake Loss", fake_label_loss_u)
 
         #  --- Update generators ---
-        gen_loss.backward()
-        g_optimizer.step()
+        g_precision.backward(gen_loss)
+        g_precision.step(g_optimizer)
 
         #####################################################
         # ------------ Discriminator Computations -----------
@@ -188,38 +222,39 @@ for epoch in range(args.epochs):
         set_grad([segmentator, generator], False)
         d_optimizer.zero_grad()
 
-        # --- Forward pass through discriminators ---
-        vol_real_label_x, vol_label_x = discriminator(vol_x)
-        vol_fake_label_u, vol_label_u = discriminator(vol_u.detach())
+        with d_precision.autocast():
+            # --- Forward pass through discriminators ---
+            vol_real_label_x, vol_label_x = discriminator(vol_x)
+            vol_fake_label_u, vol_label_u = discriminator(vol_u.detach())
 
-        # --- Discriminator losses ---
-        vol_x_original_label_rfield = labels2rfield(
-            method="maps", shape=vol_label_x.shape, labels=vol_x_original_label
-        ).to(vol_label_x.device)
-        vol_x_label_dis_loss = dis_labels_criterion(vol_label_x, vol_x_original_label_rfield)
-        vol_u_label_dis_loss = dis_labels_criterion(vol_label_u, vol_x_original_label_rfield) * args.dis_u_coef
+            # --- Discriminator losses ---
+            vol_x_original_label_rfield = labels2rfield(
+                method="maps", shape=vol_label_x.shape, labels=vol_x_original_label
+            ).to(vol_label_x.device)
+            vol_x_label_dis_loss = dis_labels_criterion(vol_label_x, vol_x_original_label_rfield)
+            vol_u_label_dis_loss = dis_labels_criterion(vol_label_u, vol_x_original_label_rfield) * args.dis_u_coef
 
-        # -- Real/Fake Label --
-        real_fake_loss = 0
-        if args.realfake_coef > 0:
-            target_real = torch.ones_like(vol_real_label_x).cuda()
-            real_loss_x = dis_realfake_criterion(vol_real_label_x, target_real)
+            # -- Real/Fake Label --
+            real_fake_loss = 0
+            if args.realfake_coef > 0:
+                target_real = torch.ones_like(vol_real_label_x)
+                real_loss_x = dis_realfake_criterion(vol_real_label_x, target_real)
 
-            target_fake = torch.zeros_like(vol_fake_label_u).cuda()
-            fake_loss_u = dis_realfake_criterion(vol_fake_label_u, target_fake)
+                target_fake = torch.zeros_like(vol_fake_label_u)
+                fake_loss_u = dis_realfake_criterion(vol_fake_label_u, target_fake)
 
-            real_fake_loss = (real_loss_x + fake_loss_u) * args.realfake_coef
+                real_fake_loss = (real_loss_x + fake_loss_u) * args.realfake_coef
 
         # Total discriminators losses
         dis_loss = vol_x_label_dis_loss + vol_u_label_dis_loss + real_fake_loss
-        epoch_dis_loss.append(dis_loss.item())
-        epoch_dis_xlabel_loss.append(vol_x_label_dis_loss.item())
-        epoch_dis_ulabel_loss.append(vol_u_label_dis_loss.item())
-        epoch_dis_realfake_loss.append(0 if real_fake_loss == 0 else real_fake_loss.item())
+        epoch_values.add("Discriminator Loss", dis_loss)
+        epoch_values.add("Discriminator X-VendorLabel Loss", vol_x_label_dis_loss)
+        epoch_values.add("Discriminator U-VendorLabel Loss", vol_u_label_dis_loss)
+        epoch_values.add("Discriminator RealFake Loss", real_fake_loss)
 
         # --- Update discriminators ---
-        dis_loss.backward()
-        d_optimizer.step()
+        d_precision.backward(dis_loss)
+        d_precision.step(d_optimizer)
 
         #####################################################
         # ---------------- EVALUATION METRICS ---------------
@@ -229,8 +264,9 @@ for epoch in range(args.epochs):
         discriminator.eval()
 
         # --- Discriminator metrics ---
-        vol_real_label_x, vol_label_x = discriminator(vol_x)
-        vol_fake_label_u, vol_label_u = discriminator(vol_u.detach())
+        with d_precision.autocast():
+            vol_real_label_x, vol_label_x = discriminator(vol_x)
+            vol_fake_label_u, vol_label_u = discriminator(vol_u.detach())
 
         vol_x_original_label_rfield = labels2rfield(
             method="maps", shape=vol_label_x.shape, labels=vol_x_original_label
@@ -240,111 +276,102 @@ for epoch in range(args.epochs):
         vol_label_u = map2multiclass(vol_label_u)
 
         label_size = np.prod(list(vol_x_original_label_rfield.shape))
-        vol_x_vendor_acc.append(
-            (torch.sum(vol_label_x == vol_x_original_label_rfield.squeeze()) / label_size).item()
+        epoch_values.add(
+            "Vendor X Acc", torch.sum(vol_label_x == vol_x_original_label_rfield.squeeze()) / label_size
         )
-        vol_u_vendor_acc.append(
-            (torch.sum(vol_label_u == vol_x_original_label_rfield.squeeze()) / label_size).item()
+        epoch_values.add(
+            "Vendor U Acc", torch.sum(vol_label_u == vol_x_original_label_rfield.squeeze()) / label_size
         )
 
         if args.realfake_coef > 0:
-            vol_x_realfake_acc.append(
-                (torch.sum(
+            epoch_values.add(
+                "RealFake X Acc", torch.sum(
                     (torch.sigmoid(vol_real_label_x) > 0.5) == torch.ones_like(vol_real_label_x),
-                ) / label_size).item()
+                ) / label_size
             )
-            vol_u_realfake_acc.append(
-                (torch.sum(
+            epoch_values.add(
+                "RealFake U Acc", torch.sum(
                     (torch.sigmoid(vol_fake_label_u) > 0.5) == torch.zeros_like(vol_real_label_x)
-                ) / label_size).item()
+                ) / label_size
             )
 
         # --- Segmentator metrics ---
         set_grad([segmentator], False)
         segmentator.eval()
-        pred_x = segmentator(vol_x)
-        for mask_index, mask in enumerate(inestable_mask):
-            if mask is not None:
-                vol_x_iou.append(evaluate_segmentation(pred_x.detach()[mask_index], mask.squeeze()))
-                vol_u_iou.append(evaluate_segmentation(pred_u.detach()[mask_index], mask.squeeze()))
+        with g_precision.autocast():
+            pred_x = segmentator(vol_x)
+        pred_x, pred_u = pred_x.detach().float(), pred_u.detach().float()
+        host_masks = batch_masks[masked_indices].cpu() if len(masked_indices) > 0 else []  # Single copy per batch
+        for mask_index, mask in zip(masked_indices, host_masks):
+            epoch_values.add("Vol X IOU", evaluate_segmentation(pred_x[mask_index], mask.squeeze()))
+            epoch_values.add("Vol U IOU", evaluate_segmentation(pred_u[mask_index], mask.squeeze()))
 
-    logging = {}
+    logging = epoch_values.means()
 
     # --- Plot examples ---
-    if args.plot_examples:
+    if args.plot_examples and is_main_process():
         vendors_transformed_samples = []
-        with torch.no_grad():
+        with torch.no_grad(), g_precision.autocast():
             for vendor_samples in vendors_samples:
                 vendors_transformed_samples.append(
-                    generator(vendor_samples).data.cpu().numpy()[:, 0, ...]
+                    local_model(generator)(vendor_samples).float().data.cpu().numpy()[:, 0, ...]
                 )
         generated_samples = plot_save_generated_vendor_list(
             vendors_transformed_samples, os.path.join(args.output_dir, "generated_samples", f"epoch_{epoch}.jpg")
         )
         logging["Generated Examples"] = generated_samples
 
-    vol_x_vendor_acc, vol_u_vendor_acc = np.mean(vol_x_vendor_acc), np.mean(vol_u_vendor_acc)
-    dis_metrics = f"X Vendor Acc: {vol_x_vendor_acc:.4f} | U Vendor Acc: {vol_u_vendor_acc:.4f}"
-    logging["Vendor X Acc"] = vol_x_vendor_acc
-    logging["Vendor U Acc"] = vol_u_vendor_acc
-
+    dis_metrics = f"X Vendor Acc: {logging['Vendor X Acc']:.4f} | U Vendor Acc: {logging['Vendor U Acc']:.4f}"
     if args.realfake_coef > 0:
-        vol_x_realfake_acc = np.mean(vol_x_realfake_acc)
-        vol_u_realfake_acc = np.mean(vol_u_realfake_acc)
-        dis_metrics += f" | X RealFake Acc: {vol_x_realfake_acc:.4f} | U RealFake Acc: {vol_u_realfake_acc:.4f}"
-        logging["RealFake X Acc"] = vol_x_realfake_acc
-        logging["RealFake U Acc"] = vol_u_realfake_acc
+        dis_metrics += f" | X RealFake Acc: {logging['RealFake X Acc']:.4f}" \
+                       f" | U RealFake Acc: {logging['RealFake U Acc']:.4f}"
 
-    seg_metrics = f" Vol X IOU: {np.mean(vol_x_iou):.4f} | Vol U IOU: {np.mean(vol_u_iou):.4f}"
-    logging["Vol X IOU"] = np.mean(vol_x_iou)
-    logging["Vol U IOU"] = np.mean(vol_u_iou)
+    logging.setdefault("Vol X IOU", np.nan)  # No labeled samples seen this epoch
+    logging.setdefault("Vol U IOU", np.nan)
+    seg_metrics = f" Vol X IOU: {logging['Vol X IOU']:.4f} | Vol U IOU: {logging['Vol U IOU']:.4f}"
 
-    epoch_gen_loss, epoch_dis_loss = np.mean(epoch_gen_loss), np.mean(epoch_dis_loss)
     print(
-        f"Epoch {epoch} | Gen Loss: {epoch_gen_loss:.4f} | Dis Loss: {epoch_dis_loss:.4f} "
+        f"Epoch {epoch} | Gen Loss: {logging['Generator Loss']:.4f} | Dis Loss: {logging['Discriminator Loss']:.4f} "
         f"| {dis_metrics} | {seg_metrics}"
     )
 
-    logging["Generator Loss"] = epoch_gen_loss
-    logging["Discriminator Loss"] = epoch_dis_loss
     logging["Segmentator Learning Rate"] = g_optimizer.param_groups[0]['lr']
     logging["Generator Learning Rate"] = g_optimizer.param_groups[1]['lr']
     logging["Discriminator Learning Rate"] = d_optimizer.param_groups[0]['lr']
 
-    # ---- Checkpoint ----
-    torch.save(
-        {
-            'epoch': epoch + 1,
-            'segmentator': segmentator.state_dict(),
-            'discriminator': discriminator.state_dict(),
-            'generator': generator.state_dict(),
-            'd_optimizer': d_optimizer.state_dict(),
-            'g_optimizer': g_optimizer.state_dict()
-        },
-        f'{args.output_dir}/checkpoint.pt'
-    )
-
-    # Intermediate losses
-    logging["Discriminator RealFake Loss"] = np.mean(epoch_dis_realfake_loss)
-    logging["Discriminator X-VendorLabel Loss"] = np.mean(epoch_dis_xlabel_loss)
-    logging["Discriminator U-VendorLabel Loss"] = np.mean(epoch_dis_ulabel_loss)
-    logging["Segmentator X-Task Loss"] = np.mean(epoch_seg_xtask_loss)
-    logging["Segmentator U-Task Loss"] = np.mean(epoch_seg_utask_loss)
-    logging["Generator Cycle Loss"] = np.mean(epoch_gen_cycle_loss)
-    logging["Generator U-VendorLabel Loss"] = np.mean(epoch_gen_ulabel_loss)
-    logging["Generator U-Fake Loss"] = np.mean(epoch_gen_ufake_loss)
-
     # Logging
 
     wandb.log(logging)
-    wandb.save(f'{args.output_dir}/checkpoint.pt')
 
     # -- Update learning rates --
     g_lr_scheduler.step()
     d_lr_scheduler.step()
 
+    # ---- Checkpoint ---- (full state to resume next epoch, written in background and uploaded to wandb once on disk)
+    rng_states = gather_objects(get_rng_state())  # Every process, main one saves
+    if is_main_process():
+        checkpoint_writer.save(
+            {
+                'epoch': epoch + 1,
+                'segmentator': segmentator.state_dict(),
+                'discriminator': discriminator.state_dict(),
+                'generator': generator.state_dict(),
+                'd_optimizer': d_optimizer.state_dict(),
+                'g_optimizer': g_optimizer.state_dict(),
+                'g_lr_scheduler': g_lr_scheduler.state_dict(),
+                'd_lr_scheduler': d_lr_scheduler.state_dict(),
+                'g_precision': g_precision.state_dict(),
+                'd_precision': d_precision.state_dict(),
+                'rng': rng_states,
+                'wandb_id': wandb.run.id
+            },
+            resume_path, on_written=lambda paths: wandb_save_checkpoint(paths[0], args.output_dir),
+            lossless=True  # Optimizers states
+        )
+
+checkpoint_writer.close()
 
-if args.evaluate:
+if args.evaluate and is_main_process():
     remove_predictions = True
     path_gt = "data/MMs/Testing"
     original_output_dir = args.output_dir
@@ -373,3 +400,5 @@ if args.evaluate:
 
 
 wandb.finish()
+
+cleanup_distributed()
@@ -1,10 +1,16 @@
 import torch
 from torch.optim.swa_utils import AveragedModel
 
+from models.compilation import compile_model
 from models.segmentation import model_selector_segmentation
+from utils.checkpoints import load_checkpoint
+from utils.distributed import is_distributed, distributed_model, get_device
 
 
-def model_selector(problem_type, model_name, num_classes, in_channels, devices="", checkpoint="", from_swa=False):
+def model_selector(
+        problem_type, model_name, num_classes, in_channels, devices="", checkpoint="", from_swa=False,
+        compile_mode="none", compile_cache=""
+):
     """
 
     Args:
@@ -12,9 +18,12 @@ def model_selector(problem_type, model_name, num_classes, in_channels, devices="
         model_name:
         num_classes:
         in_channels:
-        devices:
-        checkpoint:
+        devices: GPU indices for DataParallel (default all visible). Ignored when distributed (torchrun launch):
+                 each process wraps the model in DistributedDataParallel on its own device
+        checkpoint: Path of the weights to load (plain, compressed or content addressed, see CheckpointWriter)
         from_swa:
+        compile_mode: Compiled execution ('none', 'compile' or 'torchscript', see compile_model)
+        compile_cache: Directory to keep compiled artefacts between runs
 
     Returns:
 
@@ -29,12 +38,17 @@ def model_selector(problem_type, model_name, num_classes, in_channels, devices="
 
     model_total_params = sum(p.numel() for p in model.parameters())
     print("Model total number of parameters: {}".format(model_total_params))
-    model = torch.nn.DataParallel(model, device_ids=range(torch.cuda.device_count()))
+    model = model.to(get_device())
+    if is_distributed():  # torchvision encoders keep their (unused) classifier
+        model = distributed_model(model, find_unused_parameters=True)
+    else:
+        model = torch.nn.DataParallel(model, device_ids=devices if len(devices) else range(torch.cuda.device_count()))
+    model = compile_model(model, compile_mode, compile_cache, cache_key=f"{model_name}_{num_classes}_{in_channels}")
     if from_swa:
         model = AveragedModel(model)
 
     if checkpoint != "":
         print("Loaded model from checkpoint: {}".format(checkpoint))
-        model.load_state_dict(torch.load(checkpoint))
+        model.load_state_dict(load_checkpoint(checkpoint, map_location="cpu"))
 
     return model
@@ -0,0 +1,92 @@
+import hashlib
+import inspect
+import os
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+COMPILE_MODES = ("none", "compile", "torchscript")
+
+
+def compile_model(model, compile_mode="none", cache_dir="", cache_key=""):
+    """
+    Opt-in compiled execution of a model. The wrapped module of DataParallel / DistributedDataParallel models is
+    the one compiled, so state_dict keys (and checkpoints) are the same as the eager model ones.
+    :param model: Model, optionally wrapped in DataParallel or DistributedDataParallel
+    :param compile_mode: 'none' (eager), 'compile' (torch.compile, TorchScript if not available in the installed
+                         torch) or 'torchscript' (torch.jit.script, eager if the model can not be scripted)
+    :param cache_dir: Directory where compiled artefacts are kept between runs (inductor cache / scripted modules)
+    :param cache_key: Name of the model configuration for the TorchScript cache (e.g. model name and channels)
+    :return: Model ready to train / predict
+    """
+    if compile_mode not in COMPILE_MODES:
+        assert False, f"Unknown compile mode '{compile_mode}'"
+    if compile_mode == "none":
+        return model
+
+    distributed = isinstance(model, DistributedDataParallel)
+    data_parallel = isinstance(model, torch.nn.DataParallel)
+    if data_parallel and len(model.device_ids) > 1:
+        # DataParallel replicates the module on each forward, replicas can not run compiled graphs / scripted modules
+        print("Compiled models are not replicated by DataParallel: running eager model on multiple GPUs")
+        return model
+    module = model.module if data_parallel or distributed else model
+
+    if compile_mode == "compile" and hasattr(torch.nn.Module, "compile"):
+        if cache_dir != "":
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+        # In place: compiled at first forward, parameters (DistributedDataParallel gradient hooks) and state_dict
+        # keys unchanged
+        module.compile()
+        return model
+
+    if distributed:
+        print("Scripted modules can not replace the DistributedDataParallel module: running eager model")
+        return model
+    if compile_mode == "compile":
+        print("torch.nn.Module.compile not available (torch < 2.2), using TorchScript")
+    scripted = script_module(module, cache_dir, cache_key)
+    if scripted is None:
+        return model
+    if data_parallel:
+        model.module = scripted
+        return model
+    return scripted
+
+
+def script_module(module, cache_dir="", cache_key=""):
+    """
+    torch.jit.script of a module. When cache_dir and cache_key are given, the scripted module is saved and
+    later runs load it (with the weights of the given module) instead of scripting it again. Cached files are
+    invalidated by changes of the torch version, the architecture or the model class source.
+    :return: Scripted module, or None if the model can not be scripted
+    """
+    cache_path = ""
+    if cache_dir != "" and cache_key != "":
+        try:
+            source = inspect.getsource(type(module))
+        except (OSError, TypeError):
+            source = ""
+        architecture = hashlib.sha256(f"{torch.__version__}{module}{source}".encode()).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, f"{cache_key}_{architecture}.pt")
+
+    if cache_path != "" and os.path.exists(cache_path):
+        device = next(module.parameters()).device
+        scripted = torch.jit.load(cache_path, map_location=device)
+        scripted.load_state_dict(module.state_dict())
+        scripted.train(module.training)
+        print(f"Loaded scripted model from cache: {cache_path}")
+        return scripted
+
+    try:
+        scripted = torch.jit.script(module)
+    except Exception as e:
+        reason = next((line.strip() for line in str(e).splitlines() if line.strip() != ""), "")
+        print(f"Model can not be scripted, running eager model ({type(e).__name__}: {reason})")
+        return None
+
+    if cache_path != "":
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.jit.save(scripted, f"{cache_path}.tmp")
+        os.replace(f"{cache_path}.tmp", cache_path)
+    return scripted
@@ -2,11 +2,13 @@ from .discriminator import *
 from .generators import *
 from .my_generators import *
 import models.gan.resnet as studio
+from models.compilation import compile_model
+from utils.checkpoints import load_checkpoint
 
 
 def define_Gen(
         input_nc, output_nc, ngf, netG, norm='batch', use_dropout=False, gpu_ids=[0],
-        checkpoint="", upsample="interpolation"
+        checkpoint="", upsample="interpolation", compile_mode="none", compile_cache=""
 ):
     norm_layer = get_norm_layer(norm_type=norm)
 
@@ -34,21 +36,25 @@ def define_Gen(
     elif netG == "studio_gen":
         model = studio.Generator(z_dim=256, img_size=256, g_conv_dim=32, g_spectral_norm=False, attention=True,
                  attention_after_nth_gen_block=2, conditional_bn=False, num_classes=input_nc,
-                 initialize=False, mixed_precision=False, activation_fn="ReLU").cuda()
+                 initialize=False, mixed_precision=False, activation_fn="ReLU").to(get_device())
     else:
         raise NotImplementedError('Generator model name [%s] is not recognized' % netG)
 
     if netG != "studio_gen":
         model = init_network(gen_net, gpu_ids)
+    model = compile_model(model, compile_mode, compile_cache, cache_key=f"{netG}_{input_nc}_{output_nc}_{ngf}")
 
     if checkpoint != "":
         print("Loaded model from checkpoint: {}".format(checkpoint))
-        model.load_state_dict(torch.load(checkpoint)["generator"])
+        model.load_state_dict(load_checkpoint(checkpoint, map_location="cpu")["generator"])
 
     return model
 
 
-def define_Dis(input_nc, ndf, netD, n_layers_D=3, norm='batch', gpu_ids=[0], checkpoint="", real_fake=False, num_classes=4):
+def define_Dis(
+        input_nc, ndf, netD, n_layers_D=3, norm='batch', gpu_ids=[0], checkpoint="", real_fake=False, num_classes=4,
+        compile_mode="none", compile_cache=""
+):
     norm_layer = get_norm_layer(norm_type=norm)
     if type(norm_layer) == functools.partial:
         use_bias = norm_layer.func == nn.InstanceNorm2d
@@ -69,9 +75,12 @@ def define_Dis(input_nc, ndf, netD, n_layers_D=3, norm='batch', gpu_ids=[0], che
         raise NotImplementedError('Discriminator model name [%s] is not recognized' % netD)
 
     model = init_network(dis_net, gpu_ids)
+    model = compile_model(
+        model, compile_mode, compile_cache, cache_key=f"{netD}_{input_nc}_{ndf}_{n_layers_D}_{real_fake}_{num_classes}"
+    )
 
     if checkpoint != "":
         print("Loaded model from checkpoint: {}".format(checkpoint))
-        model.load_state_dict(torch.load(checkpoint)["discriminator"])
+        model.load_state_dict(load_checkpoint(checkpoint, map_location="cpu")["discriminator"])
 
     return model
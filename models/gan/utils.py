@@ -2,6 +2,7 @@ import functools
 from torch.nn import init
 import torch.nn as nn
 import torch
+from utils.distributed import is_distributed, distributed_model, get_device
 
 """
 #################################################################################
@@ -36,6 +37,9 @@ def init_weights(net, init_type='normal', gain=0.02):
 
 
 def init_network(net, gpu_ids=[]):
+    if is_distributed():  # Each process initializes its weights, DistributedDataParallel broadcasts rank 0 ones
+        init_weights(net)
+        return distributed_model(net.to(get_device()))
     if len(gpu_ids) > 0:
         assert (torch.cuda.is_available())
         net.cuda(gpu_ids[0])
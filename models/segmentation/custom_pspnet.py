@@ -90,4 +90,4 @@ def custom_psp_model_selector(model_name, n_classes):
     if "pretrained" in model_name:
         pretrained = True
     model = PSPNet(n_classes=n_classes, psp_size=128, pretrained=pretrained)
-    return model.cuda()
+    return model
@@ -207,7 +207,7 @@ class EfficientUnet(nn.Module):
         else:
             assert False, "Unknown model: {}".format(model_version)
 
-        self.model.features.init_block.conv.conv = torch.nn.Conv1d(in_channels, efficient_maps_config[0], kernel_size=(3, 3), stride=(2, 2), bias=False)
+        self.model.features.init_block.conv.conv = torch.nn.Conv2d(in_channels, efficient_maps_config[0], kernel_size=(3, 3), stride=(2, 2), bias=False)
 
         self.conv1 = self.model.features.init_block
 
@@ -274,7 +274,7 @@ def efficientnet_model_selector(model_name, num_classes=1, classification=False,
             return EfficientUnet(
                 model_name, pretrained=False, num_classes=num_classes,
                 classification=classification, in_channels=in_channels
-            ).cuda()
+            )
         else:
             assert False, "Unknown model name (cannot use pretrained models on Imagenet!): {}".format(model_name)
 
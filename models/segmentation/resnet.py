@@ -210,7 +210,7 @@ class ResUnet(nn.Module):
             for param in self.resnet.parameters():  # Frost model
                 param.requires_grad = False
 
-        self.resnet.conv1 = torch.nn.Conv1d(in_channels, 64, (7, 7), (2, 2), (3, 3), bias=False)
+        self.resnet.conv1 = torch.nn.Conv2d(in_channels, 64, (7, 7), (2, 2), (3, 3), bias=False)
 
         self.conv1 = nn.Sequential(
             self.resnet.conv1,
@@ -303,7 +303,7 @@ def resnet_model_selector(model_name, num_classes=1, classification=False, in_ch
         return ResUnet(
             model_name, pretrained=False if "scratch" in model_name else True, num_classes=num_classes,
             classification=classification, in_channels=in_channels, add_scse=add_scse, add_hypercols=add_hypercols
-        ).cuda()
+        )
 
     else:
         assert False, "Unknown model selected!"
@@ -219,4 +219,4 @@ def small_segmentation_model_selector(model_name, n_classes):
         model = UNet(n_channels=3, n_classes=n_classes)
     else:
         assert False, f"Unknown model name: '{model_name}'"
-    return model.cuda()
+    return model
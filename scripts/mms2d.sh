@@ -31,6 +31,7 @@ optimizer="adam"
 # Available data augmentation policies:
 # "none" - "random_crops" - "rotations" - "vflips" - "hflips" - "elastic_transform" - "grid_distortion" - "shift"
 # "scale" - "optical_distortion" - "coarse_dropout" or "cutout" - "downscale"
+# "mms2d" - "mms2d_batch" (same combination applied over batches on device)
 data_augmentation="mms2d"
 
 normalization="negative1_positive1"  # reescale - standardize - standardize_full_vol - standardize_phase
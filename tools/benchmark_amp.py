@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Usage: python -m tools.benchmark_amp --models resnet18_unet_scratch resnet34_unet_scratch --batch_size 8 --img_size 224
+
+Train step (forward + backward + optimizer step) throughput and memory in fp32 against automatic mixed precision
+(fp16 + GradScaler on CUDA, bf16 on CPU) for segmentators (model_selector), generator and discriminator.
+Memory is the CUDA peak allocated memory when available, and always the activations saved for backward.
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # python tools/<script>.py
+from models import model_selector
+from models.gan import define_Gen, define_Dis
+from utils.neural import MixedPrecision
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mixed precision benchmark')
+    parser.add_argument(
+        '--models', nargs='+', default=['resnet18_unet_scratch', 'resnet34_unet_scratch'],
+        help='model_selector segmentators'
+    )
+    parser.add_argument('--gen_net', type=str, default='my_resnet_9blocks', help='Generator to benchmark. "" skips')
+    parser.add_argument('--dis_net', type=str, default='n_layers_spectral', help='Discriminator to benchmark. "" skips')
+    parser.add_argument('--num_classes', type=int, default=4, help='Segmentators output classes')
+    parser.add_argument('--batch_size', type=int, default=8, help='Batch size')
+    parser.add_argument('--img_size', type=int, default=224, help='Input squared size')
+    parser.add_argument('--add_depth', action='store_true', help='3 channels inputs')
+    parser.add_argument('--iterations', type=int, default=10, help='Timed train steps')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed train steps')
+    return parser.parse_args()
+
+
+def saved_activations_bytes(model, inputs, mixed_precision):
+    """
+    Bytes of the tensors autograd keeps for the backward pass of a forward step
+    """
+    saved = []
+
+    def pack(tensor):
+        saved.append(tensor.numel() * tensor.element_size())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor), mixed_precision.autocast():
+        model(inputs)
+    return sum(saved)
+
+
+def train_output(model, inputs):
+    outputs = model(inputs)
+    if isinstance(outputs, (list, tuple)):  # discriminators: [real_fake | None, vendor_label]
+        outputs = outputs[-1]
+    return outputs
+
+
+def benchmark_model(name, model, inputs, args):
+    device = inputs.device
+    results = {}
+    for amp in [False, True]:
+        mixed_precision = MixedPrecision(amp, device_type=device.type)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+        model.train()
+
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+
+        for step in range(args.warmup + args.iterations):
+            if step == args.warmup:
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+            optimizer.zero_grad()
+            with mixed_precision.autocast():
+                outputs = train_output(model, inputs)
+            loss = outputs.float().pow(2).mean()
+            mixed_precision.backward(loss)
+            mixed_precision.step(optimizer)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+        results[amp] = {
+            "throughput": args.iterations * len(inputs) / elapsed,
+            "activations": saved_activations_bytes(
+                lambda x: train_output(model, x), inputs, mixed_precision
+            ) / 1024 ** 2,
+            "peak": torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == "cuda" else None,
+        }
+
+    fp32, amp = results[False], results[True]
+    report = (
+        f"{name:<32} fp32 {fp32['throughput']:8.1f} img/s | amp {amp['throughput']:8.1f} img/s "
+        f"({amp['throughput'] / fp32['throughput']:.2f}x) | saved activations {fp32['activations']:8.1f} MiB -> "
+        f"{amp['activations']:8.1f} MiB ({fp32['activations'] / amp['activations']:.2f}x)"
+    )
+    if fp32["peak"] is not None:
+        report += f" | peak {fp32['peak']:.0f} MiB -> {amp['peak']:.0f} MiB"
+    print(report)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    in_channels = 3 if arguments.add_depth else 1
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    gpu_ids = [0] if device.type == "cuda" else []
+    batch = torch.randn(arguments.batch_size, in_channels, arguments.img_size, arguments.img_size, device=device)
+
+    precision = MixedPrecision(True, device_type=device.type)
+    print(f"\nDevice: {device.type}, mixed precision dtype: {precision.dtype}, "
+          f"batch {arguments.batch_size}x{in_channels}x{arguments.img_size}x{arguments.img_size}\n")
+
+    for model_name in arguments.models:
+        segmentator = model_selector(
+            "segmentation", model_name, arguments.num_classes, in_channels=in_channels
+        ).to(device)
+        benchmark_model(model_name, segmentator, batch, arguments)
+
+    if arguments.gen_net != "":
+        generator = define_Gen(
+            input_nc=in_channels, output_nc=in_channels, ngf=64, netG=arguments.gen_net, norm='instance',
+            gpu_ids=gpu_ids
+        ).to(device)
+        benchmark_model(f"generator {arguments.gen_net}", generator, batch, arguments)
+
+    if arguments.dis_net != "":
+        discriminator = define_Dis(
+            input_nc=in_channels, ndf=64, netD=arguments.dis_net, n_layers_D=3, norm='instance', gpu_ids=gpu_ids
+        ).to(device)
+        benchmark_model(f"discriminator {arguments.dis_net}", discriminator, batch, arguments)
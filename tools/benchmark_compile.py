@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Usage: python -m tools.benchmark_compile --models resnet18_unet_scratch efficientnet_b4c_unet_scratch --img_size 128
+
+Eager against compiled execution (see models.compilation.compile_model) for segmentators (model_selector),
+generator and discriminator. For each mode reports:
+  - Compile overhead: time of the first train step / prediction (when graphs are compiled) above a steady one.
+  - Steady state throughput of train steps (forward + backward + optimizer step) and predictions (eval, no grad).
+  - Max difference (relative to the output scale) of the first prediction against eager with the same
+    initial weights.
+Use --compile_cache to measure warm runs (artefacts cached by a previous run).
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # python tools/<script>.py
+from models import model_selector
+from models.gan import define_Gen, define_Dis
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compiled models benchmark')
+    parser.add_argument(
+        '--models', nargs='+', default=['resnet18_unet_scratch', 'efficientnet_b4c_unet_scratch'],
+        help='model_selector segmentators'
+    )
+    parser.add_argument('--gen_net', type=str, default='my_resnet_9blocks', help='Generator to benchmark. "" skips')
+    parser.add_argument('--dis_net', type=str, default='n_layers_spectral', help='Discriminator to benchmark. "" skips')
+    parser.add_argument(
+        '--modes', nargs='+', default=['compile', 'torchscript'], choices=['compile', 'torchscript'],
+        help='Compile modes compared against eager'
+    )
+    parser.add_argument('--compile_cache', type=str, default="", help='Compiled artefacts cache directory')
+    parser.add_argument('--num_classes', type=int, default=4, help='Segmentators output classes')
+    parser.add_argument('--batch_size', type=int, default=4, help='Batch size')
+    parser.add_argument('--img_size', type=int, default=128, help='Input squared size')
+    parser.add_argument('--add_depth', action='store_true', help='3 channels inputs')
+    parser.add_argument('--iterations', type=int, default=10, help='Timed steps')
+    parser.add_argument('--ngf', type=int, default=64, help='Generator filters')
+    return parser.parse_args()
+
+
+def first_output(outputs):
+    if isinstance(outputs, (list, tuple)):  # discriminators: [real_fake | None, vendor_label]
+        return outputs[-1]
+    return outputs
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def timed_steps(step, iterations, device):
+    """
+    :return: (first step seconds, steady state seconds per step)
+    """
+    start = time.perf_counter()
+    step()
+    synchronize(device)
+    first = time.perf_counter() - start
+    step()  # Some backends finish compiling (e.g. backward graphs) at the second call
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        step()
+    synchronize(device)
+    return first, (time.perf_counter() - start) / iterations
+
+
+def benchmark_mode(build_model, inputs, args):
+    device = inputs.device
+    model = build_model()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+    outputs = []
+
+    def train_step():
+        optimizer.zero_grad()
+        loss = first_output(model(inputs)).float().pow(2).mean()
+        loss.backward()
+        optimizer.step()
+
+    def predict_step():
+        with torch.no_grad():
+            outputs.append(first_output(model(inputs)).float())
+
+    # Predictions first: the first one is computed with the initial weights, the reference against eager
+    model.eval()
+    predict_first, predict_steady = timed_steps(predict_step, args.iterations, device)
+    model.train()
+    train_first, train_steady = timed_steps(train_step, args.iterations, device)
+    return {
+        "reference": outputs[0],
+        "train_overhead": train_first - train_steady, "train_throughput": len(inputs) / train_steady,
+        "predict_overhead": predict_first - predict_steady, "predict_throughput": len(inputs) / predict_steady,
+    }
+
+
+def benchmark_model(name, build_model, inputs, args):
+    """
+    :param build_model: Callable(compile_mode) -> model, built with the same initial weights at each call
+    """
+    eager = benchmark_mode(lambda: build_model("none"), inputs, args)
+    print(
+        f"\n{name}: eager train {eager['train_throughput']:7.1f} img/s | "
+        f"predict {eager['predict_throughput']:7.1f} img/s"
+    )
+    for compile_mode in args.modes:
+        compiled = benchmark_mode(lambda: build_model(compile_mode), inputs, args)
+        # Relative to the output scale: (untrained) discriminator outputs reach 1e5
+        max_diff = (compiled["reference"] - eager["reference"]).abs().max() / eager["reference"].abs().max()
+        print(
+            f"  {compile_mode:<12} train {compiled['train_throughput']:7.1f} img/s "
+            f"({compiled['train_throughput'] / eager['train_throughput']:.2f}x, overhead "
+            f"{compiled['train_overhead']:6.1f} s) | predict {compiled['predict_throughput']:7.1f} img/s "
+            f"({compiled['predict_throughput'] / eager['predict_throughput']:.2f}x, overhead "
+            f"{compiled['predict_overhead']:6.1f} s) | max rel diff {max_diff.item():.1e}"
+        )
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    in_channels = 3 if arguments.add_depth else 1
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    gpu_ids = [0] if device.type == "cuda" else []
+    batch = torch.randn(arguments.batch_size, in_channels, arguments.img_size, arguments.img_size, device=device)
+    print(f"Device: {device.type}, batch {tuple(batch.shape)}")
+
+    def seeded(build):
+        def build_model(compile_mode):
+            torch.manual_seed(0)
+            return build(compile_mode).to(device)
+        return build_model
+
+    for model_name in arguments.models:
+        benchmark_model(model_name, seeded(lambda compile_mode: model_selector(
+            "segmentation", model_name, arguments.num_classes, in_channels=in_channels,
+            compile_mode=compile_mode, compile_cache=arguments.compile_cache
+        )), batch, arguments)
+
+    if arguments.gen_net != "":
+        benchmark_model(f"generator {arguments.gen_net}", seeded(lambda compile_mode: define_Gen(
+            input_nc=in_channels, output_nc=in_channels, ngf=arguments.ngf, netG=arguments.gen_net, norm='instance',
+            gpu_ids=gpu_ids, compile_mode=compile_mode, compile_cache=arguments.compile_cache
+        )), batch, arguments)
+
+    if arguments.dis_net != "":
+        benchmark_model(f"discriminator {arguments.dis_net}", seeded(lambda compile_mode: define_Dis(
+            input_nc=in_channels, ndf=64, netD=arguments.dis_net, n_layers_D=3, norm='instance', gpu_ids=gpu_ids,
+            compile_mode=compile_mode, compile_cache=arguments.compile_cache
+        )), batch, arguments)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Usage: python -m tools.benchmark_metrics --benchmark overlap --batch_size 32 --num_classes 4
+       python -m tools.benchmark_metrics --benchmark surface --batch_size 16 --surface_workers 4
+
+MetricsAccumulator microbenchmarks on synthetic predictions: per sample loop against batched computations.
+Values of both paths are checked to be the same.
+  - overlap: iou and dice (confusion matrices)
+  - surface: hausdorff and assd (shared boundary distance transforms)
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # python tools/<script>.py
+from utils.general import reshape_masks
+from utils.metrics import MetricsAccumulator
+
+BENCHMARK_METRICS = {"overlap": ["iou", "dice"], "surface": ["hausdorff", "assd"]}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MetricsAccumulator microbenchmarks')
+    parser.add_argument('--benchmark', type=str, default="overlap", help='Which benchmark run', choices=BENCHMARK_METRICS)
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size')
+    parser.add_argument('--num_classes', type=int, default=4, help='Model output classes (with background)')
+    parser.add_argument('--img_size', type=int, default=224, help='Predictions squared size')
+    parser.add_argument('--iterations', type=int, default=20, help='Recorded batches')
+    parser.add_argument('--exclude_background', action='store_true', help='include_background=False')
+    parser.add_argument('--surface_workers', type=int, default=0, help='Threads for batched hausdorff/assd')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def synthetic_batches(args, ragged):
+    """
+    Predictions with blobs of each class and targets close to them. When ragged, targets are original masks
+    (numpy arrays) with sizes around img_size, as in validation batches
+    """
+    rng = np.random.RandomState(0)
+    batches = []
+    for _ in range(args.iterations):
+        targets = []
+        predictions = torch.randn(args.batch_size, args.num_classes, args.img_size, args.img_size)
+        for indx in range(args.batch_size):
+            target = rng.randint(0, args.num_classes, (args.img_size // 16, args.img_size // 16))
+            target = np.kron(target, np.ones((16, 16), dtype=target.dtype)).astype(np.uint8)
+            rows, cols = np.arange(args.img_size)[:, None], np.arange(args.img_size)
+            predictions[indx, torch.from_numpy(target.astype(np.int64)), rows, cols] += 3
+            if ragged:  # Crop or pad by an even amount, as original masks of different sizes
+                original_shape = args.img_size + 2 * rng.randint(-20, 20, 2)
+                target = reshape_masks(target, original_shape, "padd").astype(np.uint8)
+            targets.append(target)
+        if not ragged:
+            targets = torch.from_numpy(np.stack(targets)).unsqueeze(1).float().to(args.device)
+        batches.append((predictions.to(args.device), targets))
+    return batches
+
+
+def record_time(metrics, batches, device):
+    start = time.perf_counter()
+    for prediction, target in batches:
+        metrics.record(prediction, target)
+    metrics.flush_pending()  # Batched values are kept on device until update()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / len(batches) * 1000  # milliseconds per batch
+
+
+def benchmark_metrics(args):
+    for ragged in [False, True]:
+        batches = synthetic_batches(args, ragged)
+        results = {}
+        for batched in [False, True]:
+            metrics = MetricsAccumulator(
+                "segmentation", BENCHMARK_METRICS[args.benchmark], args.num_classes, average="mean",
+                include_background=not args.exclude_background, mask_reshape_method="padd", batched=batched,
+                surface_workers=args.surface_workers
+            )
+            results[batched] = (record_time(metrics, batches, args.device), metrics.metrics)
+
+        (loop_ms, loop_values), (batched_ms, batched_values) = results[False], results[True]
+        max_diff = max(
+            np.abs(np.nan_to_num(np.array(loop_values[key][-1][c]) - np.array(batched_values[key][-1][c]))).max(
+                initial=0
+            ) for key in loop_values for c in range(len(loop_values[key][-1]))
+        )
+        same_counts = all(
+            len(loop_values[key][-1][c]) == len(batched_values[key][-1][c])
+            for key in loop_values for c in range(len(loop_values[key][-1]))
+        )
+
+        print(f"\n{'Original masks (ragged)' if ragged else 'Same size labels'} - "
+              f"batch {args.batch_size}x{args.num_classes}x{args.img_size}x{args.img_size} on {args.device}")
+        print(f"Per sample loop: {loop_ms:8.2f} ms/batch")
+        print(f"Batched:         {batched_ms:8.2f} ms/batch ({loop_ms / batched_ms:.1f}x faster)")
+        print(f"Same recorded values: {same_counts}, max abs difference {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    benchmark_metrics(parse_args())
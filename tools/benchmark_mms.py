@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Usage: python -m tools.benchmark_mms --benchmark item_lookup --normalization standardize_phase
+"""
+import argparse
+import os
+import pickle
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from skimage.exposure import match_histograms
+
+import utils.dataload as data_utils
+from utils.data_augmentation import data_augmentation_selector
+from utils.datasets import MMs2DDataset, mms_labeled_infos, mms_slice_paths
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='M&Ms data pipeline microbenchmarks')
+    parser.add_argument(
+        '--benchmark', type=str, required=True, help='Which benchmark run',
+        choices=['item_lookup', 'hist_matching', 'sample_size']
+    )
+    parser.add_argument('--partition', type=str, default="Training", help='MMs2DDataset partition')
+    parser.add_argument('--normalization', type=str, default="standardize_phase", help='Data normalization method')
+    parser.add_argument('--img_size', type=int, default=224, help='Final img squared size')
+    parser.add_argument('--iterations', type=int, default=2000, help='Number of timed items')
+    parser.add_argument('--data_relative_path', type=str, default="", help='Prepend extension to MMs data base dir')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size for collated batches benchmarks')
+    return parser.parse_args()
+
+
+def time_per_item(method, indices):
+    start = time.perf_counter()
+    for idx in indices:
+        method(idx)
+    return (time.perf_counter() - start) / len(indices) * 1e6  # microseconds
+
+
+def legacy_item_lookup(dataset, idx):
+    """
+    Per item DataFrame resolution performed by MMs2DDataset.__getitem__ before precompute_items()
+    """
+    df_entry = dataset.data.loc[idx]
+    external_code = df_entry["External code"]
+    c_slice, c_phase, c_partition = df_entry["Slice"], df_entry["Phase"], df_entry["Partition"]
+    if c_phase == df_entry["ED"]:
+        c_phase_str = "ED"
+    elif c_phase == df_entry["ES"]:
+        c_phase_str = "ES"
+    else:
+        c_phase_str = "UnknownPhase"
+    c_vendor, c_centre = df_entry["Vendor"], df_entry["Centre"]
+    meta_entry = dataset.data_meta.loc[dataset.data_meta["External code"] == external_code]
+    img_id = f"{external_code}_slice{c_slice}_phase{c_phase}_vendor{c_vendor}_centre{c_centre}"
+
+    labeled_info = ""
+    if c_partition == "Training":
+        has_labeled = np.sum(dataset.data.loc[dataset.data["External code"] == external_code]["Labeled"].tolist()) > 0
+        labeled_info = "Labeled" if (df_entry["Labeled"] or has_labeled) else "Unlabeled"
+
+    img_path = os.path.join(
+        dataset.base_dir, c_partition, labeled_info, external_code,
+        f"{external_code}_sa_slice{c_slice}_phase{c_phase}.npy"
+    )
+    if c_phase_str != "UnknownPhase":
+        stats = float(meta_entry[f"{c_phase_str}_mean"].iloc[0]), float(meta_entry[f"{c_phase_str}_std"].iloc[0])
+    else:
+        stats = None
+    return img_path, img_id, stats, dataset.vendor2label[c_vendor]
+
+
+def array_item_lookup(dataset, idx):
+    """
+    Per item resolution using arrays precomputed by MMs2DDataset.precompute_items()
+    """
+    return (
+        dataset.img_paths[idx], dataset.img_ids[idx],
+        (float(dataset.norm_stats[idx, 0]), float(dataset.norm_stats[idx, 1])), int(dataset.vendor_labels[idx])
+    )
+
+
+def benchmark_item_lookup(args):
+    _, _, val_aug = data_augmentation_selector("none", args.img_size, args.img_size, "padd", verbose=False)
+    dataset = MMs2DDataset(
+        partition=args.partition, transform=val_aug, img_transform=[], normalization=args.normalization,
+        add_depth=False, is_labeled=True, data_relative_path=args.data_relative_path
+    )
+    indices = np.random.RandomState(0).randint(0, len(dataset), args.iterations)
+
+    legacy_us = time_per_item(lambda idx: legacy_item_lookup(dataset, idx), indices)
+    array_us = time_per_item(lambda idx: array_item_lookup(dataset, idx), indices)
+    item_us = time_per_item(dataset.__getitem__, indices[:min(len(indices), 500)])
+
+    print(f"\nDataset rows: {len(dataset)}")
+    print(f"Legacy DataFrame lookup: {legacy_us:10.1f} us/item")
+    print(f"Precomputed array lookup: {array_us:9.1f} us/item ({legacy_us / array_us:.1f}x faster)")
+    print(f"Full __getitem__ (for reference): {item_us:.1f} us/item")
+
+
+def benchmark_hist_matching(args):
+    _, _, val_aug = data_augmentation_selector("none", args.img_size, args.img_size, "padd", verbose=False)
+    dataset = MMs2DDataset(
+        partition=args.partition, transform=val_aug, img_transform=[], normalization=args.normalization,
+        add_depth=False, is_labeled=True, data_relative_path=args.data_relative_path, rand_histogram_matching=True
+    )
+    # Reference slices as sampled before precomputed tables: any slice of the partition from other vendor
+    hist_match_df = pd.read_csv(os.path.join(dataset.base_dir, "slices_info.csv"))
+    hist_match_df = hist_match_df.loc[hist_match_df["Partition"] == args.partition]
+    ref_paths, _ = mms_slice_paths(dataset.base_dir, hist_match_df, mms_labeled_infos(hist_match_df))
+    ref_vendors = hist_match_df["Vendor"].values
+
+    indices = np.random.RandomState(0).randint(0, len(dataset), args.iterations)
+    images = [np.load(dataset.img_paths[idx]) for idx in indices]
+
+    def legacy_matching(indx):
+        reference = np.load(np.random.choice(ref_paths[ref_vendors != dataset.vendors[indices[indx]]]))
+        return match_histograms(images[indx], reference)
+
+    def table_matching(indx):
+        candidates = dataset.hist_candidates[dataset.vendors[indices[indx]]]
+        return data_utils.match_histogram_table(images[indx], dataset.hist_tables[np.random.choice(candidates)])
+
+    positions = np.arange(len(indices))
+    legacy_us = time_per_item(legacy_matching, positions)
+    table_us = time_per_item(table_matching, positions)
+
+    errors = []
+    for indx in positions[:min(len(positions), 200)]:
+        reference_indx = np.random.choice(dataset.hist_candidates[dataset.vendors[indices[indx]]])
+        exact = match_histograms(images[indx], np.load(ref_paths[reference_indx]))
+        approx = data_utils.match_histogram_table(images[indx], dataset.hist_tables[reference_indx])
+        errors.append(np.abs(exact - approx).mean() / (np.abs(exact).mean() + 1e-10))
+
+    print(f"\nReference slices: {len(dataset.hist_tables)}")
+    print(f"Legacy load + match_histograms: {1e6 / legacy_us:10.1f} samples/s")
+    print(f"Precomputed reference tables: {1e6 / table_us:12.1f} samples/s ({legacy_us / table_us:.1f}x faster)")
+    print(f"Mean relative difference against exact matching: {np.mean(errors):.4f}")
+
+
+def benchmark_sample_size(args):
+    """
+    Per sample memory and pickling traffic (what a DataLoader worker sends to the main process) of full samples
+    against lightweight training samples
+    """
+    train_aug, train_aug_img, _ = data_augmentation_selector(
+        "none", args.img_size, args.img_size, "padd", verbose=False
+    )
+    indices = np.random.RandomState(0).randint(0, 10 ** 9, args.iterations)
+    for lightweight in [False, True]:
+        dataset = MMs2DDataset(
+            partition=args.partition, transform=train_aug, img_transform=train_aug_img,
+            normalization=args.normalization, add_depth=True, is_labeled=True,
+            data_relative_path=args.data_relative_path, lightweight=lightweight
+        )
+        items = indices % len(dataset)
+
+        tracemalloc.start()
+        samples = [dataset[idx] for idx in items[:args.batch_size]]
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        batch = dataset.custom_collate(samples)
+        batch_bytes = len(pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL))
+        sample_bytes = np.mean([len(pickle.dumps(dataset[idx], protocol=pickle.HIGHEST_PROTOCOL)) for idx in items])
+        pickle_us = time_per_item(lambda idx: pickle.dumps(dataset[idx], protocol=pickle.HIGHEST_PROTOCOL), items)
+        item_us = time_per_item(dataset.__getitem__, items)
+
+        print(f"\n{'Lightweight' if lightweight else 'Full'} samples, keys: {list(samples[0].keys())}")
+        print(f"Pickled sample: {sample_bytes / 1024:.1f} KiB, pickled batch of {args.batch_size}: "
+              f"{batch_bytes / 1024 ** 2:.2f} MiB")
+        print(f"Peak traced memory building a batch: {peak_bytes / 1024 ** 2:.2f} MiB")
+        print(f"__getitem__: {item_us:.1f} us/item, __getitem__ + pickle: {pickle_us:.1f} us/item")
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.benchmark == "item_lookup":
+        benchmark_item_lookup(arguments)
+    elif arguments.benchmark == "hist_matching":
+        benchmark_hist_matching(arguments)
+    elif arguments.benchmark == "sample_size":
+        benchmark_sample_size(arguments)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Usage: python tools/check_criterions.py --num_classes 4 --img_size 64
+
+Build every get_criterion type and run calculate_loss (forward and backward) on random predictions and masks,
+multiclass and (for criterions without multiclass subcriterions) single class. Fails on the first error.
+"""
+import argparse
+import os
+import sys
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # python tools/<script>.py
+from utils.distributed import get_device
+from utils.neural import AVAILABLE_CRITERIONS, calculate_loss, get_criterion
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check every training criterion')
+    parser.add_argument('--num_classes', type=int, default=4, help='Multiclass case classes (with background)')
+    parser.add_argument('--batch_size', type=int, default=2, help='Batch size')
+    parser.add_argument('--img_size', type=int, default=64, help='Predictions squared size')
+    return parser.parse_args()
+
+
+def check_criterion(criterion_type, num_classes, batch_size, img_size, device):
+    """
+    :return: (float) Loss value. Raises if the criterion can not be built or evaluated
+    """
+    # Weights do not matter here: one per subcriterion (get_criterion does not check their number)
+    criterion, weights_criterion, multiclass_criterion = get_criterion(criterion_type, ",".join(["1"] * 6))
+    for crit in criterion:
+        if not callable(crit):
+            assert False, f"Criterion '{criterion_type}' built a non callable subcriterion: {criterion}"
+
+    y_pred = torch.randn(batch_size, num_classes, img_size, img_size, device=device, requires_grad=True)
+    y_true = torch.randint(0, num_classes if num_classes > 1 else 2, (batch_size, 1, img_size, img_size))
+    y_true = y_true.float().to(device)
+    loss = calculate_loss(y_true, y_pred, criterion, weights_criterion, multiclass_criterion, num_classes)
+    loss.backward()
+    if not torch.isfinite(loss):
+        assert False, f"Criterion '{criterion_type}' gives a non finite loss: {loss.item()}"
+    return loss.item()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    device = get_device()
+    print(f"Device: {device.type}")
+    for criterion_name in AVAILABLE_CRITERIONS:
+        _, _, multiclass = get_criterion(criterion_name, ",".join(["1"] * 6))
+        cases = [arguments.num_classes] + ([1] if not any(multiclass) else [])
+        for classes in cases:
+            value = check_criterion(criterion_name, classes, arguments.batch_size, arguments.img_size, device)
+            print(f"{criterion_name:<24} {classes} classes: loss {value:.4f}")
+    print("All criterions ok")
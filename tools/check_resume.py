@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Usage: python tools/check_resume.py --work_dir checks/resume --epochs 4 --coral_vendors A B -- <train.py arguments>
+
+Train 'epochs' epochs at once and in two halves (the second one with --resume), plain and with coral when
+'--coral_vendors' is given, and check that both runs end with the same last model weights.
+Do not pass '--epochs', '--output_dir' or '--resume' among the train.py arguments.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # python tools/<script>.py
+from utils.checkpoints import load_checkpoint
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "train.py")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check that resumed trainings replay uninterrupted ones')
+    parser.add_argument('--work_dir', type=str, default="checks/resume", help='Where the runs are stored')
+    parser.add_argument('--epochs', type=int, default=4, help='Total epochs (even, resumed at the half)')
+    parser.add_argument('--coral_vendors', nargs='+', default=None, help='Also check coral runs with these vendors')
+    parser.add_argument('train_args', nargs=argparse.REMAINDER, help='train.py arguments (after --)')
+    return parser.parse_args()
+
+
+def run_train(train_args, epochs, output_dir):
+    command = [sys.executable, TRAIN_SCRIPT] + train_args + ["--epochs", str(epochs), "--output_dir", output_dir]
+    with open(os.path.join(output_dir, f"train_{epochs}epochs.log"), "a") as log:
+        subprocess.run(command + ["--resume"], stdout=log, stderr=subprocess.STDOUT, check=True)
+
+
+def last_weights(output_dir):
+    last_model = [name for name in os.listdir(output_dir) if name.startswith("model_") and name.endswith("_last.pt")]
+    if len(last_model) != 1:
+        assert False, f"Expected one last model at '{output_dir}', found: {last_model}"
+    return load_checkpoint(os.path.join(output_dir, last_model[0]), map_location="cpu")
+
+
+def check_resume(train_args, epochs, work_dir, name):
+    """
+    :return: (bool) Whether the run resumed at epochs // 2 ends with the same weights as the uninterrupted one
+    """
+    full_dir, resumed_dir = os.path.join(work_dir, f"{name}_full"), os.path.join(work_dir, f"{name}_resumed")
+    for output_dir in [full_dir, resumed_dir]:
+        if os.path.exists(output_dir) and len(os.listdir(output_dir)) > 0:
+            assert False, f"Output directory '{output_dir}' is not empty, remove it"
+        os.makedirs(output_dir, exist_ok=True)
+
+    run_train(train_args, epochs, full_dir)
+    run_train(train_args, epochs // 2, resumed_dir)
+    run_train(train_args, epochs, resumed_dir)
+
+    full_weights, resumed_weights = last_weights(full_dir), last_weights(resumed_dir)
+    return full_weights.keys() == resumed_weights.keys() and all(
+        torch.equal(full_weights[key], resumed_weights[key]) for key in full_weights
+    )
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.epochs < 2 or arguments.epochs % 2 != 0:
+        assert False, "Use an even number of epochs, at least 2"
+    base_args = [arg for arg in arguments.train_args if arg != "--"]
+    cases = [("plain", base_args)]
+    if arguments.coral_vendors is not None:
+        cases.append(("coral", base_args + ["--coral", "--coral_vendors"] + arguments.coral_vendors))
+
+    failed = []
+    for case_name, case_args in cases:
+        same = check_resume(case_args, arguments.epochs, arguments.work_dir, case_name)
+        print(f"{case_name:<8} {arguments.epochs // 2}+{arguments.epochs // 2} epochs resumed: "
+              f"{'same weights' if same else 'DIFFERENT weights'}")
+        if not same:
+            failed.append(case_name)
+    if len(failed) > 0:
+        assert False, f"Resumed trainings differ from uninterrupted ones: {failed}"
+    print("Resume ok")
@@ -2,47 +2,44 @@
 # coding: utf-8
 """
 Usage: python tools/nifti2slices.py --data_path data/MyDataset/NiftiParentFolder
+
+Volumes are converted in parallel (--workers) and every finished volume is appended to a manifest
+(data_path/nifti2slices_manifest.txt), so an interrupted run resumes where it stopped. Use --overwrite to redo all.
 """
 import argparse
 import numpy as np
 import os
 import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
-
-def load_nii(img_path):
-    """
-    Function to load a 'nii' or 'nii.gz' file, The function returns
-    everyting needed to save another 'nii' or 'nii.gz'
-    in the same dimensional space, i.e. the affine matrix and the header
-    :param img_path: (string) Path of the 'nii' or 'nii.gz' image file name
-    :return: Three element, the first is a numpy array of the image values (height, width, slices, phases),
-             ## (No) the second is the affine transformation of the image, and the
-             ## (No) last one is the header of the image.
-    """
-    nimg = nib.load(img_path)
-    return np.asanyarray(nimg.dataobj), nimg.affine, nimg.header
+MANIFEST_NAME = "nifti2slices_manifest.txt"
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Convert your nifti volume dataset (3D) to numpy slices (2D)!')
     parser.add_argument('--data_path', type=str, required=True, help='Parent folder with nifti files.')
-    aux = parser.parse_args()
-    arguments = aux.data_path
-    return arguments
-
-
-data_path = parse_args()
-print("Running...")
-all_nifti_paths = []
-for subdir, dirs, files in os.walk(data_path):
-    for file in files:
-        entry = os.path.join(subdir, file)
-        if entry.endswith((".nii", ".nii.gz")):
-            all_nifti_paths.append(entry)
-
-for nifti_path in tqdm(all_nifti_paths, desc="Remaining Files"):
-    nifti_volume = load_nii(nifti_path)[0]
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Parallel conversion processes.')
+    parser.add_argument(
+        '--dtype', type=str, default="",
+        help="Slices data type. Empty keeps loaded values, 'source' the nifti stored type, or a numpy type name."
+    )
+    parser.add_argument('--overwrite', action='store_true', help='Convert again volumes listed in the manifest.')
+    return parser.parse_args()
+
+
+def convert_volume(nifti_path, dtype=""):
+    """
+    Decompress the volume once and save all its slices (and phases) as .npy files
+    :return: (string) Converted nifti path
+    """
+    nimg = nib.load(nifti_path)
+    nifti_volume = np.asanyarray(nimg.dataobj)
+    if dtype == "source":
+        nifti_volume = nifti_volume.astype(nimg.get_data_dtype(), copy=False)
+    elif dtype != "":
+        nifti_volume = nifti_volume.astype(dtype, copy=False)
+
     dims = nifti_volume.shape  # h, w, slices, *phases*
     extension_length = 4 if nifti_path.endswith(".nii") else 7
     if len(dims) == 3:  # not phases, volume for specific phase
@@ -56,3 +53,37 @@ for nifti_path in tqdm(all_nifti_paths, desc="Remaining Files"):
                 current_slice = nifti_volume[..., s, p]
                 current_slice_path = f"{nifti_path[:-extension_length]}_slice{s}_phase{p}.npy"
                 np.save(current_slice_path, current_slice)
+    return nifti_path
+
+
+def read_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return set()
+    with open(manifest_path) as f:
+        return set(line.strip() for line in f if line.strip() != "")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("Running...")
+    all_nifti_paths = []
+    for subdir, dirs, files in os.walk(args.data_path):
+        for file in files:
+            entry = os.path.join(subdir, file)
+            if entry.endswith((".nii", ".nii.gz")):
+                all_nifti_paths.append(entry)
+
+    manifest_path = os.path.join(args.data_path, MANIFEST_NAME)
+    if args.overwrite and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    done = read_manifest(manifest_path)
+    pending = [path for path in sorted(all_nifti_paths) if os.path.relpath(path, args.data_path) not in done]
+    print(f"{len(all_nifti_paths) - len(pending)} volumes already converted, {len(pending)} remaining")
+
+    with ProcessPoolExecutor(max_workers=max(args.workers, 1)) as executor, open(manifest_path, "a") as manifest:
+        futures = [executor.submit(convert_volume, path, args.dtype) for path in pending]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Remaining Files"):
+            manifest.write(f"{os.path.relpath(future.result(), args.data_path)}\n")
+            manifest.flush()
+
+    print("Done!")
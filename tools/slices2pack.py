@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Usage: python tools/slices2pack.py --data_path data/MMs
+Requires slices generated previously with: python tools/nifti2slices.py --data_path data/MMs
+"""
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack MMs numpy slices (2D) into contiguous memory-mapped files!')
+    parser.add_argument('--data_path', type=str, default="data/MMs", help='MMs folder with slices_info.csv.')
+    parser.add_argument('--out_dir', type=str, default="", help='Output folder. Default: data_path/packed')
+    parser.add_argument('--img_dtype', type=str, default="float32", help='Data type used to store images.')
+    parser.add_argument('--mask_dtype', type=str, default="uint8", help='Data type used to store masks.')
+    return parser.parse_args()
+
+
+def find_labeled_info(base_dir, partition, external_code):
+    """
+    Training patients are stored under 'Labeled' or 'Unlabeled' folders, others directly under its partition
+    """
+    if partition != "Training":
+        return ""
+    for labeled_info in ["Labeled", "Unlabeled"]:
+        if os.path.isdir(os.path.join(base_dir, partition, labeled_info, external_code)):
+            return labeled_info
+    assert False, f"Patient '{external_code}' not found at '{os.path.join(base_dir, partition)}'"
+
+
+args = parse_args()
+out_dir = args.out_dir if args.out_dir != "" else os.path.join(args.data_path, "packed")
+os.makedirs(out_dir, exist_ok=True)
+
+data = pd.read_csv(os.path.join(args.data_path, "slices_info.csv"))
+labeled_info_cache = {}
+
+print("Running...")
+img_offsets, mask_offsets, heights, widths, labeled_infos = [], [], [], [], []
+img_offset, mask_offset = 0, 0
+with open(os.path.join(out_dir, "images.dat"), "wb") as img_file, \
+        open(os.path.join(out_dir, "masks.dat"), "wb") as mask_file:
+    for _, row in tqdm(data.iterrows(), total=len(data), desc="Remaining Slices"):
+        external_code, partition = row["External code"], row["Partition"]
+        if external_code not in labeled_info_cache:
+            labeled_info_cache[external_code] = find_labeled_info(args.data_path, partition, external_code)
+        labeled_info = labeled_info_cache[external_code]
+        slice_dir = os.path.join(args.data_path, partition, labeled_info, external_code)
+
+        image = np.load(
+            os.path.join(slice_dir, f"{external_code}_sa_slice{row['Slice']}_phase{row['Phase']}.npy")
+        ).astype(args.img_dtype)
+        img_file.write(np.ascontiguousarray(image).tobytes())
+        img_offsets.append(img_offset)
+        img_offset += image.size
+
+        mask_path = os.path.join(slice_dir, f"{external_code}_sa_gt_slice{row['Slice']}_phase{row['Phase']}.npy")
+        if os.path.exists(mask_path):
+            mask = np.load(mask_path).astype(args.mask_dtype)
+            mask_file.write(np.ascontiguousarray(mask).tobytes())
+            mask_offsets.append(mask_offset)
+            mask_offset += mask.size
+        else:  # Unlabeled slices have not mask
+            mask_offsets.append(-1)
+
+        heights.append(image.shape[0])
+        widths.append(image.shape[1])
+        labeled_infos.append(labeled_info)
+
+data["Labeled info"] = labeled_infos
+data["Image offset"] = img_offsets
+data["Mask offset"] = mask_offsets
+data["Height"] = heights
+data["Width"] = widths
+data.to_csv(os.path.join(out_dir, "index.csv"), index=False)
+shutil.copy(os.path.join(args.data_path, "slices_info.csv"), os.path.join(out_dir, "slices_info.csv"))
+
+with open(os.path.join(out_dir, "pack_info.json"), "w") as f:
+    json.dump({
+        "img_dtype": args.img_dtype, "mask_dtype": args.mask_dtype,
+        "img_values": img_offset, "mask_values": mask_offset, "num_slices": len(data)
+    }, f, indent=2)
+
+print("Done!")
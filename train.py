@@ -5,11 +5,15 @@
 from models import model_selector
 from tools.metrics_mnms import compute_metrics_on_directories
 from utils.arguments import *
-from utils.data_augmentation import data_augmentation_selector
-from utils.datasets import dataset_selector, coral_dataset_selector
+from utils.checkpoints import load_checkpoint
+from utils.data_augmentation import data_augmentation_selector, batch_augmentation_selector
+from utils.datasets import dataset_selector, coral_dataset_selector, loader_throughput, set_sampler_epoch
+from utils.distributed import (
+    cleanup_distributed, distributed_model, gather_objects, get_rank, is_main_process, local_model
+)
 from models.gan import define_Gen
 from utils.gans import set_grad
-from utils.logging import log_epoch, build_header, get_name
+from utils.logging import log_epoch, build_header, get_name, wandb_save_checkpoint
 from utils.mnms import test_prediction
 from utils.neural import *
 import os
@@ -17,7 +21,7 @@ import os
 os.environ["WANDB_SILENT"] = "true"
 import wandb
 
-set_seed(args.seed)
+set_seed(args.seed + get_rank())  # Distributed launches: different augmentations in each process
 
 if args.coral and args.coral_vendors is None:
     assert False, "When coral selected specify which vendors use with '--coral_vendors'"
@@ -25,16 +29,20 @@ if args.coral and args.coral_vendors is None:
 train_aug, train_aug_img, val_aug = data_augmentation_selector(
     args.data_augmentation, args.img_size, args.crop_size, args.mask_reshape_method
 )
+batch_transform = batch_augmentation_selector(args.data_augmentation, add_depth=args.add_depth)
 train_loader, val_loader, num_classes, class_to_cat, include_background = dataset_selector(
-    train_aug, train_aug_img, val_aug, args, sampler="random_sampler",
+    train_aug, train_aug_img, val_aug, args, sampler=args.data_sampling,
 )
 train_coral_loader = coral_dataset_selector(train_aug, train_aug_img, "Training", args) if args.coral else None
 val_coral_loader = coral_dataset_selector(val_aug, [], "Validation", args) if args.coral else None
 print(f"Number of classes: {num_classes}")
+if args.throughput_batches > 0:
+    loader_throughput(train_loader, "Train", args.throughput_batches)
 
 model = model_selector(
     args.problem_type, args.model_name, num_classes,
-    in_channels=3 if args.add_depth else 1, devices=args.gpu, checkpoint=args.model_checkpoint
+    in_channels=3 if args.add_depth else 1, devices=args.gpu, checkpoint=args.model_checkpoint,
+    compile_mode=args.compile_mode, compile_cache=args.compile_cache
 )
 swa_model = None
 
@@ -42,9 +50,11 @@ generator = None
 if args.gen_checkpoint != "":
     generator = define_Gen(
         input_nc=3 if args.add_depth else 1, output_nc=3 if args.add_depth else 1, ngf=args.ngf, netG=args.gen_net,
-        norm=args.norm_layer, use_dropout=not args.no_dropout, gpu_ids=args.gpu, checkpoint=args.gen_checkpoint
+        norm=args.norm_layer, use_dropout=not args.no_dropout, gpu_ids=args.gpu, checkpoint=args.gen_checkpoint,
+        compile_mode=args.compile_mode, compile_cache=args.compile_cache
     )
     set_grad([generator], False)
+    generator = local_model(generator)  # Frozen: no gradients to synchronize between distributed processes
 
 criterion, weights_criterion, multiclass_criterion = get_criterion(args.criterion, args.weights_criterion)
 optimizer = get_optimizer(args.optimizer, model, lr=args.learning_rate)
@@ -55,36 +65,72 @@ scheduler = get_scheduler(
 )
 
 swa_scheduler = get_scheduler("swa", optimizer, max_lr=args.swa_lr) if args.swa_start != -1 else None
+mixed_precision = MixedPrecision(args.amp)
+checkpoint_writer = CheckpointWriter(
+    max_pending=args.checkpoint_queue, content_addressed=args.checkpoint_store == "content",
+    half_precision=args.checkpoint_half, compress=args.checkpoint_compress
+)
 
 train_metrics = MetricsAccumulator(
     args.problem_type, args.metrics, num_classes, average="mean",
-    include_background=include_background, mask_reshape_method=args.mask_reshape_method
+    include_background=include_background, mask_reshape_method=args.mask_reshape_method,
+    surface_workers=args.surface_workers
 )
 val_metrics = MetricsAccumulator(
     args.problem_type, args.metrics, num_classes, average="mean",
-    include_background=include_background, mask_reshape_method=args.mask_reshape_method
+    include_background=include_background, mask_reshape_method=args.mask_reshape_method,
+    surface_workers=args.surface_workers
 )
 
 full_criterion = [args.criterion]
 full_criterion += ["coral"] if args.coral else ""
 
-wandb.init(project="MnMs Segmentation", name=get_name(args.unique_id), config=args)
+start_epoch, wandb_id = 0, None
+resume_path = os.path.join(args.output_dir, "checkpoint.pt")
+if args.resume and os.path.exists(resume_path):
+    print(f"\nResuming training from {resume_path}...\n")
+    resume_state = load_checkpoint(resume_path, map_location="cpu", weights_only=False)
+    model.load_state_dict(resume_state["model"])
+    optimizer.load_state_dict(resume_state["optimizer"])
+    scheduler.load_state_dict(resume_state["scheduler"])
+    if resume_state["swa_model"] is not None:
+        swa_model = torch.optim.swa_utils.AveragedModel(local_model(model))
+        swa_model.load_state_dict(resume_state["swa_model"])
+        swa_scheduler.load_state_dict(resume_state["swa_scheduler"])
+    mixed_precision.load_state_dict(resume_state["mixed_precision"])
+    train_metrics.load_state_dict(resume_state["train_metrics"])
+    val_metrics.load_state_dict(resume_state["val_metrics"])
+    set_rng_state(resume_state["rng"][get_rank() % len(resume_state["rng"])])  # One state per process
+    start_epoch, wandb_id = resume_state["epoch"], resume_state["wandb_id"]
+
+wandb.init(
+    project="MnMs Segmentation", name=get_name(args.unique_id), config=args, id=wandb_id, resume="allow",
+    mode=None if is_main_process() else "disabled"  # Distributed launches: main process logs
+)
 
 header, defrosted = build_header(class_to_cat, full_criterion, args.metrics, display=True), False
-for current_epoch in range(args.epochs):
+for current_epoch in range(start_epoch, args.epochs):
 
-    defrosted = check_defrost(model, defrosted, current_epoch, args.defrost_epoch)
+    was_defrosted, defrosted = defrosted, check_defrost(model, defrosted, current_epoch, args.defrost_epoch)
+    if args.distributed and defrosted and not was_defrosted:
+        # DistributedDataParallel only synchronizes the gradients of parameters trainable when wrapped
+        model = distributed_model(model.module, find_unused_parameters=True)
+    set_sampler_epoch(train_loader, current_epoch)
+    if args.coral:
+        for coral_stream in train_coral_loader:
+            coral_stream.set_epoch(current_epoch)
 
     train_metrics = train_step(
         train_loader, model, criterion, weights_criterion, multiclass_criterion, optimizer, train_metrics,
         args.coral, train_coral_loader, args.coral_weight, args.vol_task_weight, num_classes,
-        generator=generator
+        generator=generator, batch_transform=batch_transform, mixed_precision=mixed_precision,
+        debug_losses=args.debug_losses
     )
 
     val_metrics = val_step(
         val_loader, model, val_metrics, criterion, weights_criterion, multiclass_criterion, num_classes,
         generated_overlays=args.generated_overlays, overlays_path=f"{args.output_dir}/overlays/epoch_{current_epoch}",
-        generator=generator
+        generator=generator, mixed_precision=mixed_precision, debug_losses=args.debug_losses
     )
 
     # ToDo
@@ -97,25 +143,46 @@ for current_epoch in range(args.epochs):
     for metric_name in args.metrics:
         logging[f"Mean {metric_name}"] = train_metrics.mean_value(metric_name)
 
-    val_metrics.save_progress(args.output_dir, identifier="validation_metrics")
-    train_metrics.save_progress(args.output_dir, identifier="train_metrics")
+    if is_main_process():
+        val_metrics.save_progress(args.output_dir, identifier="validation_metrics")
+        train_metrics.save_progress(args.output_dir, identifier="train_metrics")
 
-    checkpoint_path = ""
     if args.swa_start != -1 and (current_epoch + 1) >= args.swa_start:
         if not swa_model:
             print("\n------------------------------- START SWA -------------------------------\n")
-            swa_model = torch.optim.swa_utils.AveragedModel(model)
+            swa_model = torch.optim.swa_utils.AveragedModel(local_model(model))
         else:
             swa_model.update_parameters(model)
             swa_scheduler.step()
     else:
         # Only save checkpoints when not applying SWA -> only want save last model using SWA
-        checkpoint_path = create_checkpoint(val_metrics, model, args.model_name, args.output_dir)
+        if is_main_process():
+            create_checkpoint(
+                val_metrics, model, args.model_name, args.output_dir, checkpoint_writer,
+                on_written=lambda paths: wandb_save_checkpoint(paths[-1], args.output_dir)  # Last model checkpoint
+            )
         scheduler_step(optimizer, scheduler, val_metrics, args)
 
+    rng_states = gather_objects(get_rng_state()) if args.resume else None  # Every process, main one saves
+    if args.resume and is_main_process():  # Everything needed to continue from next epoch
+        checkpoint_writer.save(
+            {
+                'epoch': current_epoch + 1,
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'swa_model': swa_model.state_dict() if swa_model is not None else None,
+                'swa_scheduler': swa_scheduler.state_dict() if swa_scheduler is not None else None,
+                'mixed_precision': mixed_precision.state_dict(),
+                'train_metrics': train_metrics.state_dict(),
+                'val_metrics': val_metrics.state_dict(),
+                'rng': rng_states,
+                'wandb_id': wandb.run.id
+            },
+            resume_path, lossless=True
+        )
+
     wandb.log(logging)
-    if checkpoint_path != "":
-        wandb.save(checkpoint_path)
 
 print("\nBest Validation Results:")
 val_metrics.report_best()
@@ -123,11 +190,15 @@ val_metrics.report_best()
 if swa_model is not None:
     checkpoint_path = finish_swa(
         swa_model, train_loader, val_loader, criterion, weights_criterion, multiclass_criterion,
-        num_classes, include_background, args
+        num_classes, include_background, args, checkpoint_writer
     )
-    wandb.save(checkpoint_path)
+    checkpoint_writer.flush()
+    if is_main_process():
+        wandb_save_checkpoint(checkpoint_path, args.output_dir)
+
+checkpoint_writer.close()
 
-if args.evaluate:
+if args.evaluate and is_main_process():
 
     remove_predictions = True
 
@@ -158,3 +229,5 @@ if args.evaluate:
         wandb.save(os.path.join(path_pred, "*.csv"))
 
 wandb.finish()
+
+cleanup_distributed()
@@ -1,6 +1,7 @@
 import argparse
 import json
 import os
+from utils.distributed import init_distributed, is_main_process, local_devices
 
 
 class SmartFormatter(argparse.HelpFormatter):
@@ -14,7 +15,14 @@ class SmartFormatter(argparse.HelpFormatter):
 
 parser = argparse.ArgumentParser(description='MMS 2020 Challenge - Training', formatter_class=SmartFormatter)
 
-parser.add_argument("--gpu", type=str, default="0,1")
+parser.add_argument(
+    "--gpu", type=str, default="0,1",
+    help='Visible GPUs (-1 for CPU). DataParallel over them, or one per process when launched with torchrun'
+)
+parser.add_argument(
+    '--dist_backend', type=str, default="", choices=['', 'nccl', 'gloo'],
+    help='Process group backend of torchrun launches. Default nccl with GPUs, gloo on CPU'
+)
 parser.add_argument("--seed", type=int, default=2020)
 parser.add_argument('--output_dir', type=str, help='Where progress/checkpoints will be saved')
 
@@ -29,6 +37,30 @@ parser.add_argument('--defrost_epoch', type=int, default=-1, help='Number of epo
 parser.add_argument('--batch_size', type=int, default=64, help='Batch Size for training')
 parser.add_argument('--data_augmentation', type=str, help='Apply data augmentations at train time')
 parser.add_argument('--rand_histogram_matching', action='store_true', help='Apply random histogram matching')
+parser.add_argument(
+    '--packed_data', action='store_true',
+    help='Read MMs slices from packed memory-mapped store (python tools/slices2pack.py)'
+)
+parser.add_argument('--num_workers', type=int, default=0, help='DataLoader worker processes (0: main process)')
+parser.add_argument('--persistent_workers', action='store_true', help='Keep DataLoader workers alive between epochs')
+parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches loaded in advance by each worker')
+parser.add_argument(
+    '--throughput_batches', type=int, default=0,
+    help='Batches used to report train loader throughput before training (0 disables). Diagnostic: it draws from '
+         'the random generators and samplers, so runs do not reproduce the ones without it'
+)
+parser.add_argument(
+    '--val_cache', type=str, default="", choices=["", "ram", "memmap"],
+    help='Preprocess validation data once and serve it from RAM or a memory-mapped cache'
+)
+parser.add_argument(
+    '--data_sampling', type=str, default="random_sampler", help='How to sample data points',
+    choices=['random_sampler', 'equilibrated_sampler', 'stratified_sampler']
+)
+parser.add_argument(
+    '--stratified_cycle', action='store_true',
+    help='Stratified sampler: reuse exhausted strata (oversampling the small ones) instead of ending the epoch'
+)
 parser.add_argument('--img_size', type=int, default=224, help='Final img squared size')
 parser.add_argument('--crop_size', type=int, default=224, help='Center crop squared size')
 
@@ -37,9 +69,20 @@ parser.add_argument('--add_depth', action='store_true', help='If apply image tra
 
 parser.add_argument('--model_name', type=str, default='simple_unet', help='Model name for training')
 parser.add_argument('--num_classes', type=int, default=1, help='Model output neurons')
+parser.add_argument(
+    '--amp', action='store_true', help='Automatic mixed precision (fp16 + loss scaling on CUDA, bf16 on CPU)'
+)
+parser.add_argument(
+    '--compile_mode', type=str, default="none", choices=['none', 'compile', 'torchscript'],
+    help='Compiled models execution: torch.compile (TorchScript on older torch) or TorchScript'
+)
+parser.add_argument('--compile_cache', type=str, default="", help='Directory to keep compiled artefacts between runs')
 
 # Accept a list of string metrics: train.py --metrics iou dice hauss
 parser.add_argument('--metrics', '--names-list', nargs='+', default=[])
+parser.add_argument(
+    '--surface_workers', type=int, default=0, help='Threads computing hausdorff/assd of each batch (0 sequentially)'
+)
 
 parser.add_argument('--generated_overlays', type=int, default=-1, help='Number of generate masks overlays')
 
@@ -55,12 +98,35 @@ parser.add_argument(
 
 parser.add_argument('--criterion', type=str, default='bce', help='Criterion for training')
 parser.add_argument('--weights_criterion', type=str, default='default', help='Weights for each subcriterion')
+parser.add_argument(
+    '--debug_losses', action='store_true', help='Materialise losses every step (.item()) keeping per step values'
+)
 
 parser.add_argument('--coral', action='store_true', help='Whether apply coral loss or not')
 parser.add_argument('--coral_vendors', '--argc', nargs='+', type=str, help='Which vendors are used for coral loss')
 parser.add_argument('--coral_weight', type=float, default=0.01, help='Coral loss weight')
 parser.add_argument('--vol_task_weight', type=float, default=0.7, help='Volume task loss (used when coral)')
+parser.add_argument(
+    '--volume_cache_mb', type=float, default=1024, help='Memory for decoded coral volumes cache (per vendor loader)'
+)
+parser.add_argument(
+    '--coral_prefetch', type=int, default=2, help='Ready coral volumes kept per vendor (with --num_workers > 0)'
+)
 
+parser.add_argument(
+    '--checkpoint_queue', type=int, default=2,
+    help='Checkpoint snapshots kept in host memory while written in background (0 writes synchronously)'
+)
+parser.add_argument(
+    '--checkpoint_store', type=str, default="files", choices=['files', 'content'],
+    help="'content' writes each checkpoint once under its content hash and best/last names as references"
+)
+parser.add_argument('--checkpoint_half', action='store_true', help='Store model checkpoints weights as fp16')
+parser.add_argument('--checkpoint_compress', action='store_true', help='gzip compressed checkpoints')
+parser.add_argument(
+    '--resume', action='store_true',
+    help='Save the full training state each epoch (output_dir/checkpoint.pt) and resume from it when present'
+)
 parser.add_argument('--model_checkpoint', type=str, default="", help='If there is a model checkpoint to load')
 parser.add_argument('--swa_checkpoint', action='store_true', help='If we load the model checkpoint from SWA model')
 
@@ -95,6 +161,7 @@ parser.add_argument('--evaluate', action='store_true', help='Whether evaluate us
 args = parser.parse_args()
 
 os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+args.distributed = init_distributed(args.dist_backend)
 
 if args.output_dir == "":
     assert False, "Please set an output directory"
@@ -107,12 +174,15 @@ if not os.path.exists(args.output_dir):
     os.makedirs(args.output_dir, exist_ok=True)
 
 # https://stackoverflow.com/a/55114771
-with open(os.path.join(args.output_dir, 'commandline_args.txt'), 'w') as f:
-    json.dump(args.__dict__, f, indent=2)
+if is_main_process():
+    with open(os.path.join(args.output_dir, 'commandline_args.txt'), 'w') as f:
+        json.dump(args.__dict__, f, indent=2)
 
 str_ids = args.gpu.split(',')
 args.gpu = []
 for str_id in str_ids:
     gpu_id = int(str_id)
     if gpu_id >= 0:
-        args.gpu.append(gpu_id)
+        args.gpu.append(len(args.gpu))  # CUDA_VISIBLE_DEVICES renumbers the selected GPUs from 0
+if args.distributed:
+    args.gpu = local_devices()  # GPU of the process local rank
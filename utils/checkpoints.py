@@ -0,0 +1,259 @@
+import atexit
+import copy
+import gzip
+import hashlib
+import json
+import os
+import queue
+import threading
+import torch
+
+CHECKPOINT_REF_KEY = "checkpoint_ref"  # Key of content addressed references (see CheckpointWriter)
+OBJECTS_DIR = "objects"
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def host_snapshot(state):
+    """
+    Copy of a (nested) state with every tensor cloned to host memory, so the training can keep updating
+    the original parameters / optimizer buffers while the copy is written
+    :param state: Tensor, dict, list or tuple (state_dict like structures)
+    """
+    return map_state(state, lambda storage: storage.to("cpu", copy=True), copy.deepcopy)
+
+
+def half_state(state):
+    """
+    Same state with fp32/fp64 tensors stored as fp16 (load_state_dict copies them back to the model dtype)
+    """
+    return map_state(
+        state, lambda storage: storage.half() if storage.dtype in (torch.float32, torch.float64) else storage,
+        lambda value: value
+    )
+
+
+def map_state(state, storage_fn, value_fn):
+    """
+    Apply storage_fn to the storage (as a flat tensor) of every tensor of a (nested) state and value_fn to the
+    remaining values. Each storage is mapped once and tensors are rebuilt as views of the result: tensors sharing
+    memory (e.g. modules registered twice) keep sharing it, torch.save writes them once. state_dict '_metadata'
+    (module versions) is kept
+    """
+    mapped_storages = {}
+
+    def map_value(value):
+        if torch.is_tensor(value):
+            key = (value.untyped_storage().data_ptr(), value.dtype, value.device)
+            if key not in mapped_storages:
+                storage = torch.empty(0, dtype=value.dtype, device=value.device).set_(value.untyped_storage())
+                mapped_storages[key] = storage_fn(storage)
+            return mapped_storages[key].as_strided(value.shape, value.stride(), value.storage_offset())
+        if isinstance(value, dict):
+            mapped = type(value)((key, map_value(item)) for key, item in value.items())
+            if hasattr(value, "_metadata"):
+                mapped._metadata = copy.deepcopy(value._metadata)
+            return mapped
+        if isinstance(value, (list, tuple)):
+            return type(value)(map_value(item) for item in value)
+        return value_fn(value)
+
+    return map_value(state)
+
+
+def state_digest(state):
+    """
+    sha256 of a (nested) state: structure, dtypes, shapes and tensor bytes
+    """
+    digest = hashlib.sha256()
+
+    def update(value):
+        if torch.is_tensor(value):
+            tensor = value.detach().cpu().contiguous()
+            digest.update(f"tensor{tensor.dtype}{tuple(tensor.shape)}".encode())
+            digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+        elif isinstance(value, dict):
+            digest.update(f"dict{len(value)}".encode())
+            for key, item in value.items():
+                digest.update(repr(key).encode())
+                update(item)
+        elif isinstance(value, (list, tuple)):
+            digest.update(f"list{len(value)}".encode())
+            for item in value:
+                update(item)
+        else:
+            digest.update(repr(value).encode())
+
+    update(state)
+    return digest.hexdigest()
+
+
+def atomic_save(state, path, compress=False):
+    """
+    torch.save to a temporary file renamed once complete: a crash while writing never leaves a truncated checkpoint
+    :param compress: (bool) Write the file gzip compressed (load_checkpoint detects it)
+    """
+    tmp_path = f"{path}.tmp"
+    if compress:
+        with gzip.open(tmp_path, "wb", compresslevel=6) as tmp_file:
+            torch.save(state, tmp_file)
+    else:
+        torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_file(path, map_location=None, **load_kwargs):
+    with open(path, "rb") as checkpoint_file:
+        compressed = checkpoint_file.read(2) == GZIP_MAGIC
+    if compressed:
+        with gzip.open(path, "rb") as checkpoint_file:
+            return torch.load(checkpoint_file, map_location=map_location, **load_kwargs)
+    return torch.load(path, map_location=map_location, **load_kwargs)
+
+
+def load_checkpoint(path, map_location=None, **load_kwargs):
+    """
+    Load a checkpoint saved by CheckpointWriter in any of its forms: plain or compressed torch files and
+    content addressed references (resolved to the object they point to)
+    :param load_kwargs: Extra torch.load arguments (e.g. weights_only=False for full training states)
+    """
+    state = load_file(path, map_location, **load_kwargs)
+    if isinstance(state, dict) and CHECKPOINT_REF_KEY in state:
+        state = load_file(os.path.join(os.path.dirname(path), state[CHECKPOINT_REF_KEY]), map_location, **load_kwargs)
+    return state
+
+
+def checkpoint_files(path):
+    """
+    Files that hold a checkpoint: the path itself and, for content addressed references, the referenced object
+    (e.g. to upload both to wandb keeping the relative location)
+    """
+    state = load_file(path) if os.path.getsize(path) < 4096 else None
+    if isinstance(state, dict) and CHECKPOINT_REF_KEY in state:
+        return [path, os.path.join(os.path.dirname(path), state[CHECKPOINT_REF_KEY])]
+    return [path]
+
+
+class CheckpointWriter:
+    """
+    Background checkpoint writer. save() snapshots the state to host memory and returns, a thread writes it
+    (atomically) to disk. At most 'max_pending' snapshots wait to be written: when full, save() blocks until
+    one finishes, which bounds the host memory used. Pending writes are flushed on close() / at exit.
+    With max_pending=0 checkpoints are written synchronously at save().
+
+    When content_addressed, each state is written once as 'objects/<sha256>.pt' (next to the requested paths) and
+    the requested paths are small references to it: the same weights saved as best_iou, best_dice and last
+    take the disk space of one file. Objects no longer referenced are removed. Use load_checkpoint() to read
+    any of the forms.
+    """
+
+    def __init__(self, max_pending=2, content_addressed=False, half_precision=False, compress=False):
+        """
+        :param max_pending: (int) Snapshots waiting to be written. 0 disables the background thread
+        :param content_addressed: (bool) Write states once under their content hash, paths as references
+        :param half_precision: (bool) Store floating point tensors as fp16 (except lossless saves)
+        :param compress: (bool) gzip compressed checkpoint files
+        """
+        self.max_pending = max_pending
+        self.content_addressed = content_addressed
+        self.half_precision = half_precision
+        self.compress = compress
+        self.error = None
+        self.worker = None
+        if max_pending > 0:
+            self.pending = queue.Queue(maxsize=max_pending)
+            self.worker = threading.Thread(target=self.write_pending, daemon=True)
+            self.worker.start()
+            atexit.register(self.close)
+
+    def write(self, state, paths, on_written, lossless):
+        if self.half_precision and not lossless:
+            state = half_state(state)
+        if self.content_addressed:
+            self.write_object(state, paths)
+        else:
+            for path in paths:
+                atomic_save(state, path, self.compress)
+        if on_written is not None:
+            on_written(paths)
+
+    def write_object(self, state, paths):
+        object_name = os.path.join(OBJECTS_DIR, f"{state_digest(state)}.pt")
+        for directory in sorted(set(os.path.dirname(path) for path in paths)):
+            object_path = os.path.join(directory, object_name)
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                atomic_save(state, object_path, self.compress)
+            references = [path for path in paths if os.path.dirname(path) == directory]
+            for path in references:
+                atomic_save({CHECKPOINT_REF_KEY: object_name}, path)
+            self.remove_unreferenced(directory, {os.path.basename(path): object_name for path in references})
+
+    @staticmethod
+    def remove_unreferenced(directory, new_references):
+        """
+        Keep 'objects/index.json' (reference name -> object) updated and delete objects without references
+        """
+        index_path = os.path.join(directory, OBJECTS_DIR, "index.json")
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+        index.update(new_references)
+        with open(f"{index_path}.tmp", "w") as index_file:
+            json.dump(index, index_file, indent=1)
+        os.replace(f"{index_path}.tmp", index_path)
+
+        referenced = set(os.path.basename(object_name) for object_name in index.values())
+        for object_file in os.listdir(os.path.join(directory, OBJECTS_DIR)):
+            if object_file.endswith(".pt") and object_file not in referenced:
+                os.remove(os.path.join(directory, OBJECTS_DIR, object_file))
+
+    def write_pending(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:  # After a failure the remaining snapshots are discarded
+                    self.write(*item)
+            except Exception as e:  # Raised to the training thread at next save() / flush()
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, paths, on_written=None, lossless=False):
+        """
+        :param state: State to save (state_dict or dict of state_dicts)
+        :param paths: (str or list) Destination path(s). The state is snapshotted once for all of them
+        :param on_written: Optional callable run with the paths list once they are written (from the writer thread)
+        :param lossless: (bool) Ignore half_precision for this state (e.g. optimizer states to resume training)
+        """
+        self.check_error()
+        paths = [paths] if isinstance(paths, str) else list(paths)
+        if self.worker is None:
+            self.write(state, paths, on_written, lossless)
+        else:
+            self.pending.put((host_snapshot(state), paths, on_written, lossless))
+
+    def flush(self):
+        """
+        Wait until every pending snapshot is written
+        """
+        if self.worker is not None:
+            self.pending.join()
+        self.check_error()
+
+    def close(self):
+        """
+        Flush pending snapshots and stop the thread. Later saves are written synchronously
+        """
+        if self.worker is not None:
+            self.pending.put(None)
+            self.worker.join()
+            self.worker = None
+        self.check_error()
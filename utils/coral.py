@@ -5,10 +5,12 @@ import torch
 def coral_loss(source, target):
     d = source.size(1)  # dim vector
 
-    source_c = compute_covariance(source)
-    target_c = compute_covariance(target)
+    # Covariances in fp32 also under mixed precision: fp16 sums of squares overflow easily
+    with torch.autocast(source.device.type, enabled=False):
+        source_c = compute_covariance(source.float())
+        target_c = compute_covariance(target.float())
 
-    loss = torch.sum(torch.mul((source_c - target_c), (source_c - target_c)))
+        loss = torch.sum(torch.mul((source_c - target_c), (source_c - target_c)))
 
     loss = loss / (4 * d * d)
     return loss
@@ -20,11 +22,8 @@ def compute_covariance(input_data):
     """
     n = input_data.size(0)  # batch_size
 
-    # Check if using gpu or cpu
-    if input_data.is_cuda:
-        device = torch.device('cuda')
-    else:
-        device = torch.device('cpu')
+    # Same device (gpu or cpu) as the input data
+    device = input_data.device
 
     id_row = torch.ones(n).reshape(1, n).to(device=device)
     sum_column = torch.mm(id_row, input_data)
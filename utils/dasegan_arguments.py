@@ -1,6 +1,7 @@
 import argparse
 import json
 import os
+from utils.distributed import init_distributed, is_main_process, local_devices
 
 
 class SmartFormatter(argparse.HelpFormatter):
@@ -14,7 +15,14 @@ class SmartFormatter(argparse.HelpFormatter):
 
 parser = argparse.ArgumentParser(description='MMS 2020 Challenge - DASEGAN', formatter_class=SmartFormatter)
 
-parser.add_argument("--gpu", type=str, default="0,1")
+parser.add_argument(
+    "--gpu", type=str, default="0,1",
+    help='Visible GPUs (-1 for CPU). DataParallel over them, or one per process when launched with torchrun'
+)
+parser.add_argument(
+    '--dist_backend', type=str, default="", choices=['', 'nccl', 'gloo'],
+    help='Process group backend of torchrun launches. Default nccl with GPUs, gloo on CPU'
+)
 parser.add_argument("--seed", type=int, default=2020)
 parser.add_argument('--output_dir', type=str, help='Where progress/checkpoints will be saved')
 
@@ -31,6 +39,18 @@ parser.add_argument('--dataset', type=str, help='Which dataset use')
 parser.add_argument('--use_original_mask', action='store_true', help='Whether use original mask labels when available')
 
 parser.add_argument('--data_augmentation', type=str, help='Apply data augmentations at train time')
+parser.add_argument('--num_workers', type=int, default=0, help='DataLoader worker processes (0: main process)')
+parser.add_argument('--persistent_workers', action='store_true', help='Keep DataLoader workers alive between epochs')
+parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches loaded in advance by each worker')
+parser.add_argument(
+    '--throughput_batches', type=int, default=0,
+    help='Batches used to report train loader throughput before training (0 disables). Diagnostic: it draws from '
+         'the random generators and samplers, so runs do not reproduce the ones without it'
+)
+parser.add_argument(
+    '--val_cache', type=str, default="", choices=["", "ram", "memmap"],
+    help='Preprocess validation data once and serve it from RAM or a memory-mapped cache'
+)
 parser.add_argument('--img_size', type=int, default=256, help='Final img squared size')
 parser.add_argument('--crop_size', type=int, default=256, help='Center crop squared size')
 
@@ -48,11 +68,22 @@ parser.add_argument('--weighted_sampler', action='store_true', help='If apply we
 parser.add_argument('--seg_net', type=str, default='resnet18_unet_scratch', help='Model name for Segmentator')
 parser.add_argument('--dis_net', type=str, default='n_layers_spectral', help='Model name for Discriminator')
 parser.add_argument('--gen_net', type=str, default='my_resnet_9blocks', help='Model name for Generator')
+parser.add_argument(
+    '--amp', action='store_true', help='Automatic mixed precision (fp16 + loss scaling on CUDA, bf16 on CPU)'
+)
+parser.add_argument(
+    '--compile_mode', type=str, default="none", choices=['none', 'compile', 'torchscript'],
+    help='Compiled models execution: torch.compile (TorchScript on older torch) or TorchScript'
+)
+parser.add_argument('--compile_cache', type=str, default="", help='Directory to keep compiled artefacts between runs')
 
 parser.add_argument('--dis_labels_criterion', type=str, default='ce', help='Loss for vendor labels training')
 parser.add_argument('--dis_realfake_criterion', type=str, default='bce', help='Loss for real fake training')
 parser.add_argument('--task_criterion', type=str, default='bce', help='Criterion for training')
 parser.add_argument('--task_weights_criterion', type=str, default='default', help='Weights for each subcriterion')
+parser.add_argument(
+    '--debug_losses', action='store_true', help='Materialise losses every step (.item()) keeping per step values'
+)
 
 parser.add_argument(
     '--rfield_method', type=str, required=True, choices=["random_maps", "random_atomic"],
@@ -69,6 +100,20 @@ parser.add_argument('--no_dropout', action='store_true', help='no dropout for th
 parser.add_argument('--ngf', type=int, default=64, help='# of generator filters in first conv layer')
 parser.add_argument('--ndf', type=int, default=64, help='# of discriminator filters in first conv layer')
 
+parser.add_argument(
+    '--checkpoint_queue', type=int, default=2,
+    help='Checkpoint snapshots kept in host memory while written in background (0 writes synchronously)'
+)
+parser.add_argument(
+    '--checkpoint_store', type=str, default="files", choices=['files', 'content'],
+    help="'content' writes each checkpoint once under its content hash and best/last names as references"
+)
+parser.add_argument('--checkpoint_half', action='store_true', help='Store model checkpoints weights as fp16')
+parser.add_argument('--checkpoint_compress', action='store_true', help='gzip compressed checkpoints')
+parser.add_argument(
+    '--resume', action='store_true',
+    help='Resume training from output_dir/checkpoint.pt (networks, optimizers, schedulers, epoch, RNG) when present'
+)
 parser.add_argument(
     '--dasegan_checkpoint', type=str, default="",
     help='Checkpoint with segmentator, generator and discriminator to load'
@@ -79,7 +124,11 @@ parser.add_argument('--gen_checkpoint', type=str, default="", help='If there is
 
 parser.add_argument(
     '--data_sampling', type=str, default="random_sampler", help='How to sample data points',
-    choices=['random_sampler', 'equilibrated_sampler']
+    choices=['random_sampler', 'equilibrated_sampler', 'stratified_sampler']
+)
+parser.add_argument(
+    '--stratified_cycle', action='store_true',
+    help='Stratified sampler: reuse exhausted strata (oversampling the small ones) instead of ending the epoch'
 )
 
 # Tasks weights
@@ -93,6 +142,10 @@ parser.add_argument('--plot_examples', action='store_true', help='Whether plot e
 
 parser.add_argument('--patients_percentage', type=float, default=1, help='Train patients percentage (from 0 to 1)')
 parser.add_argument('--rand_histogram_matching', action='store_true', help='Apply random histogram matching')
+parser.add_argument(
+    '--packed_data', action='store_true',
+    help='Read MMs slices from packed memory-mapped store (python tools/slices2pack.py)'
+)
 
 parser.add_argument('--unique_id', type=str, required=True, help='Unique identifier for current run')
 
@@ -101,6 +154,7 @@ parser.add_argument('--evaluate', action='store_true', help='Whether evaluate us
 args = parser.parse_args()
 
 os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+args.distributed = init_distributed(args.dist_backend)
 
 if args.output_dir == "":
     assert False, "Please set an output directory"
@@ -113,12 +167,15 @@ if args.plot_examples:
     os.makedirs(os.path.join(args.output_dir, "generated_samples"), exist_ok=True)
 
 # https://stackoverflow.com/a/55114771
-with open(os.path.join(args.output_dir, 'commandline_args.txt'), 'w') as f:
-    json.dump(args.__dict__, f, indent=2)
+if is_main_process():
+    with open(os.path.join(args.output_dir, 'commandline_args.txt'), 'w') as f:
+        json.dump(args.__dict__, f, indent=2)
 
 str_ids = args.gpu.split(',')
 args.gpu = []
 for str_id in str_ids:
     gpu_id = int(str_id)
     if gpu_id >= 0:
-        args.gpu.append(gpu_id)
+        args.gpu.append(len(args.gpu))  # CUDA_VISIBLE_DEVICES renumbers the selected GPUs from 0
+if args.distributed:
+    args.gpu = local_devices()  # GPU of the process local rank
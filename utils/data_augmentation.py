@@ -1,6 +1,9 @@
 """ --- DATA AUGMENTATION METHODS --- """
 
+import math
 import albumentations
+import torch
+import torch.nn.functional as F
 
 
 def data_augmentation_selector(da_policy, img_size, crop_size, mask_reshape_method, verbose=True):
@@ -43,9 +46,25 @@ def data_augmentation_selector(da_policy, img_size, crop_size, mask_reshape_meth
     elif da_policy == "mms2d":
         return mms2d_segmentation_da(img_size, mask_reshape_method, verbose=verbose)
 
+    elif da_policy == "mms2d_batch":
+        return mms2d_batch_segmentation_da(img_size, mask_reshape_method, verbose=verbose)
+
     assert False, "Unknown Data Augmentation Policy: {}".format(da_policy)
 
 
+def batch_augmentation_selector(da_policy, add_depth=False):
+    """
+    Batched tensor augmentations, applied by the training step over collated batches.
+    Only '_batch' policies have batched augmentations, others are applied per sample by the datasets
+    :param da_policy: (string) Data augmentation policy name
+    :param add_depth: (bool) Whether images have depth channels (only first channel is transformed)
+    :return: Callable (images, masks) -> (images, masks) or None
+    """
+    if da_policy == "mms2d_batch":
+        return MMs2DBatchAugmentation(add_depth=add_depth)
+    return None
+
+
 # ----------------------------------------------------------------------------------------- #
 # ----------------------------------------------------------------------------------------- #
 # ----------------------------------------------------------------------------------------- #
@@ -287,3 +306,195 @@ def mms2d_segmentation_da(img_size, mask_reshape_method, verbose=True):
     val_aug = common_test_augmentation(img_size, mask_reshape_method, verbose=verbose)
 
     return train_aug, train_aug_img, val_aug
+
+
+def mms2d_batch_segmentation_da(img_size, mask_reshape_method, verbose=True):
+    """
+    Same combination than mms2d_segmentation_da but random transformations are applied over whole batches
+    (see MMs2DBatchAugmentation). Datasets only reshape samples so they can be collated
+    """
+    if verbose:
+        print("Using M&Ms 2D Segmentation Batched Data Augmentation Combinations")
+
+    train_aug = common_test_augmentation(img_size, mask_reshape_method, verbose=verbose)
+
+    train_aug_img = []
+
+    val_aug = common_test_augmentation(img_size, mask_reshape_method, verbose=verbose)
+
+    return train_aug, train_aug_img, val_aug
+
+
+############################################
+#  --- BATCHED TENSOR AUGMENTATIONS --- #
+############################################
+
+class MMs2DBatchAugmentation:
+    """
+    Batched torch version of mms2d_segmentation_da policy (elastic, grid, optical, shift, scale, flips, rotate).
+    Works over collated [batch, channels, height, width] tensors on whatever device they live. Each sample draws
+    its own random parameters, all transformations are composed into a single sampling grid, and then images
+    are sampled bilinearly and masks with nearest neighbour.
+    """
+
+    def __init__(self, add_depth=False):
+        """
+        :param add_depth: (bool) Images have depth channels. Only first channel is transformed, depth rebuilt
+        """
+        self.add_depth = add_depth
+
+        self.elastic_p, self.elastic_alpha, self.elastic_sigma = 0.72, 177, 177 * 0.05
+        self.elastic_alpha_affine = 176 * 0.03
+        self.grid_p, self.grid_distort_limit, self.grid_num_steps = 0.675, 0.3, 5
+        self.optical_p, self.optical_distort_limit = 0.2, 0.2
+        self.shift_p, self.shift_limit = 0.56, 0.2
+        self.scale_p, self.scale_limit = 0.25, 0.2
+        self.vflip_p, self.hflip_p = 0.325, 0.3
+        self.rotate_p, self.rotate_limit = 0.625, 45
+
+    @staticmethod
+    def uniform(low, high, size, device):
+        return torch.rand(size, device=device) * (high - low) + low
+
+    @staticmethod
+    def applied(p, batch, device):
+        """ Per sample mask, 1 when transformation is applied with probability p """
+        return (torch.rand(batch, device=device) < p).float()
+
+    def elastic_displacements(self, batch, height, width, device, downscale=4):
+        """
+        Smooth random displacement fields in pixels. As fields are smooth they are generated at lower resolution
+        [batch, 2, height / downscale, width / downscale], same spatial extent, to be sampled with grid_sample
+        """
+        sigma = self.elastic_sigma / downscale
+        radius = int(4 * sigma + 0.5)
+        kernel = torch.arange(-radius, radius + 1, device=device, dtype=torch.float32)
+        kernel = torch.exp(-0.5 * (kernel / sigma) ** 2)
+        kernel = (kernel / kernel.sum()).repeat(2, 1, 1)  # [2, 1, k]
+
+        noise = torch.rand((batch, 2, max(height // downscale, 1), max(width // downscale, 1)), device=device) * 2 - 1
+        noise = F.conv2d(noise, kernel.unsqueeze(2), padding=(0, radius), groups=2)
+        noise = F.conv2d(noise, kernel.unsqueeze(3), padding=(radius, 0), groups=2)
+        # Blurred white noise amplitude is inversely proportional to sigma: rescale to full resolution amplitude
+        return noise * self.elastic_alpha / downscale
+
+    def elastic_affine(self, batch, height, width, device):
+        """
+        Random affine (as ElasticTransform alpha_affine) moving 3 points around center. Returns inverse maps
+        """
+        size = min(height, width) // 3
+        pts1 = torch.tensor([[size, size], [size, -size], [-size, -size]], dtype=torch.float32, device=device)
+        pts2 = pts1 + self.uniform(-self.elastic_alpha_affine, self.elastic_alpha_affine, (batch, 3, 2), device)
+        src = torch.cat((pts1, torch.ones((3, 1), device=device)), 1)  # [3, 3]
+        affine = torch.linalg.solve(src, pts2).transpose(1, 2)  # [batch, 2, 3]: src @ affine^T = pts2
+        return torch.linalg.inv(affine[:, :, :2]), affine[:, :, 2]
+
+    def grid_knots(self, batch, length, grid_mask, device):
+        """
+        GridDistortion steps along one axis: output cell i maps to input range [start_i, start_i + step * xstep_i]
+        """
+        step = length / self.grid_num_steps
+        xsteps = 1 + self.uniform(
+            -self.grid_distort_limit, self.grid_distort_limit, (batch, self.grid_num_steps + 1), device
+        ) * grid_mask.view(batch, 1)
+        starts = torch.cumsum(torch.cat((torch.zeros((batch, 1), device=device), xsteps[:, :-1] * step), 1), 1)
+        return step, xsteps, starts
+
+    def grid_distort(self, coords, step, xsteps, starts, length):
+        """ Piecewise linear GridDistortion inverse map over one axis (coords centered at 0, in pixels) """
+        b = coords.shape[0]
+        absolute = coords + length / 2
+        cell = torch.clamp(torch.floor(absolute / step), 0, self.grid_num_steps).long().view(b, -1)
+        cell_xsteps = torch.gather(xsteps, 1, cell).view_as(coords)
+        cell_starts = torch.gather(starts, 1, cell).view_as(coords)
+        absolute = cell_starts + (absolute - cell.view_as(coords) * step) * cell_xsteps
+        return absolute - length / 2
+
+    def sampling_grid(self, batch, height, width, device):
+        """
+        Compose every random transformation, from last to first, as a map from output to input pixels
+        """
+        ys = (torch.arange(height, device=device, dtype=torch.float32) + 0.5) - height / 2
+        xs = (torch.arange(width, device=device, dtype=torch.float32) + 0.5) - width / 2
+        py, px = torch.meshgrid(ys, xs, indexing="ij")
+        px, py = px.expand(batch, height, width), py.expand(batch, height, width)
+
+        def per_sample(values):
+            return values.view(batch, 1, 1)
+
+        # Rotate
+        angle = self.uniform(-self.rotate_limit, self.rotate_limit, batch, device) * math.pi / 180
+        angle = per_sample(angle * self.applied(self.rotate_p, batch, device))
+        px, py = torch.cos(angle) * px - torch.sin(angle) * py, torch.sin(angle) * px + torch.cos(angle) * py
+
+        # Flips
+        px = px * per_sample(1 - 2 * self.applied(self.hflip_p, batch, device))
+        py = py * per_sample(1 - 2 * self.applied(self.vflip_p, batch, device))
+
+        # Scale
+        scale = 1 + self.uniform(-self.scale_limit, self.scale_limit, batch, device) * self.applied(
+            self.scale_p, batch, device)
+        px, py = px / per_sample(scale), py / per_sample(scale)
+
+        # Shift
+        shift_mask = self.applied(self.shift_p, batch, device)
+        px = px - per_sample(self.uniform(-self.shift_limit, self.shift_limit, batch, device) * shift_mask * width)
+        py = py - per_sample(self.uniform(-self.shift_limit, self.shift_limit, batch, device) * shift_mask * height)
+
+        # Optical distortion
+        k = per_sample(self.uniform(-self.optical_distort_limit, self.optical_distort_limit, batch, device) *
+                       self.applied(self.optical_p, batch, device))
+        r2 = (px / width) ** 2 + (py / height) ** 2
+        factor = 1 + k * r2 + k * r2 * r2
+        px, py = px * factor, py * factor
+
+        # Grid distortion
+        grid_mask = self.applied(self.grid_p, batch, device)
+        px = self.grid_distort(px, *self.grid_knots(batch, width, grid_mask, device), width)
+        py = self.grid_distort(py, *self.grid_knots(batch, height, grid_mask, device), height)
+
+        # Elastic: smooth displacements are sampled at current positions, then inverse affine
+        elastic_mask = self.applied(self.elastic_p, batch, device)
+        displacements = self.elastic_displacements(batch, height, width, device) * elastic_mask.view(batch, 1, 1, 1)
+        norm_grid = torch.stack((px / (width / 2), py / (height / 2)), -1)
+        displacements = F.grid_sample(displacements, norm_grid, mode="bilinear", align_corners=False)
+        px, py = px + displacements[:, 0], py + displacements[:, 1]
+
+        inv_affine, translation = self.elastic_affine(batch, height, width, device)
+        eye = torch.eye(2, device=device).expand(batch, 2, 2)
+        inv_affine = torch.where(elastic_mask.view(batch, 1, 1) > 0, inv_affine, eye)
+        translation = translation * elastic_mask.view(batch, 1)
+        px, py = px - per_sample(translation[:, 0]), py - per_sample(translation[:, 1])
+        px, py = (
+            per_sample(inv_affine[:, 0, 0]) * px + per_sample(inv_affine[:, 0, 1]) * py,
+            per_sample(inv_affine[:, 1, 0]) * px + per_sample(inv_affine[:, 1, 1]) * py
+        )
+
+        return torch.stack((px / (width / 2), py / (height / 2)), -1)
+
+    def __call__(self, images, masks=None):
+        """
+        :param images: (tensor) [batch, channels, height, width] Images
+        :param masks: (tensor) [batch, 1, height, width] Masks with class indices or None
+        :return: (tensor, tensor) Transformed images and masks
+        """
+        b, _, h, w = images.shape
+        grid = self.sampling_grid(b, h, w, images.device)
+
+        warp_images = images[:, :1] if self.add_depth else images
+        # Out of image pixels are filled with each sample minimum (background), as constant border before normalize
+        background = warp_images.amin(dim=(1, 2, 3), keepdim=True)
+        warped = F.grid_sample(
+            warp_images - background, grid.to(images.dtype), mode="bilinear", padding_mode="zeros", align_corners=False
+        ) + background
+        if self.add_depth:
+            depth = images[:, 1:2]
+            warped = torch.cat((warped, depth, warped * depth), 1)
+
+        if masks is not None:
+            masks = F.grid_sample(
+                masks.float(), grid, mode="nearest", padding_mode="zeros", align_corners=False
+            ).to(masks.dtype)
+
+        return warped, masks
+
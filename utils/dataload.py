@@ -1,7 +1,13 @@
+import collections
+import functools
+import hashlib
+import json
+import shutil
 import nibabel as nib
 import pydicom
 from PIL import Image
 from utils.datasets import *
+from utils.distributed import barrier, is_main_process
 
 
 def load_tif(tif_path):
@@ -28,6 +34,59 @@ def load_nii(img_path):
     return np.asanyarray(nimg.dataobj), nimg.affine, nimg.header
 
 
+def load_nii_phase(img_path, phase):
+    """
+    Load a single phase of a 4D 'nii' or 'nii.gz' file, slicing the data object so the whole
+    cine is never materialised in memory
+    :param img_path: (string) Path of the 'nii' or 'nii.gz' image file name
+    :param phase: (int) Phase to load
+    :return: (array) [height, width, slices] Phase values
+    """
+    nimg = nib.load(img_path)
+    return np.asanyarray(nimg.dataobj[..., phase])
+
+
+class VolumeCache:
+    """
+    Least recently used cache of decoded arrays, bounded by memory size.
+    Entries are tuples of numpy arrays (or None). When used inside a Dataset each DataLoader worker
+    holds its own cache.
+    """
+
+    def __init__(self, max_mb=1024):
+        """
+        :param max_mb: (float) Maximum memory, in megabytes, held by cached arrays
+        """
+        self.max_bytes = max_mb * 1024 * 1024
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def entry_bytes(entry):
+        return sum(array.nbytes for array in entry if array is not None)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, entry):
+        size = self.entry_bytes(entry)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.current_bytes -= self.entry_bytes(self.entries.pop(key))
+        self.entries[key] = entry
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_bytes -= self.entry_bytes(evicted)
+
+
 def save_nii(img_path, data, affine, header):
     """
     Save a nifty file
@@ -41,22 +100,199 @@ def save_nii(img_path, data, affine, header):
     nimg.to_filename(img_path)
 
 
-def add_depth_channels(image_tensor):
-    _, h, w = image_tensor.size()
-    image = torch.zeros([3, h, w])
-    image[0] = image_tensor
-    for row, const in enumerate(np.linspace(0, 1, h)):
-        image[1, row, :] = const
-    image[2] = image[0] * image[1]
-    return image
+def open_packed_slices(pack_dir):
+    """
+    Open a packed slice store created with 'tools/slices2pack.py' as read-only memory-mapped arrays
+    :param pack_dir: (string) Folder with 'images.dat', 'masks.dat' and 'pack_info.json' files
+    :return: (np.memmap, np.memmap) Flat images and masks arrays. Masks is None when no mask was packed
+    """
+    with open(os.path.join(pack_dir, "pack_info.json")) as f:
+        pack_info = json.load(f)
+    images = np.memmap(
+        os.path.join(pack_dir, "images.dat"), dtype=pack_info["img_dtype"], mode="r",
+        shape=(pack_info["img_values"],)
+    )
+    masks = None
+    if pack_info["mask_values"] > 0:
+        masks = np.memmap(
+            os.path.join(pack_dir, "masks.dat"), dtype=pack_info["mask_dtype"], mode="r",
+            shape=(pack_info["mask_values"],)
+        )
+    return images, masks
+
+
+def read_packed_slice(flat_array, offset, height, width):
+    """
+    Zero-copy view of a single slice from a packed flat array
+    :param flat_array: (np.memmap) Flat array returned by 'open_packed_slices'
+    :param offset: (int) Position of the first slice value
+    :param height: (int) Slice height
+    :param width: (int) Slice width
+    :return: (array) [height, width] Slice view
+    """
+    return flat_array[offset:offset + height * width].reshape(height, width)
 
 
-def add_volume_depth_channels(list_images):
-    b, d, h, w = list_images.shape
-    new_list_images = torch.empty((b, 3, h, w))
-    for indx, image in enumerate(list_images):
-        new_list_images[indx, ...] = data_utils.add_depth_channels(image)
-    return new_list_images
+def config_hash(config):
+    """
+    :param config: (dict) JSON serializable description of a preprocessing pipeline
+    :return: (string) Short stable hash of the configuration
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def files_fingerprint(paths):
+    """
+    :param paths: (list) Source files of a cached result
+    :return: (string) Short hash of their sizes and modification times, changes when any of them is written again
+    """
+    stats = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stats.append((os.path.basename(path), -1, -1))
+    return config_hash(stats)
+
+
+class PreprocessedCache:
+    """
+    Fully preprocessed items (image, label, original image and original mask) of a deterministic pipeline,
+    materialised once. Kept in RAM, or stored as memory-mapped .npy files at 'cache_dir/<config hash>' and
+    reused by later runs with the same preprocessing configuration
+    """
+
+    file_names = [
+        "images", "labels", "has_label", "original_imgs", "original_img_shapes", "original_masks",
+        "original_mask_shapes"
+    ]
+
+    def __init__(self, num_items, load_item, config, mode="ram", cache_dir=""):
+        """
+        :param num_items: (int) Number of items
+        :param load_item: (function) idx -> (image tensor, label tensor or None, original image, original mask or None)
+        :param config: (dict) Preprocessing configuration, hashed to identify memory-mapped caches. Include a
+            fingerprint of the source data (see files_fingerprint) so regenerated data is not served from old caches
+        :param mode: (string) 'ram' or 'memmap'
+        :param cache_dir: (string) Parent folder of memory-mapped caches
+        """
+        if mode not in ["ram", "memmap"]:
+            assert False, f"Unknown preprocessed cache mode '{mode}'"
+
+        if mode == "ram":
+            self.arrays = self.build(num_items, load_item)
+            return
+
+        cache_path = os.path.join(cache_dir, config_hash(config))
+        # Distributed launches: the main process builds the cache while the others wait
+        if is_main_process() and not os.path.exists(os.path.join(cache_path, "images.npy")):
+            print(f"Building preprocessed cache at '{cache_path}'...")
+            arrays = self.build(num_items, load_item)
+            tmp_path = f"{cache_path}_tmp{os.getpid()}"  # Only complete caches get the final name
+            os.makedirs(tmp_path, exist_ok=True)
+            for name in self.file_names:
+                np.save(os.path.join(tmp_path, f"{name}.npy"), arrays[name])
+            with open(os.path.join(tmp_path, "config.json"), "w") as f:
+                json.dump(config, f, indent=2, default=str)
+            try:
+                os.rename(tmp_path, cache_path)
+            except OSError:  # Same cache completed meanwhile by another run
+                shutil.rmtree(tmp_path)
+                if not os.path.exists(os.path.join(cache_path, "images.npy")):
+                    raise
+        barrier()
+        self.arrays = {
+            name: np.load(os.path.join(cache_path, f"{name}.npy"), mmap_mode="r") for name in self.file_names
+        }
+        if len(self.arrays["images"]) != num_items:
+            assert False, f"Preprocessed cache '{cache_path}' does not match the dataset, remove it"
+
+    @staticmethod
+    def build(num_items, load_item):
+        images, labels, has_label, original_imgs, original_masks = None, None, [], [], []
+        for idx in range(num_items):
+            image, label, original_img, original_mask = load_item(idx)
+            if images is None:
+                images = np.empty((num_items, *image.shape), dtype=image.numpy().dtype)
+                label_shape = label.shape if label is not None else (1, *image.shape[1:])
+                labels = np.zeros((num_items, *label_shape), dtype=np.float32)
+            images[idx] = image.numpy()
+            has_label.append(label is not None)
+            if label is not None:
+                labels[idx] = label.numpy()
+            original_imgs.append(np.asarray(original_img))
+            original_masks.append(np.asarray(original_mask) if original_mask is not None else None)
+
+        present_masks = [mask for mask in original_masks if mask is not None]
+        return {
+            "images": images, "labels": labels, "has_label": np.array(has_label),
+            "original_imgs": np.concatenate([img.ravel() for img in original_imgs]),
+            "original_img_shapes": np.array([img.shape for img in original_imgs], dtype=np.int64),
+            "original_masks": np.concatenate([mask.ravel() for mask in present_masks]) if present_masks
+            else np.empty(0),
+            "original_mask_shapes": np.array(
+                [mask.shape if mask is not None else (0, 0) for mask in original_masks], dtype=np.int64
+            ),
+        }
+
+    @staticmethod
+    def ragged_offsets(shapes):
+        return np.concatenate(([0], np.cumsum(np.prod(shapes, axis=1))))
+
+    def get(self, idx):
+        """
+        :return: (image tensor, label tensor or None, original image, original mask or None)
+        """
+        arrays = self.arrays
+        if not hasattr(self, "img_offsets"):
+            self.img_offsets = self.ragged_offsets(arrays["original_img_shapes"])
+            self.mask_offsets = self.ragged_offsets(arrays["original_mask_shapes"])
+
+        image = torch.from_numpy(np.array(arrays["images"][idx]))
+        label = torch.from_numpy(np.array(arrays["labels"][idx])) if arrays["has_label"][idx] else None
+        original_img = np.array(
+            arrays["original_imgs"][self.img_offsets[idx]:self.img_offsets[idx + 1]]
+        ).reshape(arrays["original_img_shapes"][idx])
+        original_mask = None
+        if arrays["original_mask_shapes"][idx][0] > 0:  # (0, 0) shape when there was no original mask
+            original_mask = np.array(
+                arrays["original_masks"][self.mask_offsets[idx]:self.mask_offsets[idx + 1]]
+            ).reshape(arrays["original_mask_shapes"][idx])
+        return image, label, original_img, original_mask
+
+
+@functools.lru_cache(maxsize=32)
+def depth_coordinates(height, width, device=torch.device("cpu")):
+    """
+    Row coordinates plane, from 0 (top) to 1 (bottom), cached by shape and device
+    :param height: (int) Plane height
+    :param width: (int) Plane width
+    :param device: (torch.device) Device where plane lives
+    :return: (tensor) [1, 1, height, width] Row coordinates plane
+    """
+    rows = torch.from_numpy(np.linspace(0, 1, height)).float()
+    return rows.view(1, 1, height, 1).expand(1, 1, height, width).contiguous().to(device)
+
+
+def add_batch_depth_channels(images):
+    """
+    Transform 1 channel images to 3 channels: image, row coordinates and image * row coordinates
+    :param images: (tensor) [batch, 1, height, width] Images, on any device
+    :return: (tensor) [batch, 3, height, width] Images with depth channels, on same device
+    """
+    b, _, h, w = images.shape
+    images = images.float()
+    coordinates = depth_coordinates(h, w, images.device).expand(b, 1, h, w)
+    return torch.cat((images, coordinates, images * coordinates), dim=1)
+
+
+def add_depth_channels(image_tensor):
+    """
+    :param image_tensor: (tensor) [1, height, width] Image
+    :return: (tensor) [3, height, width] Image with depth channels
+    """
+    return add_batch_depth_channels(image_tensor.unsqueeze(0))[0]
 
 
 def apply_normalization(image, normalization_type, mean=None, std=None, image_min=None, image_max=None):
@@ -123,6 +359,33 @@ def apply_torch_normalization(image, normalization_type):
     assert False, "Unknown normalization: '{}'".format(normalization_type)
 
 
+def histogram_quantiles(image, num_quantiles=128):
+    """
+    Compact histogram table of an image: intensity values at evenly spaced cumulative probabilities
+    :param image: (array) Reference image
+    :param num_quantiles: (int) Table length
+    :return: (array) [num_quantiles] Intensity quantiles
+    """
+    values, counts = np.unique(image.ravel(), return_counts=True)
+    cumulative = np.cumsum(counts) / image.size
+    return np.interp(np.linspace(0, 1, num_quantiles), cumulative, values)
+
+
+def match_histogram_table(image, reference_table):
+    """
+    Histogram matching against a reference table (see histogram_quantiles). Same cumulative mapping than
+    skimage match_histograms but without loading and sorting the reference image
+    :param image: (array) Image to transform
+    :param reference_table: (array) [num_quantiles] Reference intensity quantiles
+    :return: (array) Image with reference histogram
+    """
+    values, unique_indices, counts = np.unique(image.ravel(), return_inverse=True, return_counts=True)
+    cumulative = np.cumsum(counts) / image.size
+    matched = np.interp(cumulative, np.linspace(0, 1, len(reference_table)), reference_table)
+    out_dtype = image.dtype if np.issubdtype(image.dtype, np.floating) else np.float32
+    return matched[unique_indices].reshape(image.shape).astype(out_dtype)
+
+
 def apply_augmentations(image, transform, img_transform, mask=None):
     if transform:
         if mask is not None:
@@ -178,8 +441,8 @@ def apply_volume_2Daugmentations(list_images, transform, img_transform, list_mas
 
 
 def add_volume_depth_channels(list_images):
-    b, d, h, w = list_images.shape
-    new_list_images = torch.empty((b, 3, h, w))
-    for indx, image in enumerate(list_images):
-        new_list_images[indx, ...] = add_depth_channels(image)
-    return new_list_images
+    """
+    :param list_images: (tensor) [slices, 1, height, width] Volume images
+    :return: (tensor) [slices, 3, height, width] Volume images with depth channels
+    """
+    return add_batch_depth_channels(list_images)
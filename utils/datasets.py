@@ -1,5 +1,13 @@
+import atexit
+import functools
+import hashlib
+import json
+import math
+import queue
 import random
-from torch.utils.data import DataLoader, WeightedRandomSampler
+import threading
+import time
+from torch.utils.data import DataLoader, DistributedSampler, Sampler, WeightedRandomSampler
 import torch
 import os
 import numpy as np
@@ -7,13 +15,15 @@ from torch.utils.data import Dataset
 import albumentations
 import copy
 import pandas as pd
-from skimage.exposure import match_histograms
 
 import utils.dataload as data_utils
 from tools.metrics_mnms import load_nii
 from utils.data_augmentation import data_augmentation_selector
+from utils.distributed import barrier, get_rank, get_world_size, is_main_process
 from utils.general import map_mask_classes
 
+HIST_QUANTILES = 128  # Histogram matching reference table length
+
 
 class MMs2DDataset(Dataset):
     """
@@ -22,7 +32,8 @@ class MMs2DDataset(Dataset):
 
     def __init__(self, partition, transform, img_transform, normalization="normalize", add_depth=True,
                  is_labeled=True, centre=None, vendor=None, end_volumes=True, data_relative_path="",
-                 only_phase="", rand_histogram_matching=False, patients_percentage=1, check_labeled=True):
+                 only_phase="", rand_histogram_matching=False, patients_percentage=1, check_labeled=True,
+                 packed=False, preprocessed_cache="", lightweight=False):
         """
         :param partition: (string) Dataset partition in ["Training", "Validation", "Test"]
         :param transform: (list) List of albumentations applied to image and mask
@@ -37,6 +48,10 @@ class MMs2DDataset(Dataset):
         :param only_phase: (string) Select only phases by 'ED' or 'ES'
         :param rand_histogram_matching: (bool) Perform random histogram matching with different vendors
         :param patients_percentage: (float) Train patients percentage (from 0 to 1)
+        :param packed: (bool) Read slices from packed memory-mapped store (python tools/slices2pack.py)
+        :param preprocessed_cache: (string) Serve items from a preprocessed cache built once: 'ram' or 'memmap'.
+                                   Only for deterministic pipelines (validation). Empty disables it
+        :param lightweight: (bool) Training samples: only 'image', 'label' and 'vendor_label' (no originals or ids)
         """
 
         if partition not in ["Training", "Validation", "Testing", "All", "All_val"]:
@@ -91,6 +106,12 @@ class MMs2DDataset(Dataset):
 
         data = data.reset_index(drop=True)
 
+        self.packed = packed
+        self.pack_dir = os.path.join(self.base_dir, "packed")
+        self._packed_images, self._packed_masks = None, None
+        if self.packed:
+            data = self.add_packed_info(data)
+
         self.data = data
         print(data.groupby("Vendor").count()["External code"])
         self.num_vendors = len(data["Vendor"].unique())
@@ -98,17 +119,150 @@ class MMs2DDataset(Dataset):
 
         self.add_depth = add_depth
         self.normalization = normalization
+        self.lightweight = lightweight
         self.transform = albumentations.Compose(transform)
         self.img_transform = albumentations.Compose(img_transform)
+        self.precompute_items()
 
         self.rand_histogram_matching = rand_histogram_matching
         if self.rand_histogram_matching:
             data = pd.read_csv(os.path.join(self.base_dir, "slices_info.csv"))
-            self.hist_match_df = data.loc[data["Partition"] == partition] if "All" not in self.partition else data
+            hist_match_df = data.loc[data["Partition"] == partition] if "All" not in self.partition else data
+            self.hist_tables = self.load_histogram_tables(data)[hist_match_df.index.values]
+            # Reference candidates for each vendor: slices from any other vendor
+            hist_vendors = hist_match_df["Vendor"].values
+            self.hist_candidates = {vendor: np.flatnonzero(hist_vendors != vendor) for vendor in self.vendor2label}
+
+        self.preprocessed = None
+        if preprocessed_cache != "" and len(self) > 0:
+            config = {
+                "dataset": "MMs2DDataset", "items": data_utils.config_hash(self.img_ids.tolist()),
+                "transform": repr(self.transform), "img_transform": repr(self.img_transform),
+                "normalization": self.normalization, "add_depth": self.add_depth,
+                "rand_histogram_matching": self.rand_histogram_matching and self.partition in ["Training", "All"],
+                "source": data_utils.files_fingerprint(self.source_files())
+            }
+            self.preprocessed = data_utils.PreprocessedCache(
+                len(self), self.preprocess_item, config, mode=preprocessed_cache,
+                cache_dir=os.path.join(self.base_dir, "preprocessed_cache")
+            )
 
     def __len__(self):
         return len(self.data)
 
+    def precompute_items(self):
+        """
+        Resolve once, for each row of self.data, everything __getitem__ needs (file paths, phase, labeled folder,
+        vendor label and normalization statistics) as flat arrays, so item fetch does not touch any DataFrame
+        """
+        data = self.data
+        external_codes = data["External code"].astype(str).values
+        slices, phases = data["Slice"].values, data["Phase"].values
+
+        self.phase_strs = np.where(
+            phases == data["ED"].values, "ED", np.where(phases == data["ES"].values, "ES", "UnknownPhase")
+        )
+
+        is_training = (data["Partition"] == "Training").values
+        labeled = data["Labeled"].values.astype(bool)
+        self.labeled_infos = mms_labeled_infos(data)
+        self.has_mask = np.ones(len(data), dtype=bool) if self.partition == "All" else ~(is_training & ~labeled)
+
+        self.vendors = data["Vendor"].values
+        self.vendor_labels = np.array([self.vendor2label[v] for v in self.vendors], dtype=np.int64)
+
+        self.img_ids = np.array([
+            f"{code}_slice{c_slice}_phase{c_phase}_vendor{vendor}_centre{centre}"
+            for code, c_slice, c_phase, vendor, centre in zip(
+                external_codes, slices, phases, self.vendors, data["Centre"].values
+            )
+        ])
+        self.img_paths, self.mask_paths = mms_slice_paths(self.base_dir, data, self.labeled_infos)
+
+        # Normalization statistics per row: (mean, std) when standardize, (max, min) when reescale
+        self.norm_stats = np.full((len(data), 2), np.nan)
+        if self.normalization in ["standardize_full_vol", "standardize_phase", "reescale_full_vol", "reescale_phase"]:
+            meta = data[["External code"]].merge(self.data_meta, on="External code", how="left")
+            stat_names = ("mean", "std") if "standardize" in self.normalization else ("max", "min")
+            for stat_indx, stat_name in enumerate(stat_names):
+                if "full_vol" in self.normalization:
+                    self.norm_stats[:, stat_indx] = meta[f"Vol_{stat_name}"].values
+                else:
+                    for phase_str in ["ED", "ES"]:
+                        phase_rows = self.phase_strs == phase_str
+                        self.norm_stats[phase_rows, stat_indx] = meta[f"{phase_str}_{stat_name}"].values[phase_rows]
+            # UnknownPhase slices (not ED or ES) and volumes without statistics would give NaN images
+            missing = np.isnan(self.norm_stats).any(axis=1)
+            if missing.any():
+                assert False, (
+                    f"No '{self.normalization}' statistics for {missing.sum()} slices, e.g. {self.img_ids[missing][0]} "
+                    f"({self.phase_strs[missing][0]}). Phase normalizations need ED and ES slices only (end_volumes)"
+                )
+
+        if self.packed:
+            self.img_offsets = data["Image offset"].values.astype(np.int64)
+            self.mask_offsets = data["Mask offset"].values.astype(np.int64)
+            self.slice_shapes = data[["Height", "Width"]].values.astype(np.int64)
+
+    def source_files(self):
+        """
+        Files the items are read from: slices (or packed store) and the statistics tables
+        """
+        tables = [os.path.join(self.base_dir, name) for name in ["slices_info.csv", "volume_info_statistics.csv"]]
+        if self.packed:
+            return tables + [os.path.join(self.pack_dir, name) for name in sorted(os.listdir(self.pack_dir))]
+        return tables + self.img_paths.tolist() + self.mask_paths[self.has_mask].tolist()
+
+    def load_histogram_tables(self, data):
+        """
+        Histogram reference tables for every slice at slices_info.csv (same order).
+        Built once reading all slices and stored beside slices_info.csv, keyed by its content hash
+        """
+        with open(os.path.join(self.base_dir, "slices_info.csv"), "rb") as f:
+            slices_hash = hashlib.sha1(f.read()).hexdigest()[:16]
+        tables_path = os.path.join(self.base_dir, f"histogram_tables_{slices_hash}_{HIST_QUANTILES}.npy")
+        if os.path.exists(tables_path):
+            return np.load(tables_path)
+
+        print("Building histogram matching reference tables...")
+        tables = np.empty((len(data), HIST_QUANTILES), dtype=np.float32)
+        if self.packed:
+            data = self.add_packed_info(data.reset_index(drop=True))
+            packed_images, _ = data_utils.open_packed_slices(self.pack_dir)
+            for indx, (offset, height, width) in enumerate(data[["Image offset", "Height", "Width"]].values):
+                image = data_utils.read_packed_slice(packed_images, offset, height, width)
+                tables[indx] = data_utils.histogram_quantiles(image, HIST_QUANTILES)
+        else:
+            img_paths, _ = mms_slice_paths(self.base_dir, data, mms_labeled_infos(data))
+            for indx, img_path in enumerate(img_paths):
+                tables[indx] = data_utils.histogram_quantiles(np.load(img_path), HIST_QUANTILES)
+        tmp_path = f"{tables_path}.tmp{os.getpid()}"  # Readers only see complete tables
+        with open(tmp_path, "wb") as f:
+            np.save(f, tables)
+        os.replace(tmp_path, tables_path)
+        return tables
+
+    def add_packed_info(self, data):
+        """
+        Attach packed store offsets and shapes to each slice entry
+        """
+        index_path = os.path.join(self.pack_dir, "index.csv")
+        if not os.path.exists(index_path):
+            assert False, 'You have to pack 2D slices first: python tools/slices2pack.py --data_path "data/MMs"'
+        index = pd.read_csv(index_path)[
+            ["External code", "Slice", "Phase", "Labeled info", "Image offset", "Mask offset", "Height", "Width"]
+        ]
+        index["Labeled info"] = index["Labeled info"].fillna("")
+        return data.merge(index, on=["External code", "Slice", "Phase"], how="left", validate="one_to_one")
+
+    def packed_slices(self):
+        """
+        Memory maps are opened lazily so each DataLoader worker maps the store by itself
+        """
+        if self._packed_images is None:
+            self._packed_images, self._packed_masks = data_utils.open_packed_slices(self.pack_dir)
+        return self._packed_images, self._packed_masks
+
     @staticmethod
     def custom_collate(batch):
         """
@@ -117,100 +271,52 @@ class MMs2DDataset(Dataset):
             batch: list of dataset items (from __getitem__). In this case batch is a list of dicts with
                    key image, and depending of validation or train different keys
 
-        Returns:
+        Returns: (dict) 'image' and 'label' batch tensors ('label_present' marks samples with mask),
+                 originals as RaggedBatch and other keys as lists (see collate_batch)
 
         """
-        # We have to modify "original_mask" as has different shapes
-        not_stack_items = ["original_mask", "original_img", "img_id", "vendor_label", "inestable_mask"]
-        batch_keys = list(batch[0].keys())
-        res = {bkey: [] for bkey in batch_keys}
-        for belement in batch:
-            for bkey in batch_keys:
-                res[bkey].append(belement[bkey])
-
-        for bkey in batch_keys:
-            if bkey in not_stack_items:
-                continue  # We wont stack over original_mask...
-            res[bkey] = torch.stack(res[bkey]) if None not in res[bkey] else None
-
-        return res
+        return collate_batch(
+            batch, tensor_keys=("image",), optional_keys=("label",), ragged_keys=("original_img", "original_mask")
+        )
 
     def histogram_matching_augmentation(self, image, original_vendor):
         # 40% of the time perform histogram matching with different vendor slice
         if self.partition in ["Training", "All"] and self.rand_histogram_matching and (random.random() < 0.4):
-            rand_hist_entry = self.hist_match_df[self.hist_match_df["Vendor"] != original_vendor].sample(n=1).iloc[0]
-            external_code = rand_hist_entry["External code"]
-            c_slice = rand_hist_entry["Slice"]
-            c_phase = rand_hist_entry["Phase"]
-            c_vendor = rand_hist_entry["Vendor"]
-            c_partition = rand_hist_entry["Partition"]
-            labeled_info = "Unlabeled" if c_vendor == "C" else "Labeled"
-            reference_img_path = os.path.join(
-                self.base_dir, c_partition, labeled_info, external_code,
-                f"{external_code}_sa_slice{c_slice}_phase{c_phase}.npy"
-            )
-            reference = np.load(reference_img_path)
-            image = match_histograms(image, reference, multichannel=False)
+            reference_table = self.hist_tables[np.random.choice(self.hist_candidates[original_vendor])]
+            image = data_utils.match_histogram_table(image, reference_table)
         return image
 
-    def __getitem__(self, idx):
-        df_entry = self.data.loc[idx]
-        external_code = df_entry["External code"]
-        c_slice = df_entry["Slice"]
-        c_phase = df_entry["Phase"]
-        c_partition = df_entry["Partition"]
-        if c_phase == df_entry["ED"]:
-            c_phase_str = "ED"
-        elif c_phase == df_entry["ES"]:
-            c_phase_str = "ES"
-        else:
-            # assert False, "Not in ED or ES phases?!"
-            c_phase_str = "UnknownPhase"
-        c_vendor = df_entry["Vendor"]
-        c_centre = df_entry["Centre"]
-        meta_entry = self.data_meta.loc[self.data_meta["External code"] == external_code]
-        img_id = f"{external_code}_slice{c_slice}_phase{c_phase}_vendor{c_vendor}_centre{c_centre}"
-
-        labeled_info = ""
-        if c_partition == "Training":
-            has_labeled = np.sum(self.data.loc[self.data["External code"] == external_code]["Labeled"].tolist()) > 0
-            labeled_info = "Labeled" if (df_entry["Labeled"] or has_labeled) else "Unlabeled"
+    def preprocess_item(self, idx):
+        """
+        :return: (image tensor, label tensor or None, original image, original mask or None)
+        """
+        c_vendor = self.vendors[idx]
 
-        img_path = os.path.join(
-            self.base_dir, c_partition, labeled_info, external_code,
-            f"{external_code}_sa_slice{c_slice}_phase{c_phase}.npy"
-        )
-        image = np.load(img_path)
-        original_image = copy.deepcopy(image)
+        if self.packed:
+            packed_images, packed_masks = self.packed_slices()
+            height, width = self.slice_shapes[idx]
+            image = data_utils.read_packed_slice(packed_images, self.img_offsets[idx], height, width)
+        else:
+            image = np.load(self.img_paths[idx])
+        original_image = copy.deepcopy(image) if not self.lightweight else None
 
         image = self.histogram_matching_augmentation(image, c_vendor)
 
         mask = None
-        if self.partition == "All" or not (c_partition == "Training" and not df_entry["Labeled"]):
-            mask_path = os.path.join(
-                self.base_dir, c_partition, labeled_info, external_code,
-                f"{external_code}_sa_gt_slice{c_slice}_phase{c_phase}.npy"
-            )
-            mask = np.load(mask_path)
-        original_mask = copy.deepcopy(mask)
+        if self.has_mask[idx]:
+            if self.packed:
+                mask = data_utils.read_packed_slice(packed_masks, self.mask_offsets[idx], height, width)
+            else:
+                mask = np.load(self.mask_paths[idx])
+        original_mask = copy.deepcopy(mask) if not self.lightweight else None
 
         image, mask = data_utils.apply_augmentations(image, self.transform, self.img_transform, mask)
 
-        if self.normalization == "standardize_full_vol":
-            mean = float(meta_entry["Vol_mean"])
-            std = float(meta_entry["Vol_std"])
+        if self.normalization in ["standardize_full_vol", "standardize_phase"]:
+            mean, std = float(self.norm_stats[idx, 0]), float(self.norm_stats[idx, 1])
             image = data_utils.apply_normalization(image, "standardize", mean=mean, std=std)
-        elif self.normalization == "standardize_phase":
-            mean = float(meta_entry[f"{c_phase_str}_mean"])
-            std = float(meta_entry[f"{c_phase_str}_std"])
-            image = data_utils.apply_normalization(image, "standardize", mean=mean, std=std)
-        elif self.normalization == "reescale_full_vol":
-            phase_max = float(meta_entry[f"Vol_max"])
-            phase_min = float(meta_entry[f"Vol_min"])
-            image = data_utils.apply_normalization(image, "reescale", image_max=phase_max, image_min=phase_min)
-        elif self.normalization == "reescale_phase":
-            phase_max = float(meta_entry[f"{c_phase_str}_max"])
-            phase_min = float(meta_entry[f"{c_phase_str}_min"])
+        elif self.normalization in ["reescale_full_vol", "reescale_phase"]:
+            phase_max, phase_min = float(self.norm_stats[idx, 0]), float(self.norm_stats[idx, 1])
             image = data_utils.apply_normalization(image, "reescale", image_max=phase_max, image_min=phase_min)
         else:
             image = data_utils.apply_normalization(image, self.normalization)
@@ -220,11 +326,21 @@ class MMs2DDataset(Dataset):
         if self.add_depth:
             image = data_utils.add_depth_channels(image)
         mask = torch.from_numpy(np.expand_dims(mask, 0)).float() if mask is not None else None
+        return image, mask, original_image, original_mask
+
+    def __getitem__(self, idx):
+        if self.preprocessed is not None:
+            image, mask, original_image, original_mask = self.preprocessed.get(idx)
+        else:
+            image, mask, original_image, original_mask = self.preprocess_item(idx)
+
+        if self.lightweight:
+            return {"image": image, "label": mask, "vendor_label": int(self.vendor_labels[idx])}
 
         return {
-            "img_id": img_id, "image": image, "label": mask,
+            "img_id": self.img_ids[idx], "image": image, "label": mask,
             "original_img": original_image, "original_mask": original_mask,
-            "vendor_label": self.vendor2label[c_vendor], "inestable_mask": mask
+            "vendor_label": int(self.vendor_labels[idx])
         }
 
 
@@ -235,7 +351,7 @@ class MMs3DDataset(Dataset):
 
     def __init__(self, partition, transform, img_transform, normalization="normalize", add_depth=True,
                  is_labeled=True, centre=None, vendor=None, end_volumes=True, data_relative_path="",
-                 only_phase=""):
+                 only_phase="", cache_mb=1024, lightweight=False):
         """
         :param partition: (string) Dataset partition in ["Training", "Validation", "Test"]
         :param transform: (list) List of albumentations applied to image and mask
@@ -248,6 +364,8 @@ class MMs3DDataset(Dataset):
         :param end_volumes: (bool) Whether only include 'ED' and 'ES' phases ((to) segmented) or all
         :param data_relative_path: (string) Prepend extension to MMs data base dir
         :param only_phase: (string) Select only phases by 'ED' or 'ES'
+        :param cache_mb: (float) Memory for decoded phases LRU cache (per worker). 0 disables the cache
+        :param lightweight: (bool) Training samples: only 'volume', 'label' and 'labeled_info' (no originals or ids)
         """
 
         if partition not in ["Training", "Validation", "Testing"]:
@@ -276,14 +394,35 @@ class MMs3DDataset(Dataset):
         self.data = data
         self.data_meta = pd.read_csv(os.path.join(self.base_dir, "volume_info_statistics.csv"))
 
+        # Full cine statistics precomputed per patient: mean, std, max, min
+        self.vol_stats = data[["External code"]].merge(self.data_meta, on="External code", how="left")[
+            ["Vol_mean", "Vol_std", "Vol_max", "Vol_min"]
+        ].values
+
         self.add_depth = add_depth
         self.normalization = normalization
         self.transform = albumentations.Compose(transform)
         self.img_transform = albumentations.Compose(img_transform)
+        self.volume_cache = data_utils.VolumeCache(cache_mb) if cache_mb > 0 else None
+        self.lightweight = lightweight
 
     def __len__(self):
         return len(self.data)
 
+    def load_phase(self, volume_path, mask_path, external_code, c_phase):
+        """
+        Decoded phase volume and mask (None when unlabeled), from cache when available
+        """
+        cache_key = (external_code, c_phase)
+        entry = self.volume_cache.get(cache_key) if self.volume_cache is not None else None
+        if entry is None:
+            volume = data_utils.load_nii_phase(volume_path, c_phase)
+            mask = data_utils.load_nii_phase(mask_path, c_phase) if mask_path is not None else None
+            entry = (volume, mask)
+            if self.volume_cache is not None:
+                self.volume_cache.put(cache_key, entry)
+        return entry
+
     @staticmethod
     def custom_collate(batch):
         """
@@ -292,23 +431,13 @@ class MMs3DDataset(Dataset):
             batch: list of dataset items (from __getitem__). In this case batch is a list of dicts with
                    key image, and depending of validation or train different keys
 
-        Returns:
+        Returns: (dict) 'volume' and 'label' batch tensors ('label_present' marks samples with mask),
+                 originals as RaggedBatch and other keys as lists (see collate_batch)
 
         """
-        not_stack_items = ["original_mask", "original_volume", "volume_id", "vol_slices", "labeled_info"]
-        # We have to modify "original_mask" as has different shapes
-        batch_keys = list(batch[0].keys())
-        res = {bkey: [] for bkey in batch_keys}
-        for belement in batch:
-            for bkey in batch_keys:
-                res[bkey].append(belement[bkey])
-
-        for bkey in batch_keys:
-            if bkey in not_stack_items:
-                continue  # We wont stack over original_mask...
-            res[bkey] = torch.stack(res[bkey]) if None not in res[bkey] else None
-
-        return res
+        return collate_batch(
+            batch, tensor_keys=("volume",), optional_keys=("label",), ragged_keys=("original_volume", "original_mask")
+        )
 
     def __getitem__(self, idx):
         df_entry = self.data.loc[idx]
@@ -326,22 +455,22 @@ class MMs3DDataset(Dataset):
             self.base_dir, self.partition, labeled_info, external_code,
             f"{external_code}_sa.nii.gz"
         )
-        volume, affine, header = load_nii(volume_path)
-        vol_mean, vol_std, vol_max, vol_min = volume.mean(), volume.std(), volume.max(), volume.min()
-        vol_slices = volume.shape[2]
-        volume = volume[..., c_phase].transpose(2, 0, 1)
-
-        mask = None
+        mask_path = None
         if not (self.partition == "Training" and not df_entry["Labeled"]):
             mask_path = os.path.join(
                 self.base_dir, self.partition, labeled_info, external_code,
                 f"{external_code}_sa_gt.nii.gz"
             )
-            mask, mask_affine, mask_header = load_nii(mask_path)
-            mask = mask[..., c_phase].transpose(2, 0, 1)
 
-        original_volume = copy.deepcopy(volume)
-        original_mask = copy.deepcopy(mask)
+        volume, mask = self.load_phase(volume_path, mask_path, external_code, c_phase)
+        vol_mean, vol_std, vol_max, vol_min = self.vol_stats[idx]
+        vol_slices = volume.shape[2]
+        # Copies: cached arrays must not be modified by augmentations
+        volume = np.array(volume.transpose(2, 0, 1))
+        mask = np.array(mask.transpose(2, 0, 1)) if mask is not None else None
+
+        original_volume = copy.deepcopy(volume) if not self.lightweight else None
+        original_mask = copy.deepcopy(mask) if not self.lightweight else None
 
         volume, mask = data_utils.apply_volume_2Daugmentations(volume, self.transform, self.img_transform, mask)
 
@@ -364,18 +493,77 @@ class MMs3DDataset(Dataset):
             volume = data_utils.add_volume_depth_channels(volume.unsqueeze(1))
         mask = torch.from_numpy(np.expand_dims(mask, 0)).float() if mask is not None else None
 
+        if self.lightweight:
+            return {"volume": volume, "label": mask, "labeled_info": labeled_info}
+
         return {
             "volume_id": volume_id, "volume": volume, "label": mask, "vol_slices": vol_slices,
             "original_volume": original_volume, "original_mask": original_mask, "labeled_info": labeled_info
         }
 
 
+def seed_worker(worker_id, seed=2020):
+    """
+    DataLoader worker_init_fn. Seeds numpy, python random and albumentations (which samples its parameters
+    from both) on each worker. torch.initial_seed() differs per worker and epoch, and it is drawn from the main
+    process generator seeded with 'seed', so augmentations stay reproducible and are not repeated across workers
+    """
+    worker_seed = (seed + torch.initial_seed()) % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def worker_kwargs(num_workers, seed, persistent_workers=False, prefetch_factor=2):
+    """
+    DataLoader keyword arguments for multi-process loading. Empty when num_workers is 0 (main process loading)
+    """
+    if num_workers <= 0:
+        return {}
+    return dict(
+        num_workers=num_workers, persistent_workers=persistent_workers, prefetch_factor=prefetch_factor,
+        worker_init_fn=functools.partial(seed_worker, seed=seed)
+    )
+
+
+def args_worker_kwargs(args):
+    return worker_kwargs(args.num_workers, args.seed, args.persistent_workers, args.prefetch_factor)
+
+
+def loader_throughput(loader, name="Train", num_batches=5):
+    """
+    Print loader throughput over the first 'num_batches' batches. First batch time (workers startup) reported apart
+    """
+    start = time.perf_counter()
+    first_time, num_samples, timed_batches = 0, 0, 0
+    for batch_indx, batch in enumerate(loader):
+        if batch_indx == 0:
+            first_time = time.perf_counter() - start
+            start = time.perf_counter()
+        else:
+            sample = batch["image"] if "image" in batch else batch["volume"]
+            num_samples += len(sample)
+            timed_batches += 1
+        if batch_indx == num_batches:
+            break
+    elapsed = time.perf_counter() - start
+    workers = getattr(loader, "num_workers", 0)
+    if timed_batches == 0:
+        print(f"{name} loader: first batch {first_time:.2f}s ({workers} workers)")
+        return
+    print(
+        f"{name} loader: first batch {first_time:.2f}s, {timed_batches / elapsed:.2f} batches/s, "
+        f"{num_samples / elapsed:.1f} samples/s ({workers} workers)"
+    )
+
+
 def get_volume_loader(
         vendor, train_aug, train_aug_img, add_depth=True, partition="Training",
-        data_relative_path="", normalization="standardize"
+        data_relative_path="", normalization="standardize", cache_mb=1024, workers=None, generator=None
 ):
     """
     Helper function for easily create data loaders for coral loss application
+    workers: (dict) DataLoader multi-process keyword arguments (see worker_kwargs)
+    generator: (torch.Generator) Shuffling and workers seeds generator. Default global torch generator
     """
     data_mod = ""
 
@@ -392,17 +580,124 @@ def get_volume_loader(
     dataset = MMs3DDataset(
         partition=partition, transform=train_aug, img_transform=train_aug_img, normalization=normalization,
         add_depth=add_depth, is_labeled=(not unlabeled), centre=c_centre, vendor=c_vendor, end_volumes=only_end,
-        data_relative_path=data_relative_path
+        data_relative_path=data_relative_path, cache_mb=cache_mb, lightweight=True
     )
 
     loader = DataLoader(
         dataset, batch_size=batch_size, pin_memory=True, collate_fn=dataset.custom_collate,
-        shuffle=True if partition == "Training" else False,
+        shuffle=True if partition == "Training" else False, generator=generator,
+        **(workers if workers is not None else {})
     )
 
     return loader
 
 
+class VolumeStream:
+    """
+    Infinite stream over a volume DataLoader. With worker processes a background thread keeps iterating the loader
+    (restarting it at each epoch end) and holds up to 'prefetch' ready batches, so sampling a volume never waits on
+    DataLoader iterator setup. Without workers batches are loaded at next(): a thread would draw augmentations from
+    the random generators shared with the training loop and runs would not be reproducible.
+    Call set_epoch() at each training epoch start so resumed trainings draw the same volumes as uninterrupted ones.
+    """
+
+    def __init__(self, loader, prefetch=2, join_timeout=5):
+        """
+        :param loader: (DataLoader) Volume loader (see get_volume_loader). Give it its own 'generator' when it uses
+            worker processes, so shuffling and workers seeds do not depend on the background thread timing
+        :param prefetch: (int) Number of ready batches kept in the queue
+        :param join_timeout: (float) Seconds close() waits for the background thread
+        """
+        self.loader = loader
+        self.join_timeout = join_timeout
+        self.prefetch = prefetch
+        self.seed = loader.generator.initial_seed() if loader.generator is not None else None
+        self.iterator = None
+        self.error = None  # Background thread failure, raised at every next() once the ready batches are consumed
+        self.ready, self.stop, self.worker = None, None, None
+        if loader.num_workers > 0:
+            self.start()
+            atexit.register(self.close)
+
+    def start(self):
+        """
+        Start the background thread with its own queue and stop event: a previous thread still finishing its batch
+        after close() can not feed the new queue
+        """
+        self.ready = queue.Queue(maxsize=max(self.prefetch, 1))
+        self.stop = threading.Event()
+        self.worker = threading.Thread(target=self.fill, args=(self.ready, self.stop), daemon=True)
+        self.worker.start()
+
+    def fill(self, ready, stop):
+        try:
+            while not stop.is_set():
+                for batch in self.loader:
+                    if not self.put(ready, stop, batch):
+                        return
+        except Exception as e:
+            if not stop.is_set():
+                self.error = e
+
+    @staticmethod
+    def put(ready, stop, item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def set_epoch(self, epoch):
+        """
+        Restart the stream with the loader generator seeded from its initial seed plus the epoch: the volumes drawn
+        in an epoch do not depend on the previous ones, so a resumed training replays the uninterrupted one
+        :param epoch: (int) Training epoch
+        """
+        if self.seed is None:
+            assert False, "VolumeStream.set_epoch needs a loader with its own 'generator'"
+        self.close()
+        self.loader.generator.manual_seed(self.seed + epoch)
+        self.iterator, self.error = None, None
+        if self.loader.num_workers > 0:
+            self.start()
+
+    def load(self):
+        """
+        Next batch loaded by the calling process (no worker processes)
+        """
+        if self.iterator is not None:
+            batch = next(self.iterator, None)
+            if batch is not None:
+                return batch
+        self.iterator = iter(self.loader)  # Epoch end: restart the loader
+        batch = next(self.iterator, None)
+        if batch is None:
+            assert False, "Empty volume loader"
+        return batch
+
+    def close(self):
+        if self.worker is not None:
+            self.stop.set()
+            self.worker.join(timeout=self.join_timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.worker is None:
+            return self.load()
+        while True:
+            try:
+                return self.ready.get(timeout=0.1)
+            except queue.Empty:
+                if self.error is not None:
+                    raise self.error
+                if not self.worker.is_alive():
+                    assert False, "VolumeStream closed"
+
+
 class MMsSubmissionDataset(Dataset):
     """
     Submission Dataset for Multi-Centre, Multi-Vendor & Multi-Disease Cardiac Image Segmentation Challenge (M&Ms).
@@ -536,6 +831,248 @@ class MMsSubmissionDataset(Dataset):
         return [ed_volume, es_volume, affine, header, initial_shape, str(external_code), original_ed, original_es]
 
 
+class RaggedBatch:
+    """
+    Batch of arrays with different shapes (or None) stored as one flat array plus offsets.
+    Indexing returns a view of each original array
+    """
+
+    def __init__(self, arrays):
+        self.shapes = [np.shape(array) if array is not None else None for array in arrays]
+        sizes = [int(np.prod(shape)) if shape is not None else 0 for shape in self.shapes]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        present = [array for array in arrays if array is not None]
+        self.flat = np.empty(self.offsets[-1], dtype=np.result_type(*present) if present else np.float32)
+        for indx, array in enumerate(arrays):
+            if array is not None:
+                self.flat[self.offsets[indx]:self.offsets[indx + 1]] = np.ravel(array)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, indx):
+        if self.shapes[indx] is None:
+            return None
+        return self.flat[self.offsets[indx]:self.offsets[indx + 1]].reshape(self.shapes[indx])
+
+    def __iter__(self):
+        return (self[indx] for indx in range(len(self)))
+
+
+def batch_buffer(reference, batch_size):
+    """
+    Empty batch tensor for samples like 'reference'. Inside DataLoader workers it is allocated in shared memory
+    (as default_collate does) so it reaches the main process without extra copies. In the main process it is
+    pinned when CUDA is available (pinned blocks are recycled by torch caching host allocator), so the
+    DataLoader pin_memory step has nothing left to copy
+    """
+    shape = (batch_size, *reference.shape)
+    if torch.utils.data.get_worker_info() is not None:
+        storage = reference._typed_storage()._new_shared(reference.numel() * batch_size, device=reference.device)
+        return reference.new(storage).resize_(shape)
+    return torch.empty(shape, dtype=reference.dtype, pin_memory=torch.cuda.is_available())
+
+
+def collate_batch(batch, tensor_keys=(), optional_keys=(), ragged_keys=()):
+    """
+    Collate samples (dicts) writing each tensor key directly into one preallocated batch tensor, instead of
+    building lists and stacking them.
+
+    Args:
+        batch: list of dataset items (from __getitem__)
+        tensor_keys: Same shape tensors. None if no sample has values
+        optional_keys: Same shape tensors that some samples may not have (None). Their slots are zero filled and
+                       '<key>_present' (bool tensor) marks the samples with values
+        ragged_keys: Arrays with different shapes, returned as RaggedBatch
+
+    Returns: (dict) Other keys are returned as lists
+
+    """
+    res = {}
+    for bkey in batch[0].keys():
+        values = [sample[bkey] for sample in batch]
+        if bkey in tensor_keys or bkey in optional_keys:
+            present = torch.tensor([value is not None for value in values])
+            reference = next((value for value in values if value is not None), None)
+            if reference is None:
+                res[bkey] = None
+            else:
+                res[bkey] = batch_buffer(reference, len(batch))
+                for indx, value in enumerate(values):
+                    if value is not None:
+                        res[bkey][indx].copy_(value)
+                    else:
+                        res[bkey][indx].zero_()
+            if bkey in optional_keys:
+                res[f"{bkey}_present"] = present
+        elif bkey in ragged_keys:
+            res[bkey] = RaggedBatch(values)
+        else:
+            res[bkey] = values
+    return res
+
+
+class StratifiedBatchSampler(Sampler):
+    """
+    Batch sampler drawing each batch evenly from strata (ex. vendor x phase). Strata index buckets are built once.
+    Each bucket is walked once per epoch as a random permutation, without replacement: the epoch ends when the
+    limiting stratum can not fill its share of a batch, so items of larger strata left over are not drawn that epoch.
+    Batch remainders (batch_size not multiple of the number of strata) go to the strata with more items left.
+    With cycle, exhausted buckets are reshuffled and walked again up to num_batches: small strata are then
+    oversampled, their items drawn several times per epoch (about num_batches * batch_size / num_strata / size).
+    In distributed launches each process walks a disjoint part (every world_size-th item) of every bucket
+    """
+
+    def __init__(self, strata, batch_size, num_batches=None, cycle=False, rank=0, world_size=1):
+        """
+        :param strata: (array) Stratum key per dataset item
+        :param batch_size: (int) Batch size
+        :param num_batches: (int) Batches per epoch. Default: len(strata) // batch_size (of this process part) when
+            cycle, until the limiting stratum is exhausted otherwise (used as upper bound)
+        :param cycle: (bool) Reshuffle and reuse exhausted strata (oversampling) instead of ending the epoch
+        :param rank: (int) Process rank in distributed launches
+        :param world_size: (int) Number of processes in distributed launches
+        """
+        super().__init__()
+        strata_keys, strata_indices = np.unique(np.asarray(strata), return_inverse=True)
+        self.strata_keys = strata_keys
+        self.buckets = [
+            np.flatnonzero(strata_indices == indx)[rank::world_size] for indx in range(len(strata_keys))
+        ]
+        # Same number of batches in every process: sized on the smallest part of each bucket
+        part_sizes = np.bincount(strata_indices, minlength=len(strata_keys)) // world_size
+        self.part_sizes = part_sizes
+        self.batch_size = batch_size
+        self.cycle = cycle
+        self.per_stratum = batch_size // len(self.buckets)
+        self.remainder = batch_size % len(self.buckets)
+        if cycle:
+            self.num_batches = num_batches if num_batches is not None else max(part_sizes.sum() // batch_size, 1)
+        else:
+            # The batch amounts only depend on the items left per stratum, not on the random tie breaks
+            exhaust_batches, remaining = 0, part_sizes.copy()
+            while True:
+                amounts = self.batch_amounts(remaining, np.random.RandomState(0))
+                if np.any(amounts > remaining):
+                    break
+                remaining -= amounts
+                exhaust_batches += 1
+            if exhaust_batches == 0:
+                assert False, f"Strata {dict(zip(strata_keys, part_sizes))} can not fill a batch " \
+                              f"of {batch_size} without replacement"
+            self.num_batches = min(exhaust_batches, num_batches) if num_batches is not None else exhaust_batches
+
+    def batch_amounts(self, remaining, rng):
+        """
+        :param remaining: (array) Items left per stratum
+        :param rng: (np.random.RandomState) Breaks the ties between strata with the same items left
+        :return: (array) Items per stratum of the next batch: remainder to the strata with more items left
+        """
+        amounts = np.full(len(self.buckets), self.per_stratum)
+        order = rng.permutation(len(self.buckets))
+        order = order[np.argsort(-remaining[order], kind="stable")]
+        amounts[order[:self.remainder]] += 1
+        return amounts
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        rng = np.random.RandomState(np.random.randint(2 ** 31))
+        orders = [rng.permutation(bucket) for bucket in self.buckets]
+        cursors = [0] * len(self.buckets)
+
+        def take(stratum, amount):
+            chosen = []
+            while amount > 0:
+                if cursors[stratum] == len(orders[stratum]):  # only reached when cycling
+                    orders[stratum], cursors[stratum] = rng.permutation(self.buckets[stratum]), 0
+                step = min(amount, len(orders[stratum]) - cursors[stratum])
+                chosen.append(orders[stratum][cursors[stratum]:cursors[stratum] + step])
+                cursors[stratum] += step
+                amount -= step
+            return chosen
+
+        for _ in range(self.num_batches):
+            if self.cycle:
+                amounts = np.full(len(self.buckets), self.per_stratum)
+                amounts[rng.choice(len(self.buckets), self.remainder, replace=False)] += 1
+            else:
+                amounts = self.batch_amounts(self.part_sizes - np.array(cursors), rng)
+            batch = []
+            for stratum, amount in enumerate(amounts):
+                batch += take(stratum, amount)
+            batch = np.concatenate(batch)
+            rng.shuffle(batch)
+            yield batch.tolist()
+
+
+class ShardSampler(Sampler):
+    """
+    Sequential sampler over the items of the current process (every world_size-th item from its rank) of a
+    distributed launch. Unlike DistributedSampler no item is repeated to even the shards, so metrics gathered from
+    every process (see MetricsAccumulator) count each validation sample exactly once
+    """
+
+    def __init__(self, dataset, rank=None, world_size=None):
+        super().__init__()
+        self.rank = rank if rank is not None else get_rank()
+        self.world_size = world_size if world_size is not None else get_world_size()
+        self.num_items = len(dataset)
+
+    def __len__(self):
+        return len(range(self.rank, self.num_items, self.world_size))
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_items, self.world_size))
+
+
+def set_sampler_epoch(loader, epoch):
+    """
+    Call at each epoch start: DistributedSampler shuffles with the epoch as seed (same order in every process)
+    """
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def mms_labeled_infos(data):
+    """
+    Folder where each MMs slice is stored inside its partition. Training patients with any labeled
+    slice are stored under 'Labeled' folder, 'Unlabeled' otherwise. Other partitions have not subfolder
+    Args:
+        data: (pd.DataFrame) slices_info.csv entries
+
+    Returns: (np.array) Folder name per entry
+
+    """
+    has_labeled = data.groupby("External code")["Labeled"].transform("any").values.astype(bool)
+    labeled = data["Labeled"].values.astype(bool)
+    return np.where(
+        (data["Partition"] == "Training").values, np.where(labeled | has_labeled, "Labeled", "Unlabeled"), ""
+    )
+
+
+def mms_slice_paths(base_dir, data, labeled_infos):
+    """
+    Args:
+        base_dir: (string) MMs data base dir
+        data: (pd.DataFrame) slices_info.csv entries
+        labeled_infos: (np.array) Folder name per entry (see mms_labeled_infos)
+
+    Returns: (np.array, np.array) Image and mask .npy paths per entry
+
+    """
+    img_paths, mask_paths = [], []
+    for code, partition, labeled_info, c_slice, c_phase in zip(
+            data["External code"].astype(str).values, data["Partition"].values, labeled_infos,
+            data["Slice"].values, data["Phase"].values
+    ):
+        slice_dir = os.path.join(base_dir, partition, labeled_info, code)
+        img_paths.append(os.path.join(slice_dir, f"{code}_sa_slice{c_slice}_phase{c_phase}.npy"))
+        mask_paths.append(os.path.join(slice_dir, f"{code}_sa_gt_slice{c_slice}_phase{c_phase}.npy"))
+    return np.array(img_paths), np.array(mask_paths)
+
+
 def find_values(string, label, label_type):
     """
 
@@ -569,15 +1106,74 @@ def find_values(string, label, label_type):
 
 
 def coral_dataset_selector(train_aug, train_aug_img, partition, args):
+    """
+    Returns: (list) One infinite VolumeStream per coral vendor. Draw volumes with next(stream)
+    """
     vendor_loaders = []
-    for coral_vendor in args.coral_vendors:
+    for indx, coral_vendor in enumerate(args.coral_vendors):
+        # Own generator: streams with workers are iterated by a background thread (see VolumeStream)
+        generator = torch.Generator().manual_seed(args.seed + get_rank() * len(args.coral_vendors) + indx)
         vendor_loader = get_volume_loader(
-            coral_vendor, train_aug, train_aug_img, add_depth=args.add_depth, partition=partition
+            coral_vendor, train_aug, train_aug_img, add_depth=args.add_depth, partition=partition,
+            cache_mb=args.volume_cache_mb, workers=args_worker_kwargs(args), generator=generator
         )
-        vendor_loaders.append(vendor_loader)
+        vendor_loaders.append(VolumeStream(vendor_loader, prefetch=args.coral_prefetch))
     return vendor_loaders
 
 
+def acdc_manifest(base_dir):
+    """
+    Slices manifest (mask and image paths, patient and slice) of ACDC data, in os.walk order.
+    Built walking 'base_dir' once and persisted at 'base_dir/slices_manifest.csv'. It is rebuilt when any
+    walked directory mtime changes (files or folders added/removed), which only needs one stat per directory
+    """
+    manifest_path = os.path.join(base_dir, "slices_manifest.csv")
+    mtimes_path = os.path.join(base_dir, "slices_manifest_dirs.json")
+    if os.path.exists(manifest_path) and os.path.exists(mtimes_path):
+        with open(mtimes_path) as f:
+            dir_mtimes = json.load(f)
+        if all(os.path.isdir(path) and os.stat(path).st_mtime == mtime for path, mtime in dir_mtimes.items()):
+            return pd.read_csv(manifest_path, dtype={"Mask path": str, "Image path": str, "Patient": str})
+
+    mask_paths, dir_mtimes = [], {}
+    for subdir, dirs, files in os.walk(base_dir):
+        dir_mtimes[subdir] = os.stat(subdir).st_mtime
+        for file in files:
+            entry = os.path.join(subdir, file)
+            if "_gt" in entry and not ".nii" in entry and not ".nii.gz" in entry:
+                mask_paths.append(entry)
+
+    manifest = pd.DataFrame({
+        "Mask path": mask_paths,
+        "Image path": [path.replace("_gt", "") for path in mask_paths],
+        "Patient": [path.split("/")[-2] for path in mask_paths],
+        "Slice": [
+            int(path.split("_slice")[-1].split(".")[0]) if "_slice" in path else -1 for path in mask_paths
+        ],
+    })
+    if len(manifest) > 0:
+        # Creating manifest files changes base_dir mtime: create both first, then take it (rewriting does not)
+        manifest.to_csv(manifest_path, index=False)
+        open(mtimes_path, "a").close()
+        dir_mtimes[base_dir] = os.stat(base_dir).st_mtime
+        with open(mtimes_path, "w") as f:
+            json.dump(dir_mtimes, f)
+    return manifest
+
+
+def classes_lut(classes_map, size=0):
+    """
+    Lookup table version of a classes map, so masks can be remapped as lut[mask]
+    :param classes_map: (dict) Mapping between classes. E.g.  {0:0, 1:3, 2:2, 3:1 ,4:4}
+    :param size: (int) Minimum table length, to cover every mask value (max value + 1)
+    :return: (np.array) lut[class] = mapped class. Classes not in the map keep their value
+    """
+    lut = np.arange(max(max(classes_map) + 1, size), dtype=np.int64)
+    for value, mapped in classes_map.items():
+        lut[value] = mapped
+    return lut
+
+
 class ACDC172Dataset(Dataset):
     """
     2D Dataset for ACDC Challenge.
@@ -585,12 +1181,15 @@ class ACDC172Dataset(Dataset):
     """
 
     def __init__(self, mode, transform, img_transform, add_depth=True, normalization="normalize", relative_path="",
-                 train_patients=100):
+                 train_patients=100, preprocessed_cache="", lightweight=False):
         """
         :param mode: (string) Dataset mode in ["train", "validation"]
         :param transform: (list) List of albumentations applied to image and mask
         :param img_transform: (list) List of albumentations applied to image only
         :param normalization: (str) Normalization mode. One of 'reescale', 'standardize', 'global_standardize'
+        :param preprocessed_cache: (string) Serve items from a preprocessed cache built once: 'ram' or 'memmap'.
+                                   Only for deterministic pipelines (validation). Empty disables it
+        :param lightweight: (bool) Training samples: only 'image' and 'label' (no originals or ids)
         """
 
         if mode not in ["train", "full_train", "validation"]:
@@ -602,15 +1201,13 @@ class ACDC172Dataset(Dataset):
         # Original ACDC -> class_to_cat = {1: "RV", 2: "MYO", 3: "LV", 4: "Mean"}
         self.class_to_cat = {1: "LV", 2: "MYO", 3: "RV", 4: "Mean"}
         self.map_classes = {0: 0, 1: 3, 2: 2, 3: 1, 4: 4}
+        self.classes_lut = classes_lut(self.map_classes)
         self.num_classes = 4
         self.include_background = False
 
-        data = []
-        for subdir, dirs, files in os.walk(self.base_dir):
-            for file in files:
-                entry = os.path.join(subdir, file)
-                if "_gt" in entry and not ".nii" in entry and not ".nii.gz" in entry:
-                    data.append(entry)
+        manifest = acdc_manifest(self.base_dir)
+        data = manifest["Mask path"].tolist()
+        patients = dict(zip(data, manifest["Patient"].values))
 
         if len(data) == 0:
             assert False, 'You have to transform volumes to 2D slices: ' \
@@ -618,14 +1215,15 @@ class ACDC172Dataset(Dataset):
 
         if mode in ["train", "validation"]:
             np.random.seed(1)
-            patient_list = np.sort(np.unique([elem.split("/")[-2] for elem in data]))
+            patient_list = np.sort(manifest["Patient"].unique())
             train_indx = np.random.choice(range(patient_list.shape[0]), size=(train_patients,), replace=False)
             ind = np.zeros(patient_list.shape[0], dtype=bool)
             ind[train_indx] = True
             val_indx = ~ind
 
             if mode == "train":
-                data = [elem for elem in data if elem.split("/")[-2] in patient_list[train_indx]]
+                train_patients_set = set(patient_list[train_indx])
+                data = [elem for elem in data if patients[elem] in train_patients_set]
             elif mode == "validation":
                 if train_patients > 85:
                     # If there are not too much patients take randomly
@@ -634,7 +1232,8 @@ class ACDC172Dataset(Dataset):
                     data = data[int(len(data) * .85):]
                 else:
                     # Only get first 15 patients for validation, not ALL
-                    data = [elem for elem in data if elem.split("/")[-2] in patient_list[val_indx][:15]]
+                    val_patients_set = set(patient_list[val_indx][:15])
+                    data = [elem for elem in data if patients[elem] in val_patients_set]
 
         self.data = data
         self.mode = mode
@@ -643,6 +1242,22 @@ class ACDC172Dataset(Dataset):
         self.transform = albumentations.Compose(transform)
         self.img_transform = albumentations.Compose(img_transform)
         self.add_depth = add_depth
+        self.lightweight = lightweight
+
+        self.preprocessed = None
+        if preprocessed_cache != "" and len(self) > 0:
+            config = {
+                "dataset": "ACDC172Dataset", "items": data_utils.config_hash(self.data),
+                "transform": repr(self.transform), "img_transform": repr(self.img_transform),
+                "normalization": self.normalization, "add_depth": self.add_depth, "map_classes": self.map_classes,
+                "source": data_utils.files_fingerprint(
+                    self.data + [path.replace("_gt", "") for path in self.data]
+                )
+            }
+            self.preprocessed = data_utils.PreprocessedCache(
+                len(self), self.preprocess_item, config, mode=preprocessed_cache,
+                cache_dir=os.path.join(self.base_dir, "preprocessed_cache")
+            )
 
     def __len__(self):
         return len(self.data)
@@ -655,37 +1270,35 @@ class ACDC172Dataset(Dataset):
             batch: list of dataset items (from __getitem__). In this case batch is a list of dicts with
                    key image, and depending of validation or train different keys
 
-        Returns:
+        Returns: (dict) 'image' and 'label' batch tensors ('label_present' marks samples with mask),
+                 originals as RaggedBatch and other keys as lists (see collate_batch)
 
         """
-        # We have to modify "original_mask" as has different shapes
-        batch_keys = list(batch[0].keys())
-        res = {bkey: [] for bkey in batch_keys}
-        for belement in batch:
-            for bkey in batch_keys:
-                res[bkey].append(belement[bkey])
-
-        for bkey in batch_keys:
-            if bkey == "original_mask" or bkey == "original_img" or bkey == "img_id":
-                continue  # We wont stack over original_mask...
-            res[bkey] = torch.stack(res[bkey])
-
-        return res
-
-    def __getitem__(self, idx):
+        return collate_batch(
+            batch, tensor_keys=("image",), optional_keys=("label",), ragged_keys=("original_img", "original_mask")
+        )
 
+    def preprocess_item(self, idx):
+        """
+        :return: (image tensor, label tensor, original image, original mask)
+        """
         img_path = self.data[idx].replace("_gt", "")
         image = np.load(img_path)
 
         mask_path = self.data[idx]
         mask = np.load(mask_path)
         if self.map_classes:
-            mask = map_mask_classes(mask, self.map_classes)
-
-        img_id = os.path.splitext(img_path)[0].split("/")[-1]
+            if not np.issubdtype(mask.dtype, np.integer):
+                mask = map_mask_classes(mask, self.map_classes)
+            elif mask.min() < 0:
+                assert False, f"Negative mask value {mask.min()} can not be mapped with {self.map_classes}"
+            else:
+                if mask.max() >= len(self.classes_lut):
+                    self.classes_lut = classes_lut(self.map_classes, mask.max() + 1)
+                mask = self.classes_lut[mask].astype(mask.dtype)
 
-        original_image = copy.deepcopy(image)
-        original_mask = copy.deepcopy(mask)
+        original_image = copy.deepcopy(image) if not self.lightweight else None
+        original_mask = copy.deepcopy(mask) if not self.lightweight else None
 
         image, mask = data_utils.apply_augmentations(image, self.transform, self.img_transform, mask)
         image = data_utils.apply_normalization(image, self.normalization)
@@ -694,6 +1307,18 @@ class ACDC172Dataset(Dataset):
         if self.add_depth:
             image = data_utils.add_depth_channels(image)
         mask = torch.from_numpy(np.expand_dims(mask, 0)).float()
+        return image, mask, original_image, original_mask
+
+    def __getitem__(self, idx):
+        if self.preprocessed is not None:
+            image, mask, original_image, original_mask = self.preprocessed.get(idx)
+        else:
+            image, mask, original_image, original_mask = self.preprocess_item(idx)
+
+        if self.lightweight:
+            return {"image": image, "label": mask}
+
+        img_id = os.path.splitext(self.data[idx].replace("_gt", ""))[0].split("/")[-1]
 
         return {
             "image": image, "original_img": original_image,
@@ -703,6 +1328,7 @@ class ACDC172Dataset(Dataset):
 
 def dataset_selector(train_aug, train_aug_img, val_aug, args, is_test=False, sampler="", wprob=.7):
     train_datasets, val_datasets = [], []
+    workers = args_worker_kwargs(args)
     if "mms2d" in args.dataset:
 
         if is_test:
@@ -713,7 +1339,7 @@ def dataset_selector(train_aug, train_aug_img, val_aug, args, is_test=False, sam
 
             return DataLoader(
                 test_dataset, batch_size=1, shuffle=False, pin_memory=True,
-                drop_last=False, collate_fn=test_dataset.simple_collate
+                drop_last=False, collate_fn=test_dataset.simple_collate, **workers
             )
 
         only_end = False if "full" in args.dataset else True
@@ -726,12 +1352,14 @@ def dataset_selector(train_aug, train_aug_img, val_aug, args, is_test=False, sam
                 partition="All", transform=train_aug, img_transform=train_aug_img,
                 normalization=args.normalization,
                 add_depth=args.add_depth, is_labeled=(not unlabeled), centre=c_centre, vendor=c_vendor,
-                end_volumes=only_end, rand_histogram_matching=args.rand_histogram_matching
+                end_volumes=only_end, rand_histogram_matching=args.rand_histogram_matching, packed=args.packed_data,
+                lightweight=True
             )
 
             val_dataset = MMs2DDataset(
                 partition="Validation", transform=val_aug, img_transform=[], normalization=args.normalization,
-                add_depth=args.add_depth, is_labeled=False, centre=None, vendor=None, end_volumes=True
+                add_depth=args.add_depth, is_labeled=False, centre=None, vendor=None, end_volumes=True,
+                packed=args.packed_data, preprocessed_cache=args.val_cache
             )
         else:
             train_dataset = MMs2DDataset(
@@ -739,13 +1367,14 @@ def dataset_selector(train_aug, train_aug_img, val_aug, args, is_test=False, sam
                 normalization=args.normalization,
                 add_depth=args.add_depth, is_labeled=(not unlabeled), centre=c_centre, vendor=c_vendor,
                 end_volumes=only_end, rand_histogram_matching=args.rand_histogram_matching,
-                patients_percentage=args.patients_percentage, check_labeled=check_labeled
+                patients_percentage=args.patients_percentage, check_labeled=check_labeled, packed=args.packed_data,
+                lightweight=True
             )
 
             val_dataset = MMs2DDataset(
                 partition="Validation", transform=val_aug, img_transform=[], normalization=args.normalization,
                 add_depth=args.add_depth, is_labeled=False, centre=None, vendor=None, end_volumes=True,
-                check_labeled=check_labeled
+                check_labeled=check_labeled, packed=args.packed_data, preprocessed_cache=args.val_cache
             )
 
         train_datasets.append(train_dataset)
@@ -756,12 +1385,12 @@ def dataset_selector(train_aug, train_aug_img, val_aug, args, is_test=False, sam
             assert False, "Not test partition available"
         train_dataset = ACDC172Dataset(
             mode="train", transform=train_aug, img_transform=train_aug_img,
-            add_depth=args.add_depth, normalization=args.normalization
+            add_depth=args.add_depth, normalization=args.normalization, lightweight=True
         )
 
         val_dataset = ACDC172Dataset(
             mode="validation", transform=val_aug, img_transform=[],
-            add_depth=args.add_depth, normalization=args.normalization
+            add_depth=args.add_depth, normalization=args.normalization, preprocessed_cache=args.val_cache
         )
 
         train_datasets.append(train_dataset)
@@ -772,30 +1401,46 @@ def dataset_selector(train_aug, train_aug_img, val_aug, args, is_test=False, sam
 
     elif len(train_datasets) == 1 and len(val_datasets) == 1:
 
+        # Distributed launches: each process loads its part of the epoch (same number of batches in every one)
+        world_size = get_world_size()
         if sampler == "equilibrated_sampler":
             dataset_labeled_info = np.array(train_datasets[0].data["Labeled"].astype(np.int32))
             weights = np.bincount(dataset_labeled_info)  # occurences per class
             weights[weights == 0] = 1  # replace empty bins with 1
             weights = 1 / weights  # number of targets per class
             weights /= weights.sum()  # normalize
-            for i, w in enumerate(weights):
-                dataset_labeled_info = np.where(dataset_labeled_info == i, w, dataset_labeled_info)
-            wsampler = WeightedRandomSampler(dataset_labeled_info, len(dataset_labeled_info), replacement=True)
+            sample_weights = weights[dataset_labeled_info]
+            wsampler = WeightedRandomSampler(
+                sample_weights, math.ceil(len(sample_weights) / world_size), replacement=True
+            )
 
             train_loader = DataLoader(
                 train_datasets[0], batch_size=args.batch_size, pin_memory=True,
-                collate_fn=train_datasets[0].custom_collate, sampler=wsampler
+                collate_fn=train_datasets[0].custom_collate, sampler=wsampler, **workers
             )
         elif sampler == "random_sampler":
             train_loader = DataLoader(
                 train_datasets[0], batch_size=args.batch_size, pin_memory=True,
-                collate_fn=train_datasets[0].custom_collate, shuffle=True
+                collate_fn=train_datasets[0].custom_collate, shuffle=world_size == 1,
+                sampler=DistributedSampler(train_datasets[0], seed=args.seed) if world_size > 1 else None, **workers
+            )
+        elif sampler == "stratified_sampler":
+            if not isinstance(train_datasets[0], MMs2DDataset):
+                assert False, "Vendor and phase stratified sampling only available for MMs datasets"
+            # Strata: vendor x phase ('ED', 'ES' or 'UnknownPhase' when full volumes)
+            strata = np.char.add(train_datasets[0].vendors.astype(str), train_datasets[0].phase_strs)
+            stratified_sampler = StratifiedBatchSampler(
+                strata, args.batch_size, cycle=args.stratified_cycle, rank=get_rank(), world_size=world_size
+            )
+            train_loader = DataLoader(
+                train_datasets[0], batch_sampler=stratified_sampler,
+                pin_memory=True, collate_fn=train_datasets[0].custom_collate, **workers
             )
         else:
             assert False, f"Unknown data sampler: '{sampler}'"
         val_loader = DataLoader(
-            val_datasets[0], batch_size=args.batch_size, shuffle=False, pin_memory=True,
-            drop_last=False, collate_fn=val_datasets[0].custom_collate
+            val_datasets[0], batch_size=args.batch_size, shuffle=False, pin_memory=True, drop_last=False,
+            collate_fn=val_datasets[0].custom_collate, sampler=ShardSampler(val_datasets[0]), **workers
         )
 
         num_classes = train_datasets[0].num_classes
@@ -804,14 +1449,16 @@ def dataset_selector(train_aug, train_aug_img, val_aug, args, is_test=False, sam
 
     else:
         train_dataset = torch.utils.data.ConcatDataset(train_datasets)
+        distributed = get_world_size() > 1
         train_loader = DataLoader(
-            train_dataset, batch_size=args.batch_size, pin_memory=True,
-            shuffle=True, collate_fn=train_datasets[0].custom_collate
+            train_dataset, batch_size=args.batch_size, pin_memory=True, shuffle=not distributed,
+            sampler=DistributedSampler(train_dataset, seed=args.seed) if distributed else None,
+            collate_fn=train_datasets[0].custom_collate, **workers
         )
         val_dataset = torch.utils.data.ConcatDataset(val_datasets)
         val_loader = DataLoader(
-            val_dataset, batch_size=args.batch_size, shuffle=False, pin_memory=True,
-            drop_last=False, collate_fn=val_datasets[0].custom_collate
+            val_dataset, batch_size=args.batch_size, shuffle=False, pin_memory=True, drop_last=False,
+            collate_fn=val_datasets[0].custom_collate, sampler=ShardSampler(val_dataset), **workers
         )
 
         num_classes, class_to_cat, include_background = [], None, None
@@ -836,14 +1483,13 @@ def dataset_selector(train_aug, train_aug_img, val_aug, args, is_test=False, sam
     return train_loader, val_loader, num_classes, class_to_cat, include_background
 
 
-def get_mnms_arrays(
-        vendor, normalization, partition="Training", data_mod="", verbose=False,
-        add_depth=False, batch_size=100, img_size=256, crop_size=256
+def mnms_vendor_dataset(
+        vendor, normalization, partition="Training", data_mod="", verbose=False, add_depth=False, img_size=256,
+        crop_size=256
 ):
     """
-    Return tensors torch.Size([batch, channels, img_size, crop_size])
+    Lightweight MMs2DDataset of a single vendor without data augmentation
     """
-
     data_augmentation = "none"
     mask_reshape_method = "padd"
     train_aug, train_aug_img, val_aug = data_augmentation_selector(
@@ -861,15 +1507,64 @@ def get_mnms_arrays(
         partition=partition, transform=train_aug, img_transform=train_aug_img,
         normalization=normalization, add_depth=add_depth,
         is_labeled=(not unlabeled), centre=c_centre, vendor=c_vendor,
-        end_volumes=only_end,
+        end_volumes=only_end, lightweight=True
+    )
+
+    if verbose:
+        print(f"Len train_dataset df: {len(train_dataset.data)}")
+
+    return train_dataset
+
+
+def get_mnms_arrays(
+        vendor, normalization, partition="Training", data_mod="", verbose=False,
+        add_depth=False, batch_size=100, img_size=256, crop_size=256, num_workers=0, seed=2020
+):
+    """
+    Return tensors torch.Size([batch, channels, img_size, crop_size])
+    """
+    train_dataset = mnms_vendor_dataset(
+        vendor, normalization, partition, data_mod, verbose, add_depth, img_size, crop_size
     )
 
     train_loader = DataLoader(
         train_dataset, batch_size=batch_size, pin_memory=True,
-        shuffle=False, collate_fn=train_dataset.custom_collate
+        shuffle=False, collate_fn=train_dataset.custom_collate, **worker_kwargs(num_workers, seed)
     )
 
-    if verbose:
-        print(f"Len train_dataset df: {len(train_dataset.data)}")
-
     return next(iter(train_loader))["image"]
+
+
+def get_mnms_samples(
+        vendor, normalization, num_samples=10, partition="Training", data_mod="", add_depth=False, img_size=256,
+        crop_size=256, pool_size=100, seed=42, data_relative_path=""
+):
+    """
+    Fixed samples of a vendor: 'num_samples' indices drawn (with 'seed') from the first 'pool_size' slices.
+    Only the chosen slices are loaded, and the result is cached at 'data/MMs/samples_cache' keyed by the
+    configuration and the chosen slice files, so regenerated data builds new samples.
+    Distributed launches: the main process builds the cache while the others wait
+    Return tensors torch.Size([num_samples, channels, img_size, crop_size])
+    """
+    dataset = mnms_vendor_dataset(
+        vendor, normalization, partition, data_mod, add_depth=add_depth, img_size=img_size, crop_size=crop_size
+    )
+    indices = np.random.RandomState(seed).choice(min(pool_size, len(dataset)), num_samples, replace=False)
+    tables = [os.path.join(dataset.base_dir, name) for name in ["slices_info.csv", "volume_info_statistics.csv"]]
+    config = {
+        "vendor": vendor, "normalization": normalization, "num_samples": num_samples, "partition": partition,
+        "data_mod": data_mod, "add_depth": add_depth, "img_size": img_size, "crop_size": crop_size,
+        "pool_size": pool_size, "seed": seed,
+        "source": data_utils.files_fingerprint(tables + [dataset.img_paths[idx] for idx in indices])
+    }
+    cache_dir = os.path.join(data_relative_path, "data/MMs", "samples_cache")
+    cache_path = os.path.join(cache_dir, f"{data_utils.config_hash(config)}.npy")
+    if is_main_process() and not os.path.exists(cache_path):
+        samples = torch.stack([dataset[idx]["image"] for idx in indices])
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"  # Readers only see complete samples
+        with open(tmp_path, "wb") as f:
+            np.save(f, samples.numpy())
+        os.replace(tmp_path, cache_path)
+    barrier()
+    return torch.from_numpy(np.load(cache_path))
@@ -0,0 +1,111 @@
+import builtins
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(backend=""):
+    """
+    Join the process group when launched by torchrun (RANK, WORLD_SIZE, LOCAL_RANK and MASTER_ADDR/PORT set in the
+    environment). Each process uses the visible GPU (see --gpu) of its local rank, or the CPU when there are none.
+    Only the main process (rank 0) keeps printing.
+    :param backend: Process group backend. Default nccl with GPUs, gloo on CPU
+    :return: (bool) True when running distributed
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if torch.cuda.is_available():
+        if local_rank >= torch.cuda.device_count():
+            assert False, f"Local rank {local_rank} without GPU: {torch.cuda.device_count()} visible devices (--gpu)"
+        torch.cuda.set_device(local_rank)
+    if backend == "":
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend)
+
+    if not is_main_process():
+        builtin_print = builtins.print
+
+        def print_main(*args, force=False, **kwargs):
+            if force:
+                builtin_print(*args, **kwargs)
+
+        builtins.print = print_main
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def local_devices():
+    """
+    GPU used by this process when distributed (see init_distributed), [] on CPU
+    """
+    return [torch.cuda.current_device()] if torch.cuda.is_available() else []
+
+
+def get_device():
+    """
+    Device of this process: its GPU (the first visible one when not distributed) or the CPU
+    """
+    return torch.device("cuda", torch.cuda.current_device()) if torch.cuda.is_available() else torch.device("cpu")
+
+
+def gather_objects(obj):
+    """
+    :return: (list) Picklable object of every rank, in rank order. [obj] when not distributed
+    """
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def distributed_model(model, find_unused_parameters=False):
+    """
+    DistributedDataParallel wrapper: gradients are averaged across processes at each backward.
+    State dict keys get the same 'module.' prefix as DataParallel, so checkpoints are interchangeable
+    """
+    return DistributedDataParallel(
+        model, device_ids=local_devices() or None, find_unused_parameters=find_unused_parameters
+    )
+
+
+def local_model(model):
+    """
+    Same module of a DistributedDataParallel model without collective operations (buffers broadcast) at forward,
+    for inference run by a single process or with a different number of batches per process (e.g. validation
+    shards). DataParallel keeps the state_dict keys. Other models are returned as they are
+    """
+    if isinstance(model, DistributedDataParallel):
+        return torch.nn.DataParallel(model.module, device_ids=model.device_ids)
+    return model
+
+
+def barrier():
+    """
+    Wait for every process. No-op when not distributed
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -6,7 +6,7 @@ import matplotlib.gridspec as gridspec
 
 import torch
 
-from utils.datasets import get_mnms_arrays
+from utils.datasets import get_mnms_samples
 
 
 def set_grad(nets, requires_grad=False):
@@ -191,26 +191,14 @@ def plot_save_kernels(kernel, save_dir, path_info="", by_kernel=True):
 
 
 def get_vendors_samples(normalization, add_depth=False, num_test_samples=10):
-    img_list_a = get_mnms_arrays(
-        "A", normalization=normalization, add_depth=add_depth,
-    )
-    img_list_b = get_mnms_arrays(
-        "B", normalization=normalization, add_depth=add_depth
-    )
-    img_list_c = get_mnms_arrays(
-        "C", normalization=normalization, data_mod="_unlabeled", add_depth=add_depth
-    )
-    img_list_d = get_mnms_arrays(
-        "D", normalization=normalization, data_mod="_unlabeled_full", partition="Testing", add_depth=add_depth
-    )
-
-    np.random.seed(42)
-    img_list_a_selection = img_list_a[np.random.choice(len(img_list_a), num_test_samples, replace=False)]
-    np.random.seed(42)
-    img_list_b_selection = img_list_b[np.random.choice(len(img_list_b), num_test_samples, replace=False)]
-    np.random.seed(42)
-    img_list_c_selection = img_list_c[np.random.choice(len(img_list_c), num_test_samples, replace=False)]
-    np.random.seed(42)
-    img_list_d_selection = img_list_d[np.random.choice(len(img_list_d), num_test_samples, replace=False)]
-
-    return [img_list_a_selection, img_list_b_selection, img_list_c_selection, img_list_d_selection]
+    """
+    Fixed 'num_test_samples' slices per vendor (A, B, C unlabeled and D from Testing), see get_mnms_samples
+    """
+    return [
+        get_mnms_samples("A", normalization, num_test_samples, add_depth=add_depth),
+        get_mnms_samples("B", normalization, num_test_samples, add_depth=add_depth),
+        get_mnms_samples("C", normalization, num_test_samples, data_mod="_unlabeled", add_depth=add_depth),
+        get_mnms_samples(
+            "D", normalization, num_test_samples, partition="Testing", data_mod="_unlabeled_full", add_depth=add_depth
+        ),
+    ]
@@ -1,6 +1,7 @@
 # https://pyformat.info/
 
 from utils.general import current_time
+from utils.checkpoints import checkpoint_files
 import socket
 import uuid
 
@@ -56,3 +57,13 @@ def log_epoch(current_epoch, current_lr, train_metrics, val_metrics, header):
 def get_name(unique_id):
     # unique_id -> https://serverfault.com/questions/103359/how-to-create-a-uuid-in-bash
     return f"{socket.gethostname().upper()}-{unique_id}"
+
+
+def wandb_save_checkpoint(path, base_path):
+    """
+    wandb.save of a checkpoint and, when it is a content addressed reference, of the object it points to
+    (uploaded relative to base_path so the reference still resolves)
+    """
+    import wandb
+    for checkpoint_file in checkpoint_files(path):
+        wandb.save(checkpoint_file, base_path=base_path)
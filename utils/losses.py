@@ -530,6 +530,7 @@ class BCEDicePenalizeBorderLoss(nn.Module):
         super().to(device=device)
         self.bce.to(device=device)
         self.dice.to(device=device)
+        return self
 
     def forward(self, logits, labels):
         mask_pool = F.avg_pool2d(labels, kernel_size=self.kernel_size, padding=self.kernel_size // 2, stride=1)
@@ -932,6 +933,7 @@ class ComboBCEDiceLoss(nn.Module):
     def to(self, device):
         super().to(device=device)
         self.bce_logits_loss.to(device=device)
+        return self
 
     def reset_parameters(self):
         self.running_bce_loss.zero_()
@@ -1010,6 +1012,7 @@ class ComboSemsegLossWeighted(nn.Module):
     def to(self, device):
         super().to(device=device)
         self.nll_loss.to(device=device)
+        return self
 
     def reset_parameters(self):
         self.running_bce_loss.zero_()
@@ -1098,6 +1101,7 @@ class OhemCrossEntropy2d(nn.Module):
     def to(self, device):
         super().to(device=device)
         self.criterion.to(device=device)
+        return self
 
     def forward(self, predict, target, weight=None):
         """
@@ -1143,7 +1147,7 @@ class OhemCrossEntropy2d(nn.Module):
         input_label[valid_inds] = label
         valid_flag_new = input_label != self.ignore_label
         # print(np.sum(valid_flag_new))
-        target = Variable(torch.from_numpy(input_label.reshape(target.size())).long().cuda())
+        target = Variable(torch.from_numpy(input_label.reshape(target.size())).long().to(predict.device))
 
         return self.criterion(predict, target)
 
@@ -1223,6 +1227,7 @@ class MixSoftmaxCrossEntropyOHEMLoss(OhemCrossEntropy2d):
     def to(self, device):
         super().to(device=device)
         self.bceloss.to(device=device)
+        return self
 
     def _aux_forward(self, *inputs, **kwargs):
         *preds, target = tuple(inputs)
@@ -1264,6 +1269,7 @@ class OHEMSegmentationLosses(OhemCrossEntropy2d):
     def to(self, device):
         super().to(device=device)
         self.bceloss.to(device=device)
+        return self
 
     def forward(self, *inputs):
         if not self.se_loss and not self.aux:
@@ -1852,4 +1858,69 @@ class AngularPenaltySMLoss(nn.Module):
         excl = torch.cat([torch.cat((wf[i, :y], wf[i, y + 1:])).unsqueeze(0) for i, y in enumerate(labels)], dim=0)
         denominator = torch.exp(numerator) + torch.sum(torch.exp(self.s * excl), dim=1)
         L = numerator - torch.log(denominator)
-        return -torch.mean(L)
\ No newline at end of file
+        return -torch.mean(L)
+
+
+# ==== Class-wise binary criterions ==== #
+# Binary criterions evaluated for all classes with a single batched call over one-hot masks, instead of a python
+# loop over the classes present in the batch (which requires a device->host copy of the labels to find them).
+
+def one_hot_masks(y_true, num_classes):
+    """
+    :param y_true: Class indices mask (batch, 1, h, w)
+    :param num_classes: Total number of classes
+    :return: Binary masks (batch, num_classes, h, w) and which classes are present in the batch (num_classes,)
+    """
+    masks = F.one_hot(y_true.reshape(-1, *y_true.shape[-2:]).long(), num_classes).permute(0, 3, 1, 2).float()
+    return masks, masks.amax(dim=(0, 2, 3)) > 0
+
+
+def classwise_bce(logits, masks):
+    return F.binary_cross_entropy_with_logits(logits, masks, reduction="none").mean(dim=(0, 2, 3))
+
+
+def classwise_soft_dice(logits, masks, inverse=False, smooth=1.):
+    probs = torch.sigmoid(logits)
+    if inverse:
+        probs, masks = 1 - probs, 1 - masks
+    intersection = (probs * masks).sum(dim=(0, 2, 3))
+    return 1 - ((2. * intersection + smooth) / (probs.sum(dim=(0, 2, 3)) + masks.sum(dim=(0, 2, 3)) + smooth))
+
+
+def classwise_penalize_border(logits, masks, kernel_size=3, smooth=1.):
+    """
+    BCEDicePenalizeBorderLoss for every class: border pixels (pooled mask not 0 nor 1) weight x3
+    """
+    mask_pool = F.avg_pool2d(masks, kernel_size=kernel_size, padding=kernel_size // 2, stride=1)
+    weights = 1 + (mask_pool.ge(0.01) * mask_pool.le(0.99)).float() * 2
+    w0 = masks[:, 0].numel()
+    weights = weights / weights.sum(dim=(0, 2, 3), keepdim=True) * w0
+
+    bce = weights * logits.clamp(min=0) - weights * logits * masks + weights * torch.log(1 + torch.exp(-logits.abs()))
+    bce = bce.sum(dim=(0, 2, 3)) / weights.sum(dim=(0, 2, 3))
+
+    probs, w2 = torch.sigmoid(logits), weights * weights
+    score = 2. * ((w2 * probs * masks).sum(dim=(2, 3)) + smooth) / \
+        ((w2 * probs).sum(dim=(2, 3)) + (w2 * masks).sum(dim=(2, 3)) + smooth)
+    dice = 1 - score.mean(dim=0)
+    return bce + dice
+
+
+def classwise_loss(criterion, logits, masks):
+    """
+    Evaluate a binary criterion for all classes at once
+    :param criterion: Binary criterion instance (see get_criterion)
+    :param logits: Predictions (batch, num_classes, h, w)
+    :param masks: Binary masks (batch, num_classes, h, w), see one_hot_masks
+    :return: (num_classes,) criterion(logits[:, c], masks[:, c]) for each class c
+    """
+    if type(criterion) == nn.BCEWithLogitsLoss and criterion.weight is None and criterion.pos_weight is None:
+        return classwise_bce(logits, masks)
+    if type(criterion) == SoftDiceLoss:
+        return classwise_soft_dice(logits, masks)
+    if type(criterion) == SoftInvDiceLoss:
+        return classwise_soft_dice(logits, masks, inverse=True)
+    if type(criterion) == BCEDicePenalizeBorderLoss:
+        return classwise_penalize_border(logits, masks, criterion.kernel_size)
+    # Generic criterions: one call per class, still without leaving the device
+    return torch.stack([criterion(logits[:, c], masks[:, c]) for c in range(masks.size(1))])
@@ -1,11 +1,18 @@
 import os
+import math
 from utils.general import convert_multiclass_mask, reshape_masks, plot_save_pred
 import numpy as np
 import torch
-import monai
+import torch.nn.functional as F
 import pickle
+from utils.distributed import gather_objects, get_world_size
+from utils.surface_distance import (
+    SURFACE_METRICS, hausdorff_distance, average_surface_distance, batch_surface_metrics
+)
 
 AVAILABLE_METRICS = ("accuracy", "iou", "dice", "assd", "hausdorff")
+# Computed for the whole batch (see MetricsAccumulator.record_batched): confusion matrices and surface distances
+BATCHED_METRICS = ("iou", "dice") + SURFACE_METRICS
 
 
 class MetricsAccumulator:
@@ -17,7 +24,8 @@ class MetricsAccumulator:
     """
 
     def __init__(self, problem_type, metric_list, num_classes,
-                 include_background=True, average="mean", mask_reshape_method="padd"):
+                 include_background=True, average="mean", mask_reshape_method="padd", batched=True,
+                 surface_workers=0):
         """
 
         Args:
@@ -26,6 +34,8 @@ class MetricsAccumulator:
             num_classes:
             include_background:
             average:
+            batched: Use confusion matrices for the whole batch when possible (see record_batched)
+            surface_workers: Threads used to compute hausdorff and assd of the batch samples (0 sequentially)
         """
         if average not in ["mean", "none"]:
             assert False, f"Unknown average method '{average}'"
@@ -52,6 +62,10 @@ class MetricsAccumulator:
         self.average = average
         self.mask_reshape_method = mask_reshape_method
         self.losses = {}
+        self.batched = batched and mask_reshape_method == "padd" and all(m in BATCHED_METRICS for m in metric_list)
+        self.surface_workers = surface_workers
+        # Device (intersection, summation) counts and max labels of the batches recorded since last update
+        self.pending_counts, self.pending_max_labels = [], []
 
     def __metrics_init(self):
         metric_methods = []
@@ -73,12 +87,12 @@ class MetricsAccumulator:
                 self.metrics_helpers["dice_best_value"] = -1
             elif metric_str in ["hausdorff"]:
                 self.metric_methods_args[metric_str] = {"label_idx": 1}
-                metric_methods.append(monai.metrics.compute_hausdorff_distance)
+                metric_methods.append(hausdorff_distance)
                 self.metrics_helpers["hausdorff_best_method"] = "min"
                 self.metrics_helpers["hausdorff_best_value"] = 10e8
             elif metric_str in ["assd"]:
                 self.metric_methods_args[metric_str] = {"label_idx": 1}
-                metric_methods.append(monai.metrics.compute_average_surface_distance)
+                metric_methods.append(average_surface_distance)
                 self.metrics_helpers["assd_best_method"] = "min"
                 self.metrics_helpers["assd_best_value"] = 10e8
         return metric_methods
@@ -90,7 +104,10 @@ class MetricsAccumulator:
                 self.metrics[key].append([[] for _ in range(self.num_classes)])
             self.is_updated = False
 
-        if self.problem_type == "segmentation":
+        if self.problem_type == "segmentation" and self.batched and generated_overlays <= 0:
+            self.record_batched(prediction, target)
+
+        elif self.problem_type == "segmentation":
             """
             prediction and target should be (h, w) with class indices, not probabilities or one channel per class!
             """
@@ -139,12 +156,142 @@ class MetricsAccumulator:
         else:
             assert False, f"Not implemented record for '{self.problem_type}'"
 
+    def record_batched(self, prediction, target):
+        """
+        Same values as the per sample loop of record(): a confusion matrix per sample is computed
+        for the whole batch with a single bincount on the predictions device. Intersection and summation counts
+        stay on the device and are moved to the host once, at update(), for iou and dice. Surface metrics
+        (hausdorff, assd) need the masks on the host: they are transferred once for the whole batch and each class
+        boundary distance transform is shared by both metrics.
+        As in the loop, a class gets a value for a sample when it appears in its target or in its prediction.
+        """
+        if not self.include_background and self.num_classes == 1:  # Single class -> sigmoid
+            pred_masks = (torch.sigmoid(prediction).squeeze(1) > 0.5).long()
+        else:
+            pred_masks = convert_multiclass_mask(prediction)
+
+        if torch.is_tensor(target) and target.squeeze(1).shape == pred_masks.shape:
+            target_masks = list(target.squeeze(1).to(device=pred_masks.device, dtype=torch.uint8).long())
+            pred_masks = list(pred_masks)
+        else:  # Original masks: list of arrays (generally different sizes) -> prediction reshaped per sample
+            target_masks, reshaped_preds = [], []
+            for pred_indx, pred_mask in enumerate(pred_masks):
+                original_mask = target[pred_indx]
+                if not torch.is_tensor(original_mask):
+                    original_mask = torch.from_numpy(np.asarray(original_mask).astype(np.uint8))
+                original_mask = original_mask.to(device=pred_masks.device, dtype=torch.uint8).squeeze().long()
+                target_masks.append(original_mask)
+                reshaped_preds.append(padd_mask_tensor(pred_mask, original_mask.shape))
+            pred_masks = reshaped_preds
+
+        targets_flat = torch.cat([target_mask.flatten() for target_mask in target_masks])
+        preds_flat = torch.cat([pred_mask.flatten() for pred_mask in pred_masks])
+        if targets_flat.shape != preds_flat.shape:
+            assert False, "Reshaped predictions and original masks shapes differ"
+
+        first_class = 0 if self.include_background else 1
+        num_samples, num_labels = len(target_masks), first_class + self.num_classes
+        # Labels out of range are checked at update() (no device sync per batch), binned as the last label meanwhile
+        max_label = torch.maximum(targets_flat.max(), preds_flat.max())
+        targets_flat, preds_flat = targets_flat.clamp(max=num_labels - 1), preds_flat.clamp(max=num_labels - 1)
+
+        # Sample, target and predicted label of every pixel -> (batch, labels, labels) confusion matrices
+        sample_indices = torch.repeat_interleave(
+            torch.arange(num_samples, device=targets_flat.device),
+            torch.tensor([target_mask.numel() for target_mask in target_masks], device=targets_flat.device)
+        )
+        bins = (sample_indices * num_labels + targets_flat) * num_labels + preds_flat
+        confusion = torch.bincount(bins, minlength=num_samples * num_labels * num_labels)
+        confusion = confusion.view(num_samples, num_labels, num_labels)
+
+        intersection = torch.diagonal(confusion, dim1=1, dim2=2)  # (batch, labels)
+        summation = confusion.sum(dim=2) + confusion.sum(dim=1)  # target + prediction pixels per label
+        surface_names = [metric_name for metric_name in self.metric_list if metric_name in SURFACE_METRICS]
+        self.pending_max_labels.append(max_label)
+        if not surface_names:
+            self.pending_counts.append(torch.stack((intersection, summation)))
+            return
+
+        # Surface metrics need the masks (and classes present) on the host now
+        self.check_max_label()
+        counts = torch.stack((intersection, summation)).cpu().numpy().astype(np.float64)
+        intersection, summation = counts[0], counts[1]
+        split_indices = np.cumsum([target_mask.numel() for target_mask in target_masks])[:-1]
+        targets_host = np.split(targets_flat.cpu().numpy(), split_indices)
+        preds_host = np.split(preds_flat.cpu().numpy(), split_indices)
+        shapes = [target_mask.shape for target_mask in target_masks]
+        surface_values = batch_surface_metrics(
+            [target_host.reshape(shape) for target_host, shape in zip(targets_host, shapes)],
+            [pred_host.reshape(shape) for pred_host, shape in zip(preds_host, shapes)],
+            [np.flatnonzero(summation[indx, first_class:]) + first_class for indx in range(num_samples)],
+            surface_names, workers=self.surface_workers
+        )
+        values = {}
+        for metric_name in surface_names:
+            values[metric_name] = np.full((num_samples, num_labels), np.nan)
+            for indx, sample_values in enumerate(surface_values):
+                for current_class, class_values in sample_values.items():
+                    values[metric_name][indx, current_class] = class_values[metric_name]
+        self.record_counts(intersection, summation, values)
+
+    def flush_pending(self):
+        """
+        Record the values of the batches kept on the device by record_batched(), with a single device -> host
+        transfer. Called by update()
+        """
+        self.check_max_label()
+        if len(self.pending_counts):
+            counts = torch.cat(self.pending_counts, dim=1).cpu().numpy().astype(np.float64)
+            self.pending_counts = []
+            self.record_counts(counts[0], counts[1])
+
+    def check_max_label(self):
+        """
+        Label range check of the batches recorded by record_batched(), deferred to a single device -> host transfer
+        """
+        if len(self.pending_max_labels):
+            max_label = int(torch.stack(self.pending_max_labels).max())
+            self.pending_max_labels = []
+            if max_label >= (0 if self.include_background else 1) + self.num_classes:
+                assert False, f"Label index '{max_label}' greater than num classes '{self.num_classes}'. " \
+                              f"Please count background if include_background is True."
+
+    def record_counts(self, intersection, summation, values=None):
+        """
+        Record iou and dice (and other already computed 'values') of the samples of (batch, labels) host counts.
+        As in the loop, a class gets a value for a sample when it appears in its target or in its prediction
+        """
+        first_class = 0 if self.include_background else 1
+        values = dict(values) if values is not None else {}
+        values["iou"] = (intersection + SMOOTH) / (summation - intersection + SMOOTH)
+        values["dice"] = (2.0 * intersection + SMOOTH) / (summation + SMOOTH)
+        for current_class in range(first_class, intersection.shape[1]):
+            class_samples = summation[:, current_class] > 0
+            for metric_name in self.metric_list:
+                self.metrics[metric_name][-1][current_class - first_class] += \
+                    values[metric_name][class_samples, current_class].tolist()
+
     def update(self):
         """
         CALL THIS METHOD AFTER RECORD ALL SAMPLES / AFTER EACH EPOCH
         We have accumulated metrics along different samples/batches and want to average accross that same epoch samples:
         {'iou': [[[0.8, 0.6], [0.3, 0.5]]]} -> {'iou': [[0.7, 0.4]]}
+        In distributed launches every process must call it: samples recorded by all of them are gathered first, so
+        averages (and best values) are the ones of the whole epoch and the same in every process.
         """
+        if self.is_updated:  # Nothing recorded since last update (e.g. empty validation shard)
+            for key in self.metrics:
+                self.metrics[key].append([[] for _ in range(self.num_classes)])
+
+        self.flush_pending()
+
+        if get_world_size() > 1:
+            gathered = gather_objects({key: self.metrics[key][-1] for key in self.metrics})
+            for key in self.metrics:
+                self.metrics[key][-1] = [
+                    sum(classes_values, []) for classes_values in zip(*[values[key] for values in gathered])
+                ]
+
         for key in self.metrics:
             for i in range(len(self.metrics[key][-1])):
                 self.metrics[key][-1][i] = np.mean(self.metrics[key][-1][i])
@@ -189,6 +336,19 @@ class MetricsAccumulator:
             return self.metrics[metric_name][-1][-1]
         return np.mean(self.metrics[metric_name][-1])
 
+    def state_dict(self):
+        """
+        Recorded history and best values trackers (to resume training)
+        """
+        return {
+            "metrics": self.metrics, "metrics_helpers": self.metrics_helpers,
+            "losses": self.losses, "is_updated": self.is_updated
+        }
+
+    def load_state_dict(self, state_dict):
+        for key, value in state_dict.items():
+            setattr(self, key, value)
+
     def save_progress(self, output_dir, identifier=""):
         pickle.dump(self.__dict__, open(os.path.join(output_dir, f'{identifier}_progress.pkl'), "wb"))
 
@@ -205,9 +365,77 @@ class MetricsAccumulator:
         return output_str
 
 
+class RunningLosses:
+    """
+    Running sums of losses (or any per step value) kept as device tensors. Adding a value does not synchronize
+    host and device, as calling .item() every step does, so the host keeps queuing work ahead.
+    Means are moved to the host all at once when requested (typically at the end of each epoch).
+    With debug=True values are materialised when added and every step value is kept in 'history'.
+    Ejemplo:
+        losses = RunningLosses()
+        losses.add("Train_loss", loss)  # every step
+        metrics.add_losses("Train_loss", losses.means()["Train_loss"])  # end of epoch
+    """
+
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.sums, self.counts, self.history = {}, {}, {}
+
+    def add(self, key, value):
+        if torch.is_tensor(value):
+            value = value.detach().float()
+            if self.debug:
+                value = value.item()
+        if self.debug:
+            self.history.setdefault(key, []).append(value)
+        self.sums[key] = self.sums[key] + value if key in self.sums else value
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def means(self):
+        """
+        :return: (dict) Mean value of each key as python float, with a single device->host transfer.
+                 In distributed launches (every process must call it) means of the values added by all processes
+        """
+        sums = dict(self.sums)
+        tensor_keys = [key for key, value in sums.items() if torch.is_tensor(value)]
+        if len(tensor_keys):
+            device = sums[tensor_keys[0]].device
+            sums.update(zip(
+                tensor_keys, torch.stack([sums[key].reshape(()).to(device) for key in tensor_keys]).tolist()
+            ))
+        counts = dict(self.counts)
+        if get_world_size() > 1:  # Keys may differ between processes (e.g. values only added for labeled samples)
+            gathered = gather_objects((sums, counts))
+            sums, counts = {}, {}
+            for process_sums, process_counts in gathered:
+                for key, value in process_sums.items():
+                    sums[key] = sums.get(key, 0) + float(value)
+                    counts[key] = counts.get(key, 0) + process_counts[key]
+        return {key: float(value) / counts[key] for key, value in sums.items()}
+
+    def reset(self):
+        self.sums, self.counts, self.history = {}, {}, {}
+
+
 SMOOTH = 1e-10
 
 
+def padd_mask_tensor(mask, to_shape):
+    """
+    Torch version of reshape_masks(mask, to_shape, "padd"): center crop or zero pad a (h, w) mask tensor
+    """
+    (h_in, w_in), (h_out, w_out) = mask.shape, to_shape
+    pads = []
+    for size_in, size_out in ((w_in, w_out), (h_in, h_out)):  # F.pad expects last dimension first
+        if size_in > size_out:  # center crop -> negative padding
+            offset = math.ceil((size_in - size_out) / 2)
+            pads += [-offset, -(size_in - size_out - offset)]
+        else:
+            pad, rem = (size_out - size_in), (size_out - size_in) % 2
+            pads += [math.ceil(pad / 2), math.ceil(pad / 2 + rem)]
+    return F.pad(mask, pads, mode="constant", value=0)
+
+
 def jaccard_coef(y_true, y_pred):
     """
     Size of the intersection divided by the size of the union of two label sets
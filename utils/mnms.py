@@ -1,12 +1,14 @@
 from models import model_selector
 from utils.dataload import save_nii
 from utils.datasets import dataset_selector
+from utils.distributed import get_device, local_model
 from models.gan import define_Gen
 from utils.data_augmentation import data_augmentation_selector
 import torch
 import os
 
 from utils.general import binarize_volume_prediction, plot_save_pred_volume
+from utils.neural import MixedPrecision
 
 
 def test_prediction(args, model=None, generator=None):
@@ -36,19 +38,24 @@ def test_prediction(args, model=None, generator=None):
                 checkpoint=args.gen_checkpoint
             )
 
+    # Run by the main process alone in distributed launches
+    model, generator = local_model(model), local_model(generator)
+    mixed_precision = MixedPrecision(args.amp if hasattr(args, 'amp') else False)
+    device = get_device()
     model.eval()
     with torch.no_grad():
         for (ed_volume, es_volume, img_affine, img_header, img_shape, img_id, original_ed, original_es) in test_loader:
 
-            ed_volume = ed_volume.type(torch.float).cuda()
-            es_volume = es_volume.type(torch.float).cuda()
+            ed_volume = ed_volume.type(torch.float).to(device)
+            es_volume = es_volume.type(torch.float).to(device)
 
-            if generator is not None:
-                ed_volume = generator(ed_volume)
-                es_volume = generator(es_volume)
+            with mixed_precision.autocast():
+                if generator is not None:
+                    ed_volume = generator(ed_volume)
+                    es_volume = generator(es_volume)
 
-            prob_pred_ed = model(ed_volume)
-            prob_pred_es = model(es_volume)
+                prob_pred_ed = model(ed_volume).float()
+                prob_pred_es = model(es_volume).float()
 
             pred_ed = binarize_volume_prediction(prob_pred_ed, img_shape, "padd")  # [slices, height, width]
             pred_es = binarize_volume_prediction(prob_pred_es, img_shape, "padd")  # [slices, height, width]
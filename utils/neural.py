@@ -1,10 +1,12 @@
 import random
 from torch.optim.swa_utils import SWALR
 
+from utils.checkpoints import CheckpointWriter
 from utils.coral import coral_loss
+from utils.distributed import get_device, is_main_process, local_model
 from utils.general import *
 from utils.losses import *
-from utils.metrics import MetricsAccumulator, jaccard_coef
+from utils.metrics import MetricsAccumulator, RunningLosses, jaccard_coef
 from utils.radam import *
 
 
@@ -18,6 +20,63 @@ def set_seed(seed):
     random.seed(seed)
 
 
+def get_rng_state():
+    """
+    Random generators states to resume training. DataLoader workers are seeded from the torch generator at
+    each epoch start (see seed_worker), so restoring it also restores the workers augmentations
+    """
+    return {
+        "python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    }
+
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state["python"])
+    np.random.set_state(rng_state["numpy"])
+    torch.set_rng_state(rng_state["torch"])
+    if torch.cuda.is_available() and len(rng_state["cuda"]):
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+
+
+class MixedPrecision:
+    """
+    Opt-in automatic mixed precision: fp16 autocast with a GradScaler on CUDA, bf16 autocast on CPU
+    (bf16 keeps the fp32 exponent range, so no loss scaling is required). When disabled every method behaves
+    as the plain fp32 code, so training loops are written once for both modes.
+    Use one instance per optimizer, each one keeps its own loss scale.
+    """
+
+    def __init__(self, enabled=False, device_type=""):
+        self.enabled = enabled
+        self.device_type = device_type if device_type != "" else ("cuda" if torch.cuda.is_available() else "cpu")
+        self.dtype = torch.float16 if self.device_type == "cuda" else torch.bfloat16
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=enabled and self.device_type == "cuda")
+
+    def autocast(self):
+        """
+        Context manager for forward passes
+        """
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        """
+        Unscale gradients (skipping the step if any is inf/nan) and update the loss scale
+        """
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        if self.scaler.is_enabled() and len(state_dict):  # Disabled scalers have empty states
+            self.scaler.load_state_dict(state_dict)
+
+
 def defrost_model(model):
     """
     Unfreeze model parameters
@@ -141,6 +200,12 @@ def scheduler_step(optimizer, scheduler, metric, args):
         pass  # No modify learning rate
 
 
+AVAILABLE_CRITERIONS = (
+    "bce", "ce", "bce_dice", "bce_dice_border", "bce_dice_ac", "bce_dice_border_ce", "bce_dice_border_haus_ce",
+    "bce_dice_ce"
+)
+
+
 def get_criterion(criterion_type, weights_criterion='default'):
     """
     Gives a list of subcriterions and their corresponding weight
@@ -150,6 +215,7 @@ def get_criterion(criterion_type, weights_criterion='default'):
         (list) Subcriterions
         (list) Weights for each criterion
     """
+    device = get_device()
 
     if weights_criterion == "":
         assert False, "Please specify weights for criterion"
@@ -161,51 +227,51 @@ def get_criterion(criterion_type, weights_criterion='default'):
         criterion = [criterion1]
         multiclass = [False]
     elif criterion_type == "ce":
-        criterion1 = nn.CrossEntropyLoss().cuda()
+        criterion1 = nn.CrossEntropyLoss().to(device)
         criterion = [criterion1]
         multiclass = [True]
     elif criterion_type == "bce_dice":
-        criterion1 = nn.BCEWithLogitsLoss().cuda()
-        criterion2 = SoftDiceLoss().cuda()
-        criterion3 = SoftInvDiceLoss().cuda()
+        criterion1 = nn.BCEWithLogitsLoss().to(device)
+        criterion2 = SoftDiceLoss().to(device)
+        criterion3 = SoftInvDiceLoss().to(device)
         criterion = [criterion1, criterion2, criterion3]
         multiclass = [False, False, False]
     elif criterion_type == "bce_dice_border":
-        criterion1 = nn.BCEWithLogitsLoss().cuda()
-        criterion2 = SoftDiceLoss().cuda()
-        criterion3 = SoftInvDiceLoss().cuda()
-        criterion4 = BCEDicePenalizeBorderLoss().cuda()
+        criterion1 = nn.BCEWithLogitsLoss().to(device)
+        criterion2 = SoftDiceLoss().to(device)
+        criterion3 = SoftInvDiceLoss().to(device)
+        criterion4 = BCEDicePenalizeBorderLoss().to(device)
         criterion = [criterion1, criterion2, criterion3, criterion4]
         multiclass = [False, False, False, False]
     elif criterion_type == "bce_dice_ac":
-        criterion1 = nn.BCEWithLogitsLoss().cuda()
-        criterion2 = SoftDiceLoss().cuda()
-        criterion3 = SoftInvDiceLoss().cuda()
-        criterion4 = ActiveContourLoss().cuda()
+        criterion1 = nn.BCEWithLogitsLoss().to(device)
+        criterion2 = SoftDiceLoss().to(device)
+        criterion3 = SoftInvDiceLoss().to(device)
+        criterion4 = ActiveContourLoss().to(device)
         criterion = [criterion1, criterion2, criterion3, criterion4]
         multiclass = [False, False, False, False]
     elif criterion_type == "bce_dice_border_ce":
-        criterion1 = nn.BCEWithLogitsLoss().cuda()
-        criterion2 = SoftDiceLoss().cuda()
-        criterion3 = SoftInvDiceLoss().cuda()
-        criterion4 = BCEDicePenalizeBorderLoss().cuda()
-        criterion5 = nn.CrossEntropyLoss().cuda()
+        criterion1 = nn.BCEWithLogitsLoss().to(device)
+        criterion2 = SoftDiceLoss().to(device)
+        criterion3 = SoftInvDiceLoss().to(device)
+        criterion4 = BCEDicePenalizeBorderLoss().to(device)
+        criterion5 = nn.CrossEntropyLoss().to(device)
         criterion = [criterion1, criterion2, criterion3, criterion4, criterion5]
         multiclass = [False, False, False, False, True]
     elif criterion_type == "bce_dice_border_haus_ce":
-        criterion1 = nn.BCEWithLogitsLoss().cuda()
-        criterion2 = SoftDiceLoss().cuda()
-        criterion3 = SoftInvDiceLoss().cuda()
-        criterion4 = BCEDicePenalizeBorderLoss().cuda()
-        criterion5 = HDDTBinaryLoss().cuda()
-        criterion6 = nn.CrossEntropyLoss().cuda()
+        criterion1 = nn.BCEWithLogitsLoss().to(device)
+        criterion2 = SoftDiceLoss().to(device)
+        criterion3 = SoftInvDiceLoss().to(device)
+        criterion4 = BCEDicePenalizeBorderLoss().to(device)
+        criterion5 = HDDTBinaryLoss().to(device)
+        criterion6 = nn.CrossEntropyLoss().to(device)
         criterion = [criterion1, criterion2, criterion3, criterion4, criterion5, criterion6]
         multiclass = [False, False, False, False, False, True]
     elif criterion_type == "bce_dice_ce":
-        criterion1 = nn.BCEWithLogitsLoss().cuda()
-        criterion2 = SoftDiceLoss().cuda()
-        criterion3 = SoftInvDiceLoss().cuda()
-        criterion4 = nn.CrossEntropyLoss().cuda()
+        criterion1 = nn.BCEWithLogitsLoss().to(device)
+        criterion2 = SoftDiceLoss().to(device)
+        criterion3 = SoftInvDiceLoss().to(device)
+        criterion4 = nn.CrossEntropyLoss().to(device)
         criterion = [criterion1, criterion2, criterion3, criterion4]
         multiclass = [False, False, False, True]
     else:
@@ -214,7 +280,7 @@ def get_criterion(criterion_type, weights_criterion='default'):
     return criterion, weights_criterion, multiclass
 
 
-def create_checkpoint(metrics, model, model_name, output_dir):
+def create_checkpoint(metrics, model, model_name, output_dir, checkpoint_writer=None, on_written=None):
     """
     Iterar sobre las diferentes metricas y comprobar si la ultima medicion es mejor que las anteriores
     (debemos comprobar que average!=none - si no tendremos que calcular el average)
@@ -222,18 +288,23 @@ def create_checkpoint(metrics, model, model_name, output_dir):
     Args:
         metrics:
         model:
+        checkpoint_writer: CheckpointWriter used to write in background. The model state is snapshotted once for
+                           every best metric and last checkpoints. If None, checkpoints are written synchronously
+        on_written: Optional callable run with the written paths (last checkpoint at the end) once they are on disk
 
     Returns:
 
     """
+    checkpoint_writer = checkpoint_writer if checkpoint_writer is not None else CheckpointWriter(max_pending=0)
+    paths = []
     dict_metrics = metrics.metrics
     for metric_key in dict_metrics:
         # check if last epoch mean metric value is the best
         if metrics.metrics_helpers[f"{metric_key}_is_best"]:
-            torch.save(model.state_dict(), output_dir + f"/model_{model_name}_best_{metric_key}.pt")
+            paths.append(output_dir + f"/model_{model_name}_best_{metric_key}.pt")
 
     checkpoint_path = output_dir + "/model_" + model_name + "_last.pt"
-    torch.save(model.state_dict(), checkpoint_path)
+    checkpoint_writer.save(model.state_dict(), paths + [checkpoint_path], on_written=on_written)
     return checkpoint_path
 
 
@@ -250,37 +321,41 @@ def calculate_loss(y_true, y_pred, criterion, weights_criterion, multiclass_crit
     Returns:
 
     """
-    loss = 0
-
-    if num_classes == 1:  # Single class case
-        for indx, crit in enumerate(criterion):
-            loss += weights_criterion[indx] * crit(y_pred, y_true)
+    # Losses are computed in fp32 also under mixed precision (see MixedPrecision)
+    with torch.autocast(y_pred.device.type, enabled=False):
+        y_pred = y_pred.float()
+        loss = 0
 
-    else:  # Multiclass case
+        if num_classes == 1:  # Single class case
+            for indx, crit in enumerate(criterion):
+                loss += weights_criterion[indx] * crit(y_pred, y_true)
 
-        # Case Multiclass criterions
-        multiclass_indices = [i for i, x in enumerate(multiclass_criterion) if x]
-        for indx in multiclass_indices:
-            loss += weights_criterion[indx] * criterion[indx](y_pred.float(), torch.squeeze(y_true.long()))
+        else:  # Multiclass case
 
-        # Single class criterions => calculate criterions per class
-        singleclass_indices = [i for i, x in enumerate(multiclass_criterion) if not x]
-        for current_class in np.unique(y_true.cpu().numpy()):
+            # Case Multiclass criterions
+            multiclass_indices = [i for i, x in enumerate(multiclass_criterion) if x]
+            for indx in multiclass_indices:
+                loss += weights_criterion[indx] * criterion[indx](y_pred.float(), torch.squeeze(y_true.long()))
 
-            tmp_loss, tmp_mask = 0, 1 - (y_true != current_class) * 1.0
-            for indx in singleclass_indices:  # Accumulate all different losses for each single class
-                tmp_loss += weights_criterion[indx] * criterion[indx](y_pred[:, int(current_class), :, :],
-                                                                      tmp_mask.squeeze(1))
+            # Single class criterions => calculate criterions for all classes at once over one-hot masks
+            singleclass_indices = [i for i, x in enumerate(multiclass_criterion) if not x]
+            if len(singleclass_indices):
+                masks, present = one_hot_masks(y_true, num_classes)
+                class_loss = 0
+                for indx in singleclass_indices:  # Accumulate all different losses for each class
+                    class_loss = class_loss + weights_criterion[indx] * classwise_loss(criterion[indx], y_pred, masks)
 
-            # Average over the number of classes
-            loss += (tmp_loss / len(y_true.unique()))
+                # Average over the classes present in the batch (absent ones masked out, no host sync)
+                class_loss = torch.where(present, class_loss, torch.zeros_like(class_loss))
+                loss += class_loss.sum() / present.sum()
 
-    return loss
+        return loss
 
 
 def train_step(
         train_loader, model, criterion, weights_criterion, multiclass_criterion, optimizer, train_metrics,
-        coral, coral_loader, coral_weight, vol_task_weight, num_classes, generator=None
+        coral, coral_loader, coral_weight, vol_task_weight, num_classes, generator=None, batch_transform=None,
+        mixed_precision=None, debug_losses=False
 ):
     """
 
@@ -292,49 +367,61 @@ def train_step(
         multiclass_criterion:
         optimizer:
         train_metrics:
+        batch_transform: (optional) Batched augmentations applied on device (see batch_augmentation_selector)
+        mixed_precision: (optional) MixedPrecision instance for the optimizer. Default fp32
+        debug_losses: Materialise losses every step (see RunningLosses)
 
     Returns:
 
     """
-    task_loss, coral_global = 0, 0
+    mixed_precision = mixed_precision if mixed_precision is not None else MixedPrecision()
+    losses = RunningLosses(debug=debug_losses)
+    device = get_device()
     model.train()
     for batch_indx, batch in enumerate(train_loader):
-        image, label = batch["image"].cuda(), batch["label"].cuda()
+        if not batch["label_present"].all():
+            assert False, "Training batches must be labeled, unlabeled samples found"
+        image, label = batch["image"].to(device), batch["label"].to(device)
+        if batch_transform is not None:
+            image, label = batch_transform(image, label)
         optimizer.zero_grad()
 
-        if generator is not None:
-            image = generator(image)
+        with mixed_precision.autocast():
+            if generator is not None:
+                image = generator(image)
 
-        prob_preds = model(image)
+            prob_preds = model(image)
 
         loss = calculate_loss(
             label, prob_preds, criterion, weights_criterion, multiclass_criterion, num_classes
         )
 
-        task_loss += loss.item()
-        loss.backward()
+        losses.add("Train_loss", loss)
+        mixed_precision.backward(loss)
 
         if coral:
             # coral_loader contiene una lista de loaders (1 por vendor)
             # donde cada loader carga volúmenes de su vendor asociado
-            paired_loaders = np.random.choice(coral_loader, 2, replace=False)  # replace=False to non-repetitive choice
+            # replace=False to non-repetitive choice
+            paired_loaders = [coral_loader[i] for i in np.random.choice(len(coral_loader), 2, replace=False)]
 
             # torch.Size([1, slices, 3, 224, 224]); squeeze -> num slices as batch
-            batch_0 = next(iter(paired_loaders[0]))
+            batch_0 = next(paired_loaders[0])
             batch_0_vol = batch_0["volume"].squeeze()
-            batch_1 = next(iter(paired_loaders[1]))
+            batch_1 = next(paired_loaders[1])
             batch_1_vol = batch_1["volume"].squeeze()
 
             # Se juntan los volumenes en un solo batch para agilizar la inferencia
-            batch = torch.cat((batch_0_vol, batch_1_vol), 0)
+            batch = torch.cat((batch_0_vol, batch_1_vol), 0).to(device)
 
-            # Existe un trabajo paralelo donde se utilizan GANs para normalizar las imágenes. Es posible
-            # pasar el generador de topología GAN para 'normalizar' el batch previamente
-            if generator is not None:
-                batch = generator(batch)
+            with mixed_precision.autocast():
+                # Existe un trabajo paralelo donde se utilizan GANs para normalizar las imágenes. Es posible
+                # pasar el generador de topología GAN para 'normalizar' el batch previamente
+                if generator is not None:
+                    batch = generator(batch)
 
-            # Se realiza la predicción de los volúmenes
-            pred = model(batch)
+                # Se realiza la predicción de los volúmenes
+                pred = model(batch)
 
             # Se separan los volúmenes juntados previamente
             pred_0 = pred[:len(batch_0_vol)]
@@ -345,7 +432,7 @@ def train_step(
 
             # Se calcula el CORAL loss para los volúmenes inferidos
             c_loss = coral_loss(pred_0_flat, pred_1_flat) * coral_weight
-            coral_global += c_loss.item()
+            losses.add("Coral_loss", c_loss)
 
             num_vols = (1 if batch_0["labeled_info"][0] == "Labeled" else 0) + \
                        (1 if batch_1["labeled_info"][0] == "Labeled" else 0)
@@ -356,7 +443,7 @@ def train_step(
             if batch_0["labeled_info"][0] == "Labeled":
                 batch_0_label = batch_0["label"].squeeze().unsqueeze(1)  # [1, 1, s, h, w] -> [s, 1, h, w]
                 task_vol0_loss = calculate_loss(
-                    batch_0_label.cuda(), pred_0.cuda(), criterion, weights_criterion, multiclass_criterion,
+                    batch_0_label.to(device), pred_0, criterion, weights_criterion, multiclass_criterion,
                     num_classes
                 )
 
@@ -365,47 +452,53 @@ def train_step(
             if batch_1["labeled_info"][0] == "Labeled":
                 batch_1_label = batch_1["label"].squeeze().unsqueeze(1)  # [1, 1, s, h, w] -> [s, 1, h, w]
                 task_vol1_loss = calculate_loss(
-                    batch_1_label.cuda(), pred_1.cuda(), criterion, weights_criterion, multiclass_criterion,
+                    batch_1_label.to(device), pred_1, criterion, weights_criterion, multiclass_criterion,
                     num_classes
                 )
 
                 c_loss = c_loss + ((task_vol1_loss * vol_task_weight) / num_vols)
 
-            c_loss.backward()
+            mixed_precision.backward(c_loss)
 
-        optimizer.step()
-        train_metrics.record(prob_preds, label)
+        mixed_precision.step(optimizer)
+        train_metrics.record(prob_preds.float(), label)
 
-    task_loss = task_loss / len(train_loader)
-    train_metrics.add_losses("Train_loss", task_loss)
+    epoch_losses = losses.means()
+    train_metrics.add_losses("Train_loss", epoch_losses["Train_loss"])
     if coral:
-        coral_global = coral_global / len(train_loader)
-        train_metrics.add_losses("Coral_loss", coral_global)
+        train_metrics.add_losses("Coral_loss", epoch_losses["Coral_loss"])
     train_metrics.update()
     return train_metrics
 
 
 def val_step(val_loader, model, val_metrics, criterion, weights_criterion, multiclass_criterion, num_classes,
-             generated_overlays=1, overlays_path="", generator=None):
+             generated_overlays=1, overlays_path="", generator=None, mixed_precision=None, debug_losses=False):
+    mixed_precision = mixed_precision if mixed_precision is not None else MixedPrecision()
+    losses = RunningLosses(debug=debug_losses)
+    if not is_main_process():  # Distributed launches: overlays of the main process validation shard
+        generated_overlays = -1
     if generated_overlays != 1 and overlays_path != "":
         os.makedirs(overlays_path, exist_ok=True)
 
-    val_loss = 0
+    # Validation shards of distributed processes can have different number of batches: no collectives at forward
+    model = local_model(model)
     model.eval()
+    device = get_device()
     with torch.no_grad():
         for batch_indx, batch in enumerate(val_loader):
             img_id = batch["img_id"]
-            image, label = batch["image"].cuda(), batch["label"].cuda()
+            image, label = batch["image"].to(device), batch["label"].to(device)
 
-            if generator is not None:
-                image = generator(image)
+            with mixed_precision.autocast():
+                if generator is not None:
+                    image = generator(image)
 
-            prob_preds = model(image)
+                prob_preds = model(image).float()
 
             loss = calculate_loss(
                 label, prob_preds, criterion, weights_criterion, multiclass_criterion, num_classes
             )
-            val_loss += loss.item()
+            losses.add("Val_loss", loss)
 
             original_masks = batch["original_mask"]
 
@@ -416,39 +509,40 @@ def val_step(val_loader, model, val_metrics, criterion, weights_criterion, multi
 
             val_metrics.record(prob_preds, original_masks, original_img, generated_overlays, overlays_path, img_id)
 
-    val_loss = val_loss / len(val_loader)
-    val_metrics.add_losses("Val_loss", val_loss)
+    val_metrics.add_losses("Val_loss", losses.means()["Val_loss"])
     val_metrics.update()
     return val_metrics
 
 
-def train_coral_step(coral_loader, model, coral_weight, optimizer, train_metrics, num_iters):
+def train_coral_step(coral_loader, model, coral_weight, optimizer, train_metrics, num_iters, debug_losses=False):
     """
 
     Args:
-        coral_loader: list of volume dataloaders for each vendor
+        coral_loader: list of volume streams for each vendor (see coral_dataset_selector)
         model:
         coral_weight:
         optimizer:
         train_metrics:
         num_iters: number of examples to sample as train step. Ex: 10 will perform 10 coral loss steps
+        debug_losses: Materialise losses every step (see RunningLosses)
     Returns:
 
     """
     if len(coral_loader) < 2:
         assert False, "Please set al least 2 dataloader for coral loss contrastive learning"
 
-    total_loss = 0
+    losses = RunningLosses(debug=debug_losses)
     model.train()
 
     for batch_indx in range(num_iters):
-        paired_loaders = np.random.choice(coral_loader, 2, replace=False)  # replace=False to non-repetitive choice
+        # replace=False to non-repetitive choice
+        paired_loaders = [coral_loader[i] for i in np.random.choice(len(coral_loader), 2, replace=False)]
 
         optimizer.zero_grad()
 
         # torch.Size([1, slices, 3, 224, 224]); squeeze -> num slices as batch
-        batch_0 = next(iter(paired_loaders[0]))["volume"].squeeze()
-        batch_1 = next(iter(paired_loaders[1]))["volume"].squeeze()
+        batch_0 = next(paired_loaders[0])["volume"].squeeze()
+        batch_1 = next(paired_loaders[1])["volume"].squeeze()
 
         batch = torch.cat((batch_0, batch_1), 0)
         pred = model(batch)
@@ -463,56 +557,56 @@ def train_coral_step(coral_loader, model, coral_weight, optimizer, train_metrics
         loss.backward()
         optimizer.step()
 
-        total_loss += loss.item()
+        losses.add("Coral_loss", loss)
 
-    total_loss = total_loss / num_iters
-    train_metrics.add_losses("Coral_loss", total_loss)
+    train_metrics.add_losses("Coral_loss", losses.means()["Coral_loss"])
     return train_metrics
 
 
-def val_coral_step(coral_loader, model, coral_weight, val_metrics, num_iters):
+def val_coral_step(coral_loader, model, coral_weight, val_metrics, num_iters, debug_losses=False):
     """
 
     Args:
-        coral_loader: list of volume dataloaders for each vendor
+        coral_loader: list of volume streams for each vendor (see coral_dataset_selector)
         model:
         coral_weight:
         optimizer:
         val_metrics:
         num_iters: number of examples to sample as train step. Ex: 10 will perform 10 coral loss steps
+        debug_losses: Materialise losses every step (see RunningLosses)
     Returns:
 
     """
     if len(coral_loader) < 2:
         assert False, "Please set al least 2 dataloader for coral loss contrastive learning"
 
-    total_loss = 0
+    losses = RunningLosses(debug=debug_losses)
     model.eval()
 
     with torch.no_grad():
         for batch_indx in range(num_iters):
-            paired_loaders = np.random.choice(coral_loader, 2, replace=False)  # replace=False to non-repetitive choice
+            # replace=False to non-repetitive choice
+            paired_loaders = [coral_loader[i] for i in np.random.choice(len(coral_loader), 2, replace=False)]
 
-            batch_0 = next(iter(paired_loaders[0]))  # torch.Size([1, slices, 3, 224, 224])
+            batch_0 = next(paired_loaders[0])  # torch.Size([1, slices, 3, 224, 224])
             pred_0 = model(batch_0["volume"].squeeze())  # squeeze -> use num slices as batch
             pred_0_flat = pred_0.permute(0, 2, 3, 1).contiguous().view(-1, 4)
 
-            batch_1 = next(iter(paired_loaders[1]))  # torch.Size([1, slices, 3, 224, 224])
+            batch_1 = next(paired_loaders[1])  # torch.Size([1, slices, 3, 224, 224])
             pred_1 = model(batch_1["volume"].squeeze())  # squeeze -> use num slices as batch
             pred_1_flat = pred_1.permute(0, 2, 3, 1).contiguous().view(-1, 4)
 
             loss = coral_loss(pred_0_flat, pred_1_flat) * coral_weight
 
-            total_loss += loss.item()
+            losses.add("Coral_loss", loss)
 
-    total_loss = total_loss / num_iters
-    val_metrics.add_losses("Coral_loss", total_loss)
+    val_metrics.add_losses("Coral_loss", losses.means()["Coral_loss"])
     return val_metrics
 
 
 def finish_swa(
         swa_model, train_loader, val_loader, criterion, weights_criterion, multiclass_criterion,
-        num_classes, include_background, args
+        num_classes, include_background, args, checkpoint_writer=None
 ):
     if args.swa_start == -1:  # If swa was not used, do not perform nothing
         return ""
@@ -525,29 +619,33 @@ def finish_swa(
     by doing a forward pass with the swa_model on each element of the dataset.
     """
     # torch.optim.swa_utils.update_bn(train_loader, swa_model)
+    mixed_precision = MixedPrecision(args.amp)
     swa_model.train()
+    device = get_device()
     with torch.no_grad():
         for indx, batch in enumerate(train_loader):
-            image = batch["image"].type(torch.float).cuda()
-            _ = swa_model(image)
+            image = batch["image"].type(torch.float).to(device)
+            with mixed_precision.autocast():
+                _ = swa_model(image)
 
     swa_epochs = args.epochs - args.swa_start
 
     checkpoint_path = f"model_{args.model_name}_{swa_epochs}epochs_swalr{args.swa_lr}.pt"
     checkpoint_path = os.path.join(args.output_dir, checkpoint_path)
-    torch.save(
-        swa_model.state_dict(),
-        checkpoint_path
-    )
+    if is_main_process():
+        checkpoint_writer = checkpoint_writer if checkpoint_writer is not None else CheckpointWriter(max_pending=0)
+        checkpoint_writer.save(swa_model.state_dict(), checkpoint_path)
 
     swa_metrics = MetricsAccumulator(
         args.problem_type, args.metrics, num_classes, average="mean",
-        include_background=include_background, mask_reshape_method=args.mask_reshape_method
+        include_background=include_background, mask_reshape_method=args.mask_reshape_method,
+        surface_workers=args.surface_workers
     )
 
     swa_metrics = val_step(
         val_loader, swa_model, swa_metrics, criterion, weights_criterion, multiclass_criterion, num_classes,
-        generated_overlays=args.generated_overlays, overlays_path=f"{args.output_dir}/overlays_swa"
+        generated_overlays=args.generated_overlays, overlays_path=f"{args.output_dir}/overlays_swa",
+        mixed_precision=mixed_precision, debug_losses=args.debug_losses
     )
 
     print("SWA validation metrics")